@@ -0,0 +1,115 @@
+"""
+Benchmarks the throughput, latency, memory use and state size of representative
+queries over synthetic data, printing the results as JSON for comparison across
+runs, e.g. python -m benchmarks --formats parquet --output results.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+
+from benchmarks.data import FORMATS, generate
+from benchmarks.runner import MODES, SCENARIOS, STATE_BACKENDS, run_scenario
+
+
+def _list(choices: tuple[str, ...] | list[str]):
+    def parse(value: str) -> list[str]:
+        values = [v for v in value.split(",") if v]
+        for v in values:
+            if v not in choices:
+                raise argparse.ArgumentTypeError(f"{v} is not supported")
+        return values
+
+    return parse
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--files-per-batch", type=int, default=1)
+    parser.add_argument(
+        "--scenarios",
+        type=_list(list(SCENARIOS)),
+        default=list(SCENARIOS),
+        help="comma separated, by default all of " + ",".join(SCENARIOS),
+    )
+    parser.add_argument("--modes", type=_list(MODES), default=list(MODES))
+    parser.add_argument("--formats", type=_list(FORMATS), default=list(FORMATS))
+    parser.add_argument("--backends", type=_list(STATE_BACKENDS), default=["sqlite"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="file to write instead of stdout")
+    args = parser.parse_args()
+
+    started_at = datetime.now()
+    results = []
+    with TemporaryDirectory(prefix="polar_streams-bench-") as tmp:
+        data_dirs: dict[tuple[str, int], Path] = dict()
+        for name in args.scenarios:
+            for fmt in args.formats:
+                keys = SCENARIOS[name].keys
+                if (fmt, keys) not in data_dirs:
+                    data_dirs[fmt, keys] = Path(tmp) / "data" / f"{fmt}-{keys}"
+                    generate(
+                        data_dirs[fmt, keys],
+                        fmt,
+                        args.rows,
+                        args.files,
+                        keys,
+                        args.seed,
+                    )
+
+        # Every run gets a fresh process, spawned as polars does not survive a fork
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=get_context("spawn"), max_tasks_per_child=1
+        ) as executor:
+            for name in args.scenarios:
+                for mode in args.modes:
+                    for fmt in args.formats:
+                        for backend in args.backends:
+                            run = f"{name}-{mode}-{fmt}-{backend}"
+                            print(f"Running {run}", file=sys.stderr)
+                            result = executor.submit(
+                                run_scenario,
+                                name,
+                                mode,
+                                fmt,
+                                backend,
+                                args.rows,
+                                data_dirs[fmt, SCENARIOS[name].keys],
+                                Path(tmp) / "runs" / run,
+                                args.files_per_batch,
+                            ).result()
+                            results.append(asdict(result))
+
+    report = json.dumps(
+        {
+            "started_at": started_at.isoformat(),
+            "python": platform.python_version(),
+            "polars": pl.__version__,
+            "platform": platform.platform(),
+            "arguments": {
+                key: str(value) if isinstance(value, Path) else value
+                for key, value in vars(args).items()
+            },
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
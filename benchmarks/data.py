@@ -0,0 +1,46 @@
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+
+FORMATS = ("csv", "parquet", "ndjson")
+START_TIME = datetime(2024, 1, 1)
+
+
+def synthetic_frame(rows: int, keys: int, seed: int = 0) -> pl.DataFrame:
+    """
+    Deterministic frame of rows with an id drawn from keys distinct values, a value
+    in [0, 1) and an event time increasing by a millisecond per row.
+    """
+    index = pl.int_range(0, rows, dtype=pl.UInt64)
+    return pl.select(
+        (index.hash(seed) % keys).cast(pl.Int64).alias("id"),
+        ((index.hash(seed + 1) % 1_000_000) / 1_000_000).alias("value"),
+        (pl.lit(START_TIME) + pl.duration(milliseconds=index)).alias("ts"),
+    )
+
+
+def generate(
+    directory: Path, fmt: str, rows: int, files: int, keys: int, seed: int = 0
+) -> list[Path]:
+    """
+    Write rows of synthetic data split evenly over files in directory.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    pl_df = synthetic_frame(rows, keys, seed)
+    rows_per_file = -(-rows // files)
+    paths = []
+    for i in range(files):
+        part = pl_df.slice(i * rows_per_file, rows_per_file)
+        path = directory / f"part-{i:05d}.{fmt}"
+        match fmt:
+            case "csv":
+                part.write_csv(path)
+            case "parquet":
+                part.write_parquet(path)
+            case "ndjson":
+                part.write_ndjson(path)
+            case _:
+                raise ValueError(f"{fmt} is not supported")
+        paths.append(path)
+    return paths
@@ -0,0 +1,202 @@
+import json
+import math
+import os
+import resource
+import shutil
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Thread
+from typing import Callable
+
+import polars as pl
+
+from polar_streams.dataframe import DataFrame
+from polar_streams.model import Config, MicroBatch, OutputMode
+from polar_streams.polars import read_stream
+from polar_streams.sink import FileSink, Sink
+
+MODES = ("batch", "streaming")
+STATE_BACKENDS = ("sqlite", "ipc", "parquet")
+STREAMING_TIMEOUT = 600.0
+POLL_INTERVAL = 0.01
+
+
+class NullSink(Sink):
+    """
+    Discards microbatches, which the pipeline has already collected, so only the
+    query itself is measured.
+    """
+
+    def write(self, microbatch: MicroBatch):
+        pass
+
+
+@dataclass(frozen=True)
+class Scenario:
+    query: Callable[[DataFrame], DataFrame]
+    # Output mode when streaming, queries run in complete output mode as a batch
+    output_mode: OutputMode
+    keys: int
+    sink: str = "null"
+
+
+SCENARIOS = {
+    "filter": Scenario(
+        lambda df: df.filter(pl.col("value") < 0.5), OutputMode.APPEND, 1_000
+    ),
+    "drop_duplicates": Scenario(
+        lambda df: df.drop_duplicates("id"), OutputMode.APPEND, 100_000
+    ),
+    "group_by_100": Scenario(
+        lambda df: df.group_by("id").agg(pl.sum("value"), pl.len()),
+        OutputMode.UPDATE,
+        100,
+    ),
+    "group_by_100000": Scenario(
+        lambda df: df.group_by("id").agg(pl.sum("value"), pl.len()),
+        OutputMode.UPDATE,
+        100_000,
+    ),
+    "file_sink": Scenario(
+        lambda df: df.filter(pl.col("value") < 0.5),
+        OutputMode.APPEND,
+        1_000,
+        sink="parquet",
+    ),
+}
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    mode: str
+    format: str
+    backend: str
+    rows: int
+    files: int
+    batches: int
+    seconds: float
+    rows_per_second: float
+    latency_p50: float
+    latency_p99: float
+    peak_rss_bytes: int
+    # Total rows of state after each microbatch, and bytes of the checkpoint
+    state_rows: list[int]
+    state_bytes: int
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest rank percentile, p in [0, 100].
+    """
+    if not values:
+        return math.nan
+    ranked = sorted(values)
+    return ranked[max(0, math.ceil(p / 100 * len(ranked)) - 1)]
+
+
+def _directory_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def _peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _wait_for_progress(metrics_file: Path, files: int, deadline: float) -> list[dict]:
+    """
+    Progress reported by the query, read from its metrics file rather than its
+    progress queue, which drops reports nobody reads in time.
+    """
+    while time.time() < deadline:
+        lines = metrics_file.read_text() if metrics_file.exists() else ""
+        # The last line may still be being written
+        progress = [json.loads(line) for line in lines.split("\n")[:-1]]
+        if sum(p["source_files"] for p in progress) >= files:
+            return progress
+        time.sleep(POLL_INTERVAL)
+    raise TimeoutError(f"Expected {files} files to be processed")
+
+
+def run_scenario(
+    name: str,
+    mode: str,
+    fmt: str,
+    backend: str,
+    rows: int,
+    data_dir: Path,
+    work_dir: Path,
+    files_per_batch: int,
+) -> BenchmarkResult:
+    """
+    Run a scenario over the files in data_dir, holding rows in total, using
+    work_dir for its source, checkpoint and output. Meant to run in a fresh
+    process, so its peak RSS is its own. As a batch the files are read in place,
+    while streaming they are moved into an empty source directory once the query
+    has started.
+    """
+    scenario = SCENARIOS[name]
+    data_files = sorted(data_dir.iterdir())
+    source_dir = data_dir if mode == "batch" else work_dir / "source"
+    source_dir.mkdir(parents=True, exist_ok=True)
+    staging_dir = work_dir / "staging"
+    if mode == "streaming":
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        for path in data_files:
+            shutil.copy(path, staging_dir / path.name)
+
+    df = (
+        read_stream()
+        .format(fmt)
+        .option("maxFilesPerTrigger", str(files_per_batch))
+        .load(source_dir.as_posix())
+    )
+    config = Config(
+        write_options={
+            "checkpointLocation": (work_dir / "checkpoint").as_posix(),
+            "stateBackend": backend,
+            "metricsFile": (work_dir / "metrics.jsonl").as_posix(),
+        },
+        output_mode=OutputMode.COMPLETE if mode == "batch" else scenario.output_mode,
+    )
+    query = scenario.query(df)
+    sink: Sink
+    if scenario.sink == "null":
+        sink = NullSink(config, query)
+    else:
+        sink = FileSink(config, query, scenario.sink, work_dir / "output")
+
+    start = time.time()
+    if mode == "batch":
+        sink.run()
+    else:
+        # The query never finishes when streaming, and is left behind once done
+        Thread(target=sink.run, daemon=True).start()
+        for path in sorted(staging_dir.iterdir()):
+            os.replace(path, source_dir / path.name)
+    progress = _wait_for_progress(
+        work_dir / "metrics.jsonl", len(data_files), start + STREAMING_TIMEOUT
+    )
+    seconds = time.time() - start
+
+    latencies = [p["duration"] for p in progress]
+    return BenchmarkResult(
+        scenario=name,
+        mode=mode,
+        format=fmt,
+        backend=backend,
+        rows=rows,
+        files=len(data_files),
+        batches=len(progress),
+        seconds=seconds,
+        rows_per_second=rows / seconds if seconds else math.nan,
+        latency_p50=percentile(latencies, 50),
+        latency_p99=percentile(latencies, 99),
+        peak_rss_bytes=_peak_rss_bytes(),
+        state_rows=[sum(p["state_rows"].values()) for p in progress],
+        state_bytes=_directory_size(work_dir / "checkpoint"),
+    )
@@ -1,4 +0,0 @@
-import logging
-
-logging.basicConfig()
-logging.getLogger().setLevel(logging.DEBUG)
@@ -0,0 +1,263 @@
+import json
+import logging
+import warnings
+from dataclasses import dataclass
+from enum import Enum
+
+import polars as pl
+from polars.expr.expr import Expr
+
+from polar_streams.util import log
+
+logger = logging.getLogger(__name__)
+COL_TYPE = Expr | str
+
+
+class AggregationKind(Enum):
+    SUM = "sum"
+    COUNT = "count"
+    LEN = "len"
+    MIN = "min"
+    MAX = "max"
+    MEAN = "mean"
+    FIRST = "first"
+    LAST = "last"
+
+
+@dataclass
+class PartialAggregate:
+    """
+    A single aggregation expression split into partial state columns which can be
+    computed per microbatch and merged with the partials of previous microbatches.
+    """
+
+    kind: AggregationKind
+    input_col: None | str
+    output_name: str
+
+    def _state_col(self, kind: AggregationKind) -> str:
+        return f"__{kind.value}_{self.output_name}"
+
+    def batch_exprs(self) -> list[Expr]:
+        col = pl.col(self.input_col) if self.input_col else pl.first()
+        match self.kind:
+            case AggregationKind.SUM:
+                return [col.sum().alias(self._state_col(self.kind))]
+            case AggregationKind.COUNT:
+                return [col.count().cast(pl.Int64).alias(self._state_col(self.kind))]
+            case AggregationKind.LEN:
+                length = col.len() if self.input_col else pl.len()
+                return [length.cast(pl.Int64).alias(self._state_col(self.kind))]
+            case AggregationKind.MIN:
+                return [col.min().alias(self._state_col(self.kind))]
+            case AggregationKind.MAX:
+                return [col.max().alias(self._state_col(self.kind))]
+            case AggregationKind.FIRST:
+                return [col.first().alias(self._state_col(self.kind))]
+            case AggregationKind.LAST:
+                return [col.last().alias(self._state_col(self.kind))]
+            case AggregationKind.MEAN:
+                return [
+                    col.sum().alias(self._state_col(AggregationKind.SUM)),
+                    col.count()
+                    .cast(pl.Int64)
+                    .alias(self._state_col(AggregationKind.COUNT)),
+                ]
+
+    def merge_exprs(self) -> list[Expr]:
+        match self.kind:
+            case AggregationKind.SUM | AggregationKind.COUNT | AggregationKind.LEN:
+                return [pl.col(self._state_col(self.kind)).sum()]
+            case AggregationKind.MIN:
+                return [pl.col(self._state_col(self.kind)).min()]
+            case AggregationKind.MAX:
+                return [pl.col(self._state_col(self.kind)).max()]
+            case AggregationKind.FIRST:
+                return [pl.col(self._state_col(self.kind)).first()]
+            case AggregationKind.LAST:
+                return [pl.col(self._state_col(self.kind)).last()]
+            case AggregationKind.MEAN:
+                return [
+                    pl.col(self._state_col(AggregationKind.SUM)).sum(),
+                    pl.col(self._state_col(AggregationKind.COUNT)).sum(),
+                ]
+
+    def finalise_expr(self) -> Expr:
+        if self.kind == AggregationKind.MEAN:
+            total = pl.col(self._state_col(AggregationKind.SUM))
+            count = pl.col(self._state_col(AggregationKind.COUNT))
+            return (pl.when(count > 0).then(total / count).otherwise(None)).alias(
+                self.output_name
+            )
+        return pl.col(self._state_col(self.kind)).alias(self.output_name)
+
+
+def _unwrap_column(node) -> None | str:
+    # Aggregation inputs are serialised either as the bare expression or wrapped
+    # alongside options, depending on the aggregation and polars version.
+    if isinstance(node, dict) and "Column" in node:
+        return node["Column"]
+    if isinstance(node, dict) and "input" in node:
+        return _unwrap_column(node["input"])
+    if isinstance(node, list) and node:
+        return _unwrap_column(node[0])
+    return None
+
+
+def _include_nulls(node) -> bool:
+    # Serialised as [input, include_nulls] before polars 1.33
+    if isinstance(node, dict):
+        return bool(node.get("include_nulls"))
+    if isinstance(node, list) and len(node) == 2:
+        return node[1] is True
+    return False
+
+
+def parse_partial_aggregate(expr: COL_TYPE) -> None | PartialAggregate:
+    """
+    Translate an aggregation expression into a PartialAggregate, returning None if
+    the expression cannot be maintained incrementally.
+    """
+    if isinstance(expr, str) or expr.meta.has_multiple_outputs():
+        return None
+
+    output_name = expr.meta.output_name(raise_if_undetermined=False)
+    if output_name is None:
+        return None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        tree = json.loads(expr.meta.serialize(format="json"))
+
+    if isinstance(tree, dict) and "Alias" in tree:
+        tree = tree["Alias"][0]
+
+    if tree == "Len":
+        return PartialAggregate(AggregationKind.LEN, None, output_name)
+
+    if not isinstance(tree, dict) or "Agg" not in tree:
+        return None
+
+    ((name, node),) = tree["Agg"].items()
+    input_col = _unwrap_column(node)
+    if input_col is None:
+        return None
+
+    match name:
+        case "Sum":
+            kind = AggregationKind.SUM
+        case "Count":
+            kind = (
+                AggregationKind.LEN if _include_nulls(node) else AggregationKind.COUNT
+            )
+        case "Min":
+            kind = AggregationKind.MIN
+        case "Max":
+            kind = AggregationKind.MAX
+        case "Mean":
+            kind = AggregationKind.MEAN
+        case "First":
+            kind = AggregationKind.FIRST
+        case "Last":
+            kind = AggregationKind.LAST
+        case _:
+            return None
+
+    return PartialAggregate(kind, input_col, output_name)
+
+
+class IncrementalAggregator:
+    """
+    Maintains one row of partial aggregates per group key so that each microbatch
+    only has to be merged into the keys it touches rather than re-aggregating the
+    full history of raw rows. The merged partials replace those of the keys in the
+    state they are merged into, so callers keep the state split into buckets by key
+    hash and merge each microbatch into the buckets its keys fall into.
+    """
+
+    def __init__(self, group_cols: list[str], partials: list[PartialAggregate]):
+        self._group_cols = group_cols
+        self._partials = partials
+
+    @classmethod
+    def from_exprs(
+        cls, group_cols: list[COL_TYPE], agg_cols: list[COL_TYPE]
+    ) -> "None | IncrementalAggregator":
+        group_names = []
+        for col in group_cols:
+            if isinstance(col, str):
+                group_names.append(col)
+                continue
+            name = col.meta.output_name(raise_if_undetermined=False)
+            if name is None or not col.meta.is_column():
+                logger.warning(
+                    f"Grouping by {col} cannot be computed incrementally, "
+                    "falling back to re-aggregating the full history"
+                )
+                return None
+            group_names.append(name)
+
+        partials = []
+        for agg_col in agg_cols:
+            partial = parse_partial_aggregate(agg_col)
+            if partial is None:
+                logger.warning(
+                    f"Aggregation {agg_col} cannot be computed incrementally, "
+                    "falling back to re-aggregating the full history"
+                )
+                return None
+            partials.append(partial)
+
+        return cls(group_names, partials)
+
+    def partials(self, batch: pl.LazyFrame) -> pl.LazyFrame:
+        """
+        Partial aggregates of the records of a microbatch, one row per group key.
+        """
+        return batch.group_by(self._group_cols, maintain_order=True).agg(
+            [e for p in self._partials for e in p.batch_exprs()]
+        )
+
+    def merge(
+        self, state: None | pl.LazyFrame, batch_partials: pl.LazyFrame
+    ) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+        """
+        Merge the partial aggregates of a microbatch into the partial state,
+        returning the new state and the merged partials of the keys touched by the
+        microbatch.
+        """
+        if state is None:
+            return batch_partials, batch_partials
+
+        batch_keys = batch_partials.select(self._group_cols)
+        touched = pl.concat(
+            [
+                state.join(
+                    batch_keys, on=self._group_cols, how="semi", nulls_equal=True
+                ),
+                batch_partials,
+            ],
+            how="vertical_relaxed",
+        )
+        merged = touched.group_by(self._group_cols, maintain_order=True).agg(
+            [e for p in self._partials for e in p.merge_exprs()]
+        )
+        untouched = state.join(
+            batch_keys, on=self._group_cols, how="anti", nulls_equal=True
+        )
+        return pl.concat([untouched, merged], how="vertical_relaxed"), merged
+
+    @log()
+    def update(
+        self, state: None | pl.LazyFrame, batch: pl.LazyFrame
+    ) -> tuple[pl.LazyFrame, pl.LazyFrame]:
+        """
+        Merge a microbatch into the partial state, returning the new state and the
+        merged partials of the keys touched by the microbatch.
+        """
+        return self.merge(state, self.partials(batch))
+
+    def finalise(self, state: pl.LazyFrame) -> pl.LazyFrame:
+        return state.select(
+            *self._group_cols, *[p.finalise_expr() for p in self._partials]
+        )
@@ -0,0 +1,247 @@
+import logging
+import os
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from multiprocessing import Process
+from queue import Queue
+from threading import Lock
+from typing import Callable, Generator
+
+import polars as pl
+
+from polar_streams.model import BatchMetrics, Config, Metadata, MicroBatch, OutputMode
+from polar_streams.pipeline import DONE, StageFailed
+from polar_streams.sink import QueryManager, Sink
+from polar_streams.source import FileSource, SourceFactory
+from polar_streams.statestore import StateStore
+from polar_streams.util import log
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBER_QUEUE_DEPTH = 2
+
+
+class SharedSourceLog:
+    """
+    Records source files in the WAL of every query reading a shared source. A file
+    only counts as processed once every query has committed it, and the WAL ids
+    returned are those of the first query, which translate maps to the WAL ids of
+    each query.
+    """
+
+    def __init__(self, state_stores: list[StateStore]):
+        self._state_stores = state_stores
+        self._wal_ids: dict[int, list[int]] = dict()
+
+    def processed_source_files(self) -> dict[str, tuple[int, float]]:
+        processed = [store.processed_source_files() for store in self._state_stores]
+        return {
+            path: info
+            for path, info in processed[0].items()
+            if all(files.get(path) == info for files in processed[1:])
+        }
+
+    def wal_uncommitted_entries(self) -> list[str]:
+        entries = [store.wal_uncommitted_entries() for store in self._state_stores]
+        return list(dict.fromkeys(entry for keys in entries for entry in keys))
+
+    def wal_append_many(
+        self, keys: list[str], source_files: None | list[tuple[int, float]] = None
+    ) -> list[int]:
+        wal_ids = [
+            store.wal_append_many(keys, source_files) for store in self._state_stores
+        ]
+        for i, wal_id in enumerate(wal_ids[0]):
+            self._wal_ids[wal_id] = [store_ids[i] for store_ids in wal_ids]
+        return wal_ids[0]
+
+    def source_schema(self, source: str) -> None | pl.Schema:
+        schemas = [store.source_schema(source) for store in self._state_stores]
+        pinned = {str(schema): schema for schema in schemas if schema is not None}
+        if len(pinned) > 1:
+            raise ValueError(f"Expected the queries reading {source} to share a schema")
+        return next(iter(pinned.values()), None)
+
+    def write_source_schema(self, source: str, schema: pl.Schema) -> None:
+        for store in self._state_stores:
+            store.write_source_schema(source, schema)
+
+    def translate(self, wal_ids: list[int]) -> list[list[int]]:
+        """
+        WAL ids of each query for WAL ids returned by wal_append_many, which are
+        forgotten once translated.
+        """
+        per_query = [self._wal_ids.pop(wal_id) for wal_id in wal_ids]
+        if not per_query:
+            return [[] for _ in self._state_stores]
+        return [list(ids) for ids in zip(*per_query)]
+
+
+class SharedSource:
+    """
+    A file source read by several queries of a StreamingContext. The source is
+    driven once all of its queries have subscribed, and every microbatch is read
+    into memory once and handed to each query along with its own WAL ids. The
+    slowest query applies backpressure to the source.
+    """
+
+    def __init__(self, context: "StreamingContext", source: FileSource):
+        self.context = context
+        self._source = source
+        self._lock = Lock()
+        self._subscribers: list[tuple[StateStore, Config, Queue]] = []
+        self.expected_subscribers = 0
+
+    def _drive(self) -> None:
+        queues = [q for _, _, q in self._subscribers]
+        try:
+            complete = {
+                config.output_mode == OutputMode.COMPLETE
+                for _, config, _ in self._subscribers
+            }
+            if len(complete) > 1:
+                raise ValueError(
+                    "Queries sharing a source cannot mix complete output mode with "
+                    "other output modes"
+                )
+
+            source_log = SharedSourceLog([store for store, _, _ in self._subscribers])
+            config = self._subscribers[0][1]
+            for microbatch in self._source.process(source_log, config):
+                with microbatch.metadata.metrics.timed("scan"):
+                    pl_df = microbatch.pl_df.collect().lazy()
+                wal_ids = source_log.translate(microbatch.metadata.wal_ids)
+                for q, query_wal_ids in zip(queues, wal_ids):
+                    q.put(
+                        MicroBatch(
+                            pl_df=pl_df,
+                            metadata=Metadata(
+                                start_time=microbatch.metadata.start_time,
+                                source_files=microbatch.metadata.source_files,
+                                wal_ids=query_wal_ids,
+                                metrics=BatchMetrics(
+                                    durations=dict(
+                                        microbatch.metadata.metrics.durations
+                                    )
+                                ),
+                            ),
+                            watermark=microbatch.watermark,
+                        )
+                    )
+            for q in queues:
+                q.put(DONE)
+        except BaseException as e:
+            for q in queues:
+                q.put(StageFailed(e))
+
+    def backlog(self) -> int:
+        return self._source.backlog()
+
+    @log()
+    def process(
+        self, state_store: StateStore, config: Config
+    ) -> Generator[MicroBatch, None, None]:
+        q: Queue = Queue(maxsize=SUBSCRIBER_QUEUE_DEPTH)
+        with self._lock:
+            self._subscribers.append((state_store, config, q))
+            if len(self._subscribers) == self.expected_subscribers:
+                self.context.submit(self._drive)
+
+        while (item := q.get()) is not DONE:
+            if isinstance(item, StageFailed):
+                raise item.error
+            yield item
+
+
+class StreamingContext:
+    """
+    Hosts several queries in a single process. Sources loaded through the context
+    with the same format, path and options are shared, so each source file is
+    discovered and read once and fanned out to every query reading it. Queries,
+    their pipeline stages and the shared sources run on one thread pool, which is
+    sized for them unless max_workers is given.
+
+    Queries are added by saving them as usual, and run once start is called. The
+    managers returned when saving them report their progress, while all of them are
+    stopped together through the manager returned by start.
+    """
+
+    def __init__(self, max_workers: None | int = None):
+        self._max_workers = max_workers
+        self._sources: dict[tuple, SharedSource] = dict()
+        self._queries: list[Sink] = []
+        self._executor: None | ThreadPoolExecutor = None
+        self._process = Process(target=self._run_process)
+
+    @log()
+    def read_stream(self) -> SourceFactory:
+        return SourceFactory(self)
+
+    def shared_source(self, source: FileSource) -> SharedSource:
+        assert source._path is not None
+        key = (
+            source._format,
+            source._path.resolve().as_posix(),
+            tuple(sorted(source._options.items())),
+            str(source._schema),
+        )
+        if key not in self._sources:
+            self._sources[key] = SharedSource(self, source)
+        return self._sources[key]
+
+    @log()
+    def add_query(self, sink: Sink) -> QueryManager:
+        if self._process.is_alive():
+            raise ValueError("Cannot add a query to a running StreamingContext")
+        self._queries.append(sink)
+        return QueryManager(None, sink.progress)
+
+    def submit(self, fn: Callable[[], None]) -> Future:
+        assert self._executor is not None
+        return self._executor.submit(fn)
+
+    def _required_workers(self) -> int:
+        # Each query runs on one worker, plus two for its pipeline stages, and each
+        # shared source is driven by one worker
+        workers = sum(3 if query.queue_depth > 0 else 1 for query in self._queries)
+        return workers + len(self._sources)
+
+    @log()
+    def _run(self) -> None:
+        subscribers = Counter(query._df.query_plan().source for query in self._queries)
+        for source in self._sources.values():
+            source.expected_subscribers = subscribers[source]
+
+        required = self._required_workers()
+        max_workers = self._max_workers or required
+        if max_workers < required:
+            raise ValueError(
+                f"Expected at least {required} workers for {len(self._queries)} queries"
+            )
+
+        # Streaming queries never finish, so a failed query must not wait for them
+        executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="query"
+        )
+        self._executor = executor
+        try:
+            futures = [executor.submit(query.run, executor) for query in self._queries]
+            for future in as_completed(futures):
+                future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run_process(self) -> None:
+        # Workers blocked on a stalled query would keep the process alive, so a
+        # failure of any query exits the process
+        try:
+            self._run()
+        except BaseException:
+            logger.exception("Stopping streaming context after a query failed")
+            os._exit(1)
+
+    @log()
+    def start(self) -> QueryManager:
+        self._process.start()
+        return QueryManager(self._process)
@@ -1,23 +1,59 @@
 import logging
 from abc import ABC, abstractmethod
-from typing import Generator
+from contextlib import contextmanager
+from datetime import timedelta
+from queue import Queue
+from threading import Event, Thread
+from typing import TYPE_CHECKING, Generator, Iterator
 
 import polars as pl
+import polars.selectors as cs
 from polars.expr.expr import Expr
 
-from polar_streams.model import Config, MicroBatch, OutputMode
+from polar_streams.aggregation import IncrementalAggregator
+from polar_streams.hashing import check_layout, key_hash
+from polar_streams.model import Config, MicroBatch, OutputMode, Watermark
+from polar_streams.partition import Partitions
+from polar_streams.pipeline import DONE, StageFailed
+from polar_streams.profiler import Profiler, collect, profiled
 from polar_streams.sink import SinkFactory
 from polar_streams.statestore import StateStore
-from polar_streams.util import log
+from polar_streams.util import log, parse_duration
+from polar_streams.window import Window
+
+if TYPE_CHECKING:
+    from polar_streams.source import StaticTable
 
 logger = logging.getLogger(__name__)
 COL_TYPE = Expr | str
+BUCKET_COL = "__bucket"
+JOIN_SIDES = ("left", "right")
+STATIC_JOIN_TYPES = ("inner", "left", "semi", "anti")
+JOIN_QUEUE_DEPTH = 2
+
+
+def _root_names(cols: list[COL_TYPE]) -> None | set[str]:
+    """
+    Names of the columns read by the given columns, or None if they cannot be
+    determined, e.g. for selectors and wildcards.
+    """
+    names: set[str] = set()
+    for col in cols:
+        if isinstance(col, str):
+            names.add(col)
+        elif col.meta.has_multiple_outputs() or col.meta.is_regex_projection():
+            return None
+        else:
+            names.update(col.meta.root_names())
+    return names
 
 
 class DataFrame:
-    def __init__(self, source):
+    def __init__(self, source, operation: "None | Operator" = None):
+        # The operation is applied to the output of source, so several DataFrames
+        # can be derived from the same DataFrame without affecting each other
         self._source = source
-        self._operation = None
+        self._operation = operation
 
     @log()
     def write_stream(self) -> SinkFactory:
@@ -27,16 +63,18 @@ class DataFrame:
     def process(
         self, state_store: StateStore, config: Config
     ) -> Generator[MicroBatch, None, None]:
-        for microbatch in self._source.process(state_store, config):
-            if self._operation:
-                yield self._operation.process(microbatch, state_store)
-            else:
-                yield microbatch
+        plan = self.query_plan()
+        try:
+            yield from plan.process(state_store, config)
+        finally:
+            plan.close()
+
+    def query_plan(self) -> "QueryPlan":
+        return QueryPlan(self)
 
     @log()
     def with_columns(self, *cols: COL_TYPE):
-        self._operation = AddColumns(list(cols))
-        return DataFrame(self)
+        return DataFrame(self, AddColumns(list(cols)))
 
     @log()
     def with_column(self, col: COL_TYPE):
@@ -44,87 +82,566 @@ class DataFrame:
 
     @log()
     def select(self, *cols: COL_TYPE):
-        self._operation = Select(list(cols))
-        return DataFrame(self)
+        return DataFrame(self, Select(list(cols)))
 
     @log()
-    def group_by(self, *cols):
-        return GroupedDataFrame(self, list(cols))
+    def group_by(self, *cols, num_buckets: int = 32):
+        return GroupedDataFrame(self, list(cols), num_buckets)
 
     @log()
     def filter(self, predicate: Expr | bool):
-        self._operation = Filter(predicate)
-        return DataFrame(self)
+        return DataFrame(self, Filter(predicate))
 
     @log()
-    def drop_duplicates(self, *key):
-        self._operation = DropDuplicates(list(key))
-        return DataFrame(self)
+    def drop_duplicates(
+        self, *key, num_buckets: int = 32, within_watermark: bool = False
+    ):
+        return DataFrame(self, DropDuplicates(list(key), num_buckets, within_watermark))
+
+    @log()
+    def with_watermark(self, event_time_col: str, delay: str | timedelta):
+        return DataFrame(self, WithWatermark(event_time_col, parse_duration(delay)))
+
+    @log()
+    def join(
+        self,
+        other: "DataFrame | pl.DataFrame | pl.LazyFrame | StaticTable",
+        on: str | list[str],
+        how: str = "inner",
+        num_buckets: int = 32,
+    ):
+        on = [on] if isinstance(on, str) else list(on)
+        if not isinstance(other, DataFrame):
+            return DataFrame(self, StaticJoin(other, on, how))
+
+        if how != "inner":
+            raise ValueError(f"{how} is not supported")
+        source = JoinSource(self, other)
+        return DataFrame(DataFrame(source), StreamJoin(source, on, num_buckets))
 
 
 class GroupedDataFrame(DataFrame):
-    def __init__(self, source, group_cols: list[COL_TYPE]):
+    """
+    Aggregates the records of each group across microbatches. Aggregations which
+    can be maintained incrementally keep one row of partial aggregates per group,
+    partitioned into num_buckets state tables by key hash so each microbatch only
+    rewrites the buckets its groups fall into. Other aggregations keep every record
+    of the groups and re-aggregate them on each microbatch.
+
+    The number of buckets and the hash assigning groups to them are recorded in
+    state, and must not change for an existing checkpoint. Checkpoints which kept
+    every record of the groups have them aggregated into buckets on first use.
+    """
+
+    stateful = True
+    projects = True
+
+    def __init__(
+        self, source, group_cols: list[COL_TYPE | Window], num_buckets: int = 32
+    ):
         super().__init__(source)
         self._agg_cols: list[COL_TYPE] = []
-        self._group_cols = group_cols
+        self._num_buckets = num_buckets
+        self._bucketed = False
+
+        # A window is grouped on by the start and end columns it assigns
+        windows = [col for col in group_cols if isinstance(col, Window)]
+        if len(windows) > 1:
+            raise ValueError("Expected at most one window when grouping")
+        self._window = windows[0] if windows else None
+        self._group_cols: list[COL_TYPE] = [
+            *(self._window.columns if self._window else []),
+            *(col for col in group_cols if not isinstance(col, Window)),
+        ]
+        self._group_names = [
+            col
+            if isinstance(col, str)
+            else col.meta.output_name(raise_if_undetermined=False)
+            for col in self._group_cols
+        ]
+        self._aggregator: None | IncrementalAggregator = None
+
+    def __getstate__(self) -> dict:
+        # Stages are sent to partition workers without the query they are part of
+        return {**self.__dict__, "_source": None}
 
     @log()
     def agg(self, *cols: list[COL_TYPE]):
         self._agg_cols = list(cols)  # type: ignore
+        self._aggregator = IncrementalAggregator.from_exprs(
+            self._group_cols, self._agg_cols
+        )
         return DataFrame(self)
 
+    def columns(self) -> None | set[str]:
+        window_cols = self._window.columns if self._window else []
+        names = _root_names(
+            [
+                col
+                for col in self._group_cols
+                if not (isinstance(col, str) and col in window_cols)
+            ]
+            + self._agg_cols
+        )
+        if names is not None and self._window:
+            names.add(self._window.time_col)
+        return names
+
+    def partition_key(self) -> None | list[COL_TYPE]:
+        window_cols = self._window.columns if self._window else []
+        return [
+            col
+            for col in self._group_cols
+            if not (isinstance(col, str) and col in window_cols)
+        ]
+
     @log()
+    def process_microbatch(
+        self, microbatch: MicroBatch, state_store: StateStore, config: Config
+    ) -> MicroBatch:
+        if self._aggregator:
+            return self._process_incremental(microbatch, state_store, config)
+
+        pl_df, expired = self._prepare(microbatch)
+
+        # Fetch state if exists, otherwise initialise with current batch
+        new_state = pl_df
+        microbatch_keys = pl_df.select(self._group_cols).unique()
+
+        if state_store.state_exists("group_by"):
+            new_state = pl.concat(
+                [
+                    new_state,
+                    state_store.get_state("group_by"),
+                ]
+            )
+
+        # Evict finalised groups from state
+        finalised = new_state
+        if expired is not None and config.output_mode != OutputMode.COMPLETE:
+            finalised = new_state.filter(expired)
+            new_state = new_state.filter(~expired)
+
+        result = new_state.group_by(self._group_cols).agg(self._agg_cols).lazy()
+
+        # If update mode, remove unchanged records
+        if config.output_mode == OutputMode.UPDATE:
+            result = microbatch_keys.join(
+                result, on=self._group_cols, how="left", coalesce=True
+            )
+        # If append mode with a watermark, only emit finalised groups
+        elif config.output_mode == OutputMode.APPEND and expired is not None:
+            result = finalised.group_by(self._group_cols).agg(self._agg_cols)
+
+        # Update state, sharing the concatenated history with the result
+        new_state_df, result_df = pl.collect_all([new_state, result])
+        state_store.write_state(new_state_df.lazy(), "group_by")
+
+        return microbatch.new(result_df.lazy())
+
+    def _open_buckets(self, state_store: StateStore) -> None:
+        assert self._aggregator
+        self._bucketed = True
+        bucketed = any(
+            state_store.state_exists(f"group_by_partials_{bucket:04d}")
+            for bucket in range(self._num_buckets)
+        )
+        check_layout(
+            state_store, "group_by_buckets", "buckets", self._num_buckets, bucketed
+        )
+        if bucketed or not state_store.state_exists("group_by"):
+            return
+
+        # Checkpoints used to keep every record of the groups, which are aggregated
+        # into partials once
+        state = (
+            self._aggregator.partials(state_store.get_state("group_by"))
+            .with_columns(self._bucket())
+            .collect()
+        )
+        logger.info(f"Splitting {state.height} groups into {self._num_buckets} buckets")
+        for (bucket,), pl_df_bucket in state.partition_by(
+            BUCKET_COL, as_dict=True, include_key=False
+        ).items():
+            state_store.write_state(
+                pl_df_bucket.lazy(), f"group_by_partials_{bucket:04d}"
+            )
+
+    def _bucket(self) -> Expr:
+        return (key_hash(self._group_names) % self._num_buckets).alias(BUCKET_COL)
+
+    def _process_incremental(
+        self, microbatch: MicroBatch, state_store: StateStore, config: Config
+    ) -> MicroBatch:
+        assert self._aggregator
+        if not self._bucketed:
+            self._open_buckets(state_store)
+        pl_df, expired = self._prepare(microbatch)
+
+        # Merge the partial aggregates of the batch into the buckets of its groups
+        batch_partials = (
+            self._aggregator.partials(pl_df).with_columns(self._bucket()).collect()
+        )
+        states: dict[int, pl.DataFrame] = dict()
+        touched = []
+        for (bucket,), partials in batch_partials.partition_by(
+            BUCKET_COL, as_dict=True, include_key=False
+        ).items():
+            table_name = f"group_by_partials_{bucket:04d}"
+            state = None
+            if state_store.state_exists(table_name):
+                state = state_store.get_state(table_name)
+            states[bucket], merged = pl.collect_all(
+                list(self._aggregator.merge(state, partials.lazy()))
+            )
+            touched.append(merged)
+        changed = set(states)
+
+        # Untouched buckets are only read to evict finalised groups, or to emit
+        # every group outside update mode
+        if expired is not None or config.output_mode != OutputMode.UPDATE:
+            for bucket in range(self._num_buckets):
+                table_name = f"group_by_partials_{bucket:04d}"
+                if bucket not in states and state_store.state_exists(table_name):
+                    states[bucket] = state_store.get_state(table_name).collect()
+
+        # Evict finalised groups from state
+        finalised = []
+        if expired is not None and config.output_mode != OutputMode.COMPLETE:
+            for bucket, state in states.items():
+                finalised.append(state.filter(expired))
+                states[bucket] = state.filter(~expired)
+                if states[bucket].height < state.height:
+                    changed.add(bucket)
+
+        # Update state
+        for bucket in changed:
+            state_store.write_state(
+                states[bucket].lazy(), f"group_by_partials_{bucket:04d}"
+            )
+
+        # If update mode, only emit the groups touched by this batch
+        empty = batch_partials.drop(BUCKET_COL).clear()
+        if config.output_mode == OutputMode.UPDATE:
+            emitted = touched
+        # If append mode with a watermark, only emit finalised groups
+        elif config.output_mode == OutputMode.APPEND and expired is not None:
+            emitted = finalised
+        else:
+            emitted = list(states.values())
+        result = pl.concat([empty, *emitted], how="vertical_relaxed")
+        return microbatch.new(self._aggregator.finalise(result.lazy()))
+
+    def _prepare(self, microbatch: MicroBatch) -> tuple[pl.LazyFrame, None | Expr]:
+        """
+        Assign the records of a microbatch to windows and drop records arriving for
+        groups which have already been finalised, returning the records along with
+        the predicate matching finalised groups.
+        """
+        pl_df = microbatch.pl_df
+        if self._window:
+            pl_df = self._window.assign(pl_df)
+
+        expired = self._expired(microbatch)
+        if expired is not None:
+            pl_df = pl_df.filter(~expired)
+        return pl_df, expired
+
+    def _expired(self, microbatch: MicroBatch) -> None | Expr:
+        """
+        Predicate matching the groups which can no longer receive records as they are
+        older than the watermark, or None if the groups are not bounded by event time.
+        """
+        watermark = microbatch.watermark
+        if not watermark:
+            return None
+        windowed = self._window and watermark.event_time_col == self._window.time_col
+        if not windowed and watermark.event_time_col not in self._group_names:
+            return None
+        if watermark.timestamp is None:
+            # No group can have been finalised before the first watermark
+            return pl.lit(False)
+        if self._window and windowed:
+            return self._window.expired(watermark.timestamp)
+        return pl.col(watermark.event_time_col) < watermark.timestamp
+
+
+class QueryPlan:
+    """
+    Flattens a chain of DataFrames into its source and the stages applied to each
+    microbatch, so the chain is walked once rather than through nested generators.
+    Stateless operators only extend the lazy plan of a microbatch, letting polars
+    optimise across all of them, and the plan is collected once before each
+    stateful stage so the source is never scanned more than once per microbatch.
+
+    When the numPartitions option is greater than one, the first stage keyed by a
+    partition key runs in that many partitions, see Partitions. Stages before and
+    after it run in the query process.
+    """
+
+    def __init__(self, df: DataFrame):
+        self.stages: list[Operator | GroupedDataFrame] = []
+        node = df
+        while isinstance(node, DataFrame) and node._source is not None:
+            if node._operation:
+                self.stages.append(node._operation)
+            if isinstance(node, GroupedDataFrame):
+                self.stages.append(node)
+            node = node._source
+        self.stages.reverse()
+        self.source = node
+        self.required_columns = self._required_columns()
+        self._first_stateful = next(
+            (i for i, stage in enumerate(self.stages) if stage.stateful),
+            len(self.stages),
+        )
+        self._keyed = next(
+            (
+                i
+                for i, stage in enumerate(self.stages)
+                if stage.partition_key() is not None
+            ),
+            None,
+        )
+        self._partitions: None | Partitions = None
+
+    def _required_columns(self) -> None | set[str]:
+        """
+        Source columns needed up to the first stage which projects its input, which
+        are pushed down to the source scan so stateful stages only materialise the
+        columns the query actually reads. None if every column may be needed.
+        """
+        required: set[str] = set()
+        for stage in self.stages:
+            columns = stage.columns()
+            if columns is None:
+                return None
+            required |= columns
+            if stage.projects:
+                return required
+        return None
+
     def process(
         self, state_store: StateStore, config: Config
     ) -> Generator[MicroBatch, None, None]:
-        for microbatch in self._source.process(state_store, config):
-            # Fetch state if exists, otherwise initialise with current batch
-            new_state = microbatch.pl_df
-            microbatch_keys = microbatch.pl_df.select(self._group_cols).unique()
-
-            if state_store.state_exists("group_by"):
-                new_state = pl.concat(
-                    [
-                        new_state,
-                        state_store.get_state("group_by"),
-                    ]
-                )
+        profiler = Profiler.from_config(config)
+        for microbatch in self.source.process(state_store, config):
+            if profiler:
+                profiler.start(microbatch)
+            yield self.process_microbatch(microbatch, state_store, config)
 
-            # Update state
-            state_store.write_state(new_state, "group_by")
+    def _project(self, microbatch: MicroBatch) -> MicroBatch:
+        if self.required_columns is None:
+            return microbatch
+        # Columns created by stages are not in the source, so are ignored here
+        return microbatch.new(
+            microbatch.pl_df.select(
+                cs.by_name(sorted(self.required_columns), require_all=False)
+            )
+        )
 
-            result = new_state.group_by(self._group_cols).agg(self._agg_cols).lazy()
+    @staticmethod
+    def _apply(
+        stages: list["Operator | GroupedDataFrame"],
+        microbatch: MicroBatch,
+        state_store: StateStore,
+        config: Config,
+        materialised: bool,
+    ) -> MicroBatch:
+        engine = config.write_options.get("engine", "auto") if config else "auto"
+        for stage in stages:
+            if stage.stateful and not materialised:
+                with QueryPlan._timed(microbatch, "collect"):
+                    microbatch = microbatch.new(
+                        collect(microbatch, "collect", engine).lazy()
+                    )
 
-            # If update mode, remove unchanged records
-            if config.output_mode == OutputMode.UPDATE:
-                result = microbatch_keys.join(
-                    result, on=self._group_cols, how="left", coalesce=True
-                )
-            # TODO: implement watermark for late records when using OutputMode.APPEND
+            # Stateless stages only extend the lazy plan, so only stateful stages
+            # are worth timing
+            if isinstance(stage, GroupedDataFrame):
+                with QueryPlan._timed(microbatch, QueryPlan.stage_name(stage)):
+                    microbatch = stage.process_microbatch(
+                        microbatch, state_store, config
+                    )
+            elif stage.stateful:
+                with QueryPlan._timed(microbatch, QueryPlan.stage_name(stage)):
+                    microbatch = stage.process(microbatch, state_store)
+            else:
+                microbatch = stage.process(microbatch, state_store)
+
+            # Stateful stages return results which are already in memory
+            materialised = stage.stateful
+        return microbatch
 
-            # Yield aggregated result
-            yield microbatch.new(result)
+    @staticmethod
+    @contextmanager
+    def _timed(microbatch: MicroBatch, name: str) -> Iterator[None]:
+        # Microbatches processed outside of a query may have no metadata
+        if microbatch.metadata is None:
+            yield
+            return
+        with microbatch.metadata.metrics.timed(name), profiled(microbatch, name):
+            yield
+
+    @staticmethod
+    def stage_name(stage: "Operator | GroupedDataFrame") -> str:
+        """
+        Name the time spent in a stage is recorded under in BatchMetrics.
+        """
+        return (
+            "GroupBy" if isinstance(stage, GroupedDataFrame) else type(stage).__name__
+        )
+
+    def _start_partitions(
+        self, state_store: StateStore, config: Config
+    ) -> None | Partitions:
+        num_partitions = (
+            int(config.write_options.get("numPartitions", 1)) if config else 1
+        )
+        if self._partitions or self._keyed is None or num_partitions <= 1:
+            return self._partitions
+
+        stage = self.stages[self._keyed]
+        key = stage.partition_key()
+        if not key:
+            raise ValueError("Expected a key besides the window to partition by")
+        check_layout(state_store, "partitions", "partitions", num_partitions, False)
+
+        self._partitions = Partitions(
+            QueryPlan._apply, stage, key, num_partitions, state_store, config
+        )
+        return self._partitions
+
+    def _apply_stateful(
+        self,
+        microbatch: MicroBatch,
+        state_store: StateStore,
+        config: Config,
+        materialised: bool,
+    ) -> MicroBatch:
+        stages = self.stages[self._first_stateful :]
+        partitions = self._start_partitions(state_store, config)
+        if partitions is None or self._keyed is None:
+            return self._apply(stages, microbatch, state_store, config, materialised)
+
+        keyed = self._keyed - self._first_stateful
+        microbatch = self._apply(
+            stages[:keyed], microbatch, state_store, config, materialised
+        )
+        with self._timed(microbatch, self.stage_name(self.stages[self._keyed])):
+            microbatch = partitions.process(microbatch)
+        return self._apply(stages[keyed + 1 :], microbatch, state_store, config, True)
+
+    @log()
+    def close(self) -> None:
+        """
+        Stop the partitions of the query, if any.
+        """
+        if self._partitions:
+            self._partitions.close()
+            self._partitions = None
+
+    @log()
+    def process_microbatch(
+        self, microbatch: MicroBatch, state_store: StateStore, config: Config
+    ) -> MicroBatch:
+        microbatch = self._apply(
+            self.stages[: self._first_stateful],
+            self._project(microbatch),
+            state_store,
+            config,
+            False,
+        )
+        return self._apply_stateful(microbatch, state_store, config, False)
+
+    @log()
+    def read(
+        self, microbatch: MicroBatch, state_store: StateStore, config: Config
+    ) -> MicroBatch:
+        """
+        Scan a microbatch from the source into memory, applying the stateless
+        stages before the first stateful stage so they are still pushed down to
+        the scan. Together with transform this is equivalent to process_microbatch.
+
+        With the streaming engine the microbatch is left lazy instead, so it is
+        only materialised where the query needs it, before its first stateful stage
+        or as its output, and the scan is streamed through the stages before it.
+        """
+        engine = config.write_options.get("engine", "auto") if config else "auto"
+        microbatch = self._apply(
+            self.stages[: self._first_stateful],
+            self._project(microbatch),
+            state_store,
+            config,
+            False,
+        )
+        if not self._materialise_reads(config):
+            return microbatch
+        pl_df = collect(microbatch, "read", engine)
+        if microbatch.metadata:
+            microbatch.metadata.metrics.input_rows = pl_df.height
+        return microbatch.new(pl_df.lazy())
+
+    @log()
+    def transform(
+        self, microbatch: MicroBatch, state_store: StateStore, config: Config
+    ) -> MicroBatch:
+        """
+        Apply the stages from the first stateful stage onwards to a microbatch
+        returned by read.
+        """
+        return self._apply_stateful(
+            microbatch, state_store, config, self._materialise_reads(config)
+        )
+
+    @staticmethod
+    def _materialise_reads(config: Config) -> bool:
+        return not config or config.write_options.get("engine") != "streaming"
 
 
 class Operator(ABC):
+    stateful = False
+    projects = False
+
     @abstractmethod
     def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
         raise NotImplementedError
 
+    def columns(self) -> None | set[str]:
+        """
+        Columns read by the operator, or None if they cannot be determined.
+        """
+        return None
+
+    def partition_key(self) -> None | list[COL_TYPE]:
+        """
+        Columns the state of the operator is keyed by, so that it can be split
+        into partitions by key, or None if the state is not keyed.
+        """
+        return None
+
 
 class AddColumns(Operator):
     def __init__(self, cols: list[COL_TYPE]):
         self._cols = cols
 
+    def columns(self) -> None | set[str]:
+        return _root_names(self._cols)
+
     @log()
     def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
         return microbatch.new(microbatch.pl_df.with_columns(self._cols))
 
 
 class Select(Operator):
+    projects = True
+
     def __init__(self, cols: list[COL_TYPE]):
         self._cols = cols
 
+    def columns(self) -> None | set[str]:
+        return _root_names(self._cols)
+
     @log()
     def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
         return microbatch.new(microbatch.pl_df.select(self._cols))
@@ -134,41 +651,429 @@ class Filter(Operator):
     def __init__(self, predicate: Expr | bool):
         self._predicate = predicate
 
+    def columns(self) -> None | set[str]:
+        if isinstance(self._predicate, bool):
+            return set()
+        return _root_names([self._predicate])
+
     @log()
     def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
         return microbatch.new(microbatch.pl_df.filter(self._predicate))
 
 
-class DropDuplicates(Operator):
-    def __init__(self, key: list[COL_TYPE]):
-        self._key = key
+class WithWatermark(Operator):
+    """
+    Tracks the maximum event time seen by the stream and attaches the resulting
+    watermark (max event time - delay) to every microbatch for downstream stateful
+    operators. The watermark only ever moves forward and is persisted in state,
+    typed as the event time column.
+
+    A microbatch carries the watermark as it stood before the microbatch, so its
+    own records are never late against it, and the watermark advanced by the
+    microbatch only applies from the next microbatch onwards.
+    """
+
+    stateful = True
+
+    def __init__(self, event_time_col: str, delay: timedelta):
+        self._event_time_col = event_time_col
+        self._delay = delay
+
+    def columns(self) -> None | set[str]:
+        return {self._event_time_col}
 
     @log()
     def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
-        if not state_store.state_exists("drop_duplicates"):
-            # initialise state
-            state_store.write_state(
-                microbatch.pl_df.select(*self._key).unique(), "drop_duplicates"
+        watermark = microbatch.pl_df.select(
+            (pl.col(self._event_time_col).max() - self._delay).alias("watermark")
+        ).collect()
+        timestamp = None
+        if state_store.state_exists("watermark"):
+            state = state_store.get_state("watermark").collect()
+            if state.schema["watermark"] == pl.String:
+                # Checkpoints used to store the watermark as an ISO 8601 string
+                state = state.select(
+                    pl.col("watermark")
+                    .str.to_datetime()
+                    .cast(watermark.schema["watermark"])
+                )
+            timestamp = state.item()
+            watermark = pl.concat([state, watermark.cast(state.schema)]).select(
+                pl.col("watermark").max()
             )
-            return microbatch.new(microbatch.pl_df.unique(subset=self._key))  # type: ignore
 
-        # deduplicate incoming batch
-        pl_df_unique = microbatch.pl_df.unique(subset=self._key)  # type: ignore
-        state = state_store.get_state("drop_duplicates")
+        if watermark.item() is not None and watermark.item() != timestamp:
+            state_store.write_state(watermark.lazy(), "watermark")
 
-        # filter out records based on state
-        pl_df_deduplicated = pl_df_unique.join(
-            other=state,
-            on=self._key,
-            how="anti",
+        return MicroBatch(
+            pl_df=microbatch.pl_df,
+            metadata=microbatch.metadata,
+            watermark=Watermark(self._event_time_col, self._delay, timestamp),
         )
 
-        # update state
-        new_state = pl.concat([state, pl_df_unique.select(*self._key)]).unique(
-            subset=self._key  # type: ignore
+
+class DropDuplicates(Operator):
+    """
+    Deduplicates records against every key seen so far. Keys are partitioned into
+    num_buckets state tables by hash, so each microbatch only reads the buckets its
+    keys fall into and appends the unseen keys to them as deltas.
+
+    With within_watermark the event time of each key is stored alongside it, late
+    records are dropped and keys are evicted from the buckets once they fall behind
+    the watermark, keeping the state bounded.
+
+    The number of buckets and the hash assigning keys to them are recorded in
+    state, and must not change for an existing checkpoint. Checkpoints which kept
+    every key in a single table have their keys split into buckets on first use.
+    """
+
+    stateful = True
+
+    def __init__(
+        self,
+        key: list[COL_TYPE],
+        num_buckets: int = 32,
+        within_watermark: bool = False,
+    ):
+        self._key = key
+        self._num_buckets = num_buckets
+        self._within_watermark = within_watermark
+        self._bucketed = False
+
+    def _bucket(self, key: list[COL_TYPE]) -> Expr:
+        return (key_hash(key) % self._num_buckets).alias(BUCKET_COL)
+
+    def _open_buckets(self, microbatch: MicroBatch, state_store: StateStore) -> None:
+        self._bucketed = True
+        bucketed = any(
+            state_store.state_exists(f"drop_duplicates_{bucket:04d}")
+            for bucket in range(self._num_buckets)
+        )
+        check_layout(
+            state_store,
+            "drop_duplicates_buckets",
+            "buckets",
+            self._num_buckets,
+            bucketed,
+        )
+        if bucketed or not state_store.state_exists("drop_duplicates"):
+            return
+
+        state = state_store.get_state("drop_duplicates").collect()
+        key_cols = state.columns
+        if microbatch.watermark and self._within_watermark:
+            # Keys seen before have no event time, so are evicted by the watermark
+            event_time_col = microbatch.watermark.event_time_col
+            dtype = microbatch.pl_df.collect_schema()[event_time_col]
+            state = state.with_columns(pl.lit(None, dtype).alias(event_time_col))
+        logger.info(f"Splitting {state.height} keys into {self._num_buckets} buckets")
+        for (bucket,), pl_df_bucket in (
+            state.with_columns(self._bucket(key_cols))
+            .partition_by(BUCKET_COL, as_dict=True, include_key=False)
+            .items()
+        ):
+            state_store.write_state(
+                pl_df_bucket.lazy(), f"drop_duplicates_{bucket:04d}"
+            )
+
+    def columns(self) -> None | set[str]:
+        return _root_names(self._key)
+
+    def partition_key(self) -> None | list[COL_TYPE]:
+        return self._key
+
+    @log()
+    def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
+        if not self._bucketed:
+            self._open_buckets(microbatch, state_store)
+
+        pl_df = microbatch.pl_df
+        state_cols = list(self._key)
+        expired = None
+        if self._within_watermark:
+            if not microbatch.watermark:
+                raise ValueError(
+                    "Expected a watermark when dropping duplicates within watermark"
+                )
+            state_cols.append(microbatch.watermark.event_time_col)
+            if microbatch.watermark.timestamp is not None:
+                expired = (
+                    pl.col(microbatch.watermark.event_time_col)
+                    < microbatch.watermark.timestamp
+                )
+                pl_df = pl_df.filter(~expired)
+
+        # deduplicate incoming batch and assign keys to buckets
+        pl_df_unique = (
+            pl_df.unique(subset=self._key)  # type: ignore
+            .with_columns(self._bucket(self._key))
+            .collect()
         )
 
-        state_store.write_state(new_state, "drop_duplicates")
+        deduplicated = []
+        for (bucket,), pl_df_bucket in pl_df_unique.partition_by(
+            BUCKET_COL, as_dict=True, include_key=False
+        ).items():
+            table_name = f"drop_duplicates_{bucket:04d}"
+
+            # filter out records based on state
+            if state_store.state_exists(table_name):
+                state = state_store.get_state(table_name).collect()
+
+                # evict keys behind the watermark
+                if expired is not None:
+                    live_state = state.filter(~expired)
+                    if live_state.height < state.height:
+                        state_store.write_state(live_state.lazy(), table_name)
+                    state = live_state
+
+                pl_df_bucket = pl_df_bucket.join(
+                    other=state.select(*self._key),
+                    on=self._key,
+                    how="anti",
+                    nulls_equal=True,
+                )
+
+            # update state
+            if not pl_df_bucket.is_empty():
+                state_store.append_state(
+                    pl_df_bucket.lazy().select(*state_cols), table_name
+                )
+                deduplicated.append(pl_df_bucket)
 
         # return deduplicated dataframe
-        return microbatch.new(pl_df=pl_df_deduplicated)
+        if not deduplicated:
+            return microbatch.new(pl_df_unique.drop(BUCKET_COL).clear().lazy())
+        return microbatch.new(pl_df=pl.concat(deduplicated).lazy())
+
+
+class StaticJoin(Operator):
+    """
+    Joins each microbatch with a static table, e.g. to enrich a stream with
+    reference data. Polars frames are collected once and kept in memory, while a
+    StaticTable is read again once its files change. Only joins emitting records
+    of the stream are supported, as the static table has no microbatches.
+    """
+
+    def __init__(
+        self,
+        other: "pl.DataFrame | pl.LazyFrame | StaticTable",
+        on: list[str],
+        how: str,
+    ):
+        if how not in STATIC_JOIN_TYPES:
+            raise ValueError(f"{how} is not supported")
+        self._other = other
+        self._on = on
+        self._how = how
+
+    def columns(self) -> None | set[str]:
+        return set(self._on)
+
+    def _table(self) -> pl.DataFrame:
+        if isinstance(self._other, pl.LazyFrame):
+            self._other = self._other.collect()
+        if isinstance(self._other, pl.DataFrame):
+            return self._other
+        return self._other.get()
+
+    @log()
+    def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
+        return microbatch.new(
+            microbatch.pl_df.join(self._table().lazy(), on=self._on, how=self._how)  # type: ignore
+        )
+
+
+class JoinSource:
+    """
+    Reads the inputs of a stream-stream join, yielding the microbatches of both
+    inputs as they arrive, tagged with the side they were read from. Each input
+    is read on its own thread and has the stages before its first stateful stage
+    applied there, so they are still pushed down to its scans. Microbatches are
+    only passed on once both inputs have been read from, so the schema of each
+    input is known before anything is joined.
+    """
+
+    def __init__(self, left: DataFrame, right: DataFrame):
+        self.plans = (left.query_plan(), right.query_plan())
+        for plan in self.plans:
+            if any(
+                stage.stateful and not isinstance(stage, WithWatermark)
+                for stage in plan.stages
+            ):
+                raise ValueError(
+                    "Expected only stateless operators and with_watermark on the "
+                    "inputs of a stream-stream join"
+                )
+        self.schemas: dict[int, pl.Schema] = dict()
+
+    def _read(
+        self,
+        side: int,
+        state_store: StateStore,
+        config: Config,
+        outbox: Queue,
+        first_read: list[Event],
+    ) -> None:
+        plan = self.plans[side]
+        try:
+            for microbatch in plan.source.process(state_store, config):
+                microbatch = plan.read(microbatch, state_store, config)
+                if side not in self.schemas:
+                    self.schemas[side] = microbatch.pl_df.collect_schema()
+                    first_read[side].set()
+                first_read[1 - side].wait()
+                microbatch.side = side
+                outbox.put(microbatch)
+            outbox.put(DONE)
+        except BaseException as e:
+            outbox.put(StageFailed(e))
+        finally:
+            # An input without any files must not hold back the other input
+            first_read[side].set()
+
+    @log()
+    def process(
+        self, state_store: StateStore, config: Config
+    ) -> Generator[MicroBatch, None, None]:
+        outbox: Queue = Queue(maxsize=JOIN_QUEUE_DEPTH)
+        first_read = [Event(), Event()]
+        for side in range(len(self.plans)):
+            Thread(
+                target=self._read,
+                args=(side, state_store, config, outbox, first_read),
+                name=f"join-{JOIN_SIDES[side]}",
+                daemon=True,
+            ).start()
+
+        done = 0
+        while done < len(self.plans):
+            item = outbox.get()
+            if item is DONE:
+                done += 1
+            elif isinstance(item, StageFailed):
+                raise item.error
+            else:
+                yield item
+
+
+class StreamJoin(Operator):
+    """
+    Inner join of the two streams read by a JoinSource. The records of each input
+    are buffered in state, partitioned into num_buckets tables per input by the
+    hash of the join key, and each microbatch is joined with the buckets of the
+    other input its keys fall into before being buffered itself.
+
+    An input with a watermark drops records arriving behind it, and its buffered
+    records are evicted from the buckets a microbatch touches once they fall behind
+    it, keeping the state bounded. Records of an input without a watermark are
+    kept forever. The output carries the earlier of the two watermarks, once both
+    inputs have one.
+
+    The number of buckets and the hash assigning keys to them are recorded in
+    state, and must not change for an existing checkpoint.
+    """
+
+    stateful = True
+
+    def __init__(self, source: JoinSource, on: list[str], num_buckets: int = 32):
+        self._source = source
+        self._on = on
+        self._num_buckets = num_buckets
+        self._watermarks: list[None | Watermark] = [None, None]
+        self._bucketed = False
+
+    def _open_buckets(self, state_store: StateStore) -> None:
+        self._bucketed = True
+        bucketed = any(
+            state_store.state_exists(f"join_{side}_{bucket:04d}")
+            for side in JOIN_SIDES
+            for bucket in range(self._num_buckets)
+        )
+        check_layout(
+            state_store, "join_buckets", "buckets", self._num_buckets, bucketed
+        )
+
+    def _transform(
+        self, side: int, microbatch: MicroBatch, state_store: StateStore
+    ) -> MicroBatch:
+        # The input's own watermark is kept apart from the other input's
+        input_store = state_store.namespace(f"join_{JOIN_SIDES[side]}_")
+        plan = self._source.plans[side]
+        for stage in plan.stages[plan._first_stateful :]:
+            assert isinstance(stage, Operator)
+            microbatch = stage.process(microbatch, input_store)
+        return microbatch
+
+    def _join(
+        self, side: int, pl_df: pl.DataFrame, other: pl.DataFrame
+    ) -> pl.DataFrame:
+        # Columns of the left input always come first
+        if side == 0:
+            return pl_df.join(other, on=self._on, how="inner")
+        return other.join(pl_df, on=self._on, how="inner")
+
+    def _empty(self, side: int, state_store: StateStore) -> None | pl.DataFrame:
+        schema = self._source.schemas.get(side)
+        if schema is None:
+            return None
+        microbatch = MicroBatch(pl_df=pl.LazyFrame(schema=schema), metadata=None)  # type: ignore
+        return self._transform(side, microbatch, state_store).pl_df.collect()
+
+    def _watermark(self) -> None | Watermark:
+        watermarks = [
+            watermark
+            for watermark in self._watermarks
+            if watermark and watermark.timestamp is not None
+        ]
+        if len(watermarks) < len(self._watermarks):
+            return None
+        return min(watermarks, key=lambda watermark: watermark.timestamp)  # type: ignore
+
+    @log()
+    def process(self, microbatch: MicroBatch, state_store: StateStore) -> MicroBatch:
+        if not self._bucketed:
+            self._open_buckets(state_store)
+        side = microbatch.side
+        microbatch = self._transform(side, microbatch, state_store)
+        self._watermarks[side] = microbatch.watermark
+
+        pl_df = microbatch.pl_df
+        expired = None
+        watermark = microbatch.watermark
+        if watermark and watermark.timestamp is not None:
+            expired = pl.col(watermark.event_time_col) < watermark.timestamp
+            pl_df = pl_df.filter(~expired)
+        pl_df_buckets = pl_df.with_columns(
+            (key_hash(self._on) % self._num_buckets).alias(BUCKET_COL)
+        ).collect()
+
+        joined = []
+        for (bucket,), pl_df_bucket in pl_df_buckets.partition_by(
+            BUCKET_COL, as_dict=True, include_key=False
+        ).items():
+            other_table = f"join_{JOIN_SIDES[1 - side]}_{bucket:04d}"
+            if state_store.state_exists(other_table):
+                other = state_store.get_state(other_table).collect()
+                joined.append(self._join(side, pl_df_bucket, other))
+
+            # evict records behind the watermark, then buffer the new records
+            table_name = f"join_{JOIN_SIDES[side]}_{bucket:04d}"
+            if expired is not None and state_store.state_exists(table_name):
+                state = state_store.get_state(table_name).collect()
+                live_state = state.filter(~expired)
+                if live_state.height < state.height:
+                    state_store.write_state(live_state.lazy(), table_name)
+            state_store.append_state(pl_df_bucket.lazy(), table_name)
+
+        if joined:
+            result = pl.concat(joined)
+        else:
+            empty = pl_df_buckets.drop(BUCKET_COL).clear()
+            other = self._empty(1 - side, state_store)
+            result = empty if other is None else self._join(side, empty, other)
+        return MicroBatch(
+            pl_df=result.lazy(),
+            metadata=microbatch.metadata,
+            watermark=self._watermark(),
+        )
@@ -0,0 +1,247 @@
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+from fnmatch import fnmatch
+from pathlib import Path
+from threading import Lock
+
+from polar_streams.util import log
+
+TEMP_FILE_SUFFIXES = (".tmp", ".temp", ".part", ".crdownload", "._COPYING_")
+DEFAULT_STABILITY_INTERVAL = timedelta(seconds=1)
+
+
+def is_hidden(name: str, temp_suffixes: tuple[str, ...] = TEMP_FILE_SUFFIXES) -> bool:
+    """
+    Files and directories starting with "." or "_", such as _SUCCESS markers and
+    _temporary directories, and files with a temporary suffix are never read.
+    """
+    return name.startswith((".", "_")) or name.endswith(temp_suffixes)
+
+
+@dataclass
+class DirectoryListing:
+    mtime_ns: int
+    files: dict[str, tuple[int, float]] = field(default_factory=dict)
+    subdirs: list[str] = field(default_factory=list)
+
+
+class FileLister:
+    """
+    Lists the files under a source directory with os.scandir, filtered by a glob on
+    the file name and by hive style partition directories (key=value). Hidden and
+    temporary files are skipped, and when a success marker is given, files are only
+    listed once their directory contains it. Listings are cached per directory, and
+    a directory is only rescanned when its modification time changes, so refreshing
+    a large, mostly unchanged tree costs one stat per directory rather than one per
+    file.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        recursive: bool = True,
+        glob: str = "*",
+        partition_filter: None | dict[str, str] = None,
+        temp_suffixes: tuple[str, ...] = TEMP_FILE_SUFFIXES,
+        success_marker: None | str = None,
+    ):
+        self._root = root
+        self._recursive = recursive
+        self._glob = glob
+        self._partition_filter = partition_filter or dict()
+        self._temp_suffixes = temp_suffixes
+        self._success_marker = success_marker
+        self._dirs: dict[str, DirectoryListing] = dict()
+        self._files: dict[str, tuple[int, float]] = dict()
+
+    def _partition_matches(self, name: str) -> bool:
+        key, sep, value = name.partition("=")
+        return not sep or self._partition_filter.get(key, value) == value
+
+    def matches(self, path: str) -> bool:
+        """
+        Whether a path below the root passes the recursion, glob and partition
+        filters.
+        """
+        try:
+            parts = Path(path).relative_to(self._root).parts
+        except ValueError:
+            return False
+        if not parts or (not self._recursive and len(parts) > 1):
+            return False
+        return (
+            fnmatch(parts[-1], self._glob)
+            and not is_hidden(parts[-1], self._temp_suffixes)
+            and all(
+                self._partition_matches(part) and not is_hidden(part)
+                for part in parts[:-1]
+            )
+        )
+
+    def _scan(self, directory: str, seen: set[str]) -> list[str]:
+        seen.add(directory)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        new_files = []
+        listing = self._dirs.get(directory)
+        if listing is None or listing.mtime_ns != mtime_ns:
+            previous = listing.files if listing else dict()
+            listing = DirectoryListing(mtime_ns)
+            complete = not self._success_marker
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name == self._success_marker:
+                        complete = True
+                    if is_hidden(entry.name, self._temp_suffixes):
+                        continue
+                    if entry.is_dir():
+                        if self._recursive and self._partition_matches(entry.name):
+                            listing.subdirs.append(entry.path)
+                    elif entry.is_file() and fnmatch(entry.name, self._glob):
+                        stat = entry.stat()
+                        listing.files[entry.path] = (stat.st_size, stat.st_mtime)
+            if not complete:
+                listing.files.clear()
+            new_files = [
+                path
+                for path, info in listing.files.items()
+                if previous.get(path) != info
+            ]
+            for path in previous.keys() - listing.files.keys():
+                del self._files[path]
+            self._files.update(listing.files)
+            self._dirs[directory] = listing
+
+        for subdir in listing.subdirs:
+            new_files.extend(self._scan(subdir, seen))
+        return new_files
+
+    def _sorted(self, paths: list[str]) -> list[Path]:
+        return [
+            Path(path) for path in sorted(paths, key=lambda p: (self._files[p][1], p))
+        ]
+
+    @log()
+    def refresh(self) -> list[Path]:
+        """
+        Rescan the tree and return the files which are new or have changed since
+        the previous scan, oldest first.
+        """
+        seen: set[str] = set()
+        new_files = self._scan(self._root.as_posix(), seen)
+        for directory in self._dirs.keys() - seen:
+            for path in self._dirs.pop(directory).files:
+                del self._files[path]
+        return self._sorted(new_files)
+
+    @log()
+    def list(self) -> list[Path]:
+        """
+        Rescan the tree and return every file in it, oldest first.
+        """
+        self.refresh()
+        return self._sorted(list(self._files))
+
+    def file_info(self, path: str) -> None | tuple[int, float]:
+        """
+        Size and modification time of a file as of the latest scan.
+        """
+        return self._files.get(path)
+
+
+@dataclass
+class PendingFile:
+    size: int
+    mtime: float
+    stable_since: float
+    closed: bool
+
+
+class FileCompletionTracker:
+    """
+    Holds back discovered files until they have been completely written. A file is
+    complete once its writer closed it or moved it into place, or once its size and
+    modification time have not changed for the stability interval, and, when a
+    success marker is given, its directory contains the marker. Closing an empty
+    file does not complete it. When a stability interval is set it is required even
+    for closed files, for writers which reopen their files. Files are checked
+    without blocking, so the tracker can be polled from the discovery thread.
+    """
+
+    def __init__(
+        self,
+        stability_interval: None | timedelta = None,
+        success_marker: None | str = None,
+    ):
+        self._stability_interval = stability_interval
+        self._success_marker = success_marker
+        self._pending: dict[str, PendingFile] = dict()
+        self._completed: dict[str, tuple[int, float]] = dict()
+        self._lock = Lock()
+
+    def add(self, path: str, closed: bool = False) -> None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if path in self._pending:
+                self._pending[path].closed |= closed
+            else:
+                self._pending[path] = PendingFile(
+                    stat.st_size, stat.st_mtime, time.monotonic(), closed
+                )
+
+    def add_completed(self, path: str, info: None | tuple[int, float]) -> None:
+        """
+        Record a file which has already been read, so events for it are dropped.
+        """
+        if info is None:
+            return
+        with self._lock:
+            self._completed[path] = info
+
+    def _is_ready(self, pending: PendingFile, now: float) -> bool:
+        # Some writers create and close an empty file before writing to it again
+        if pending.closed and pending.size and self._stability_interval is None:
+            return True
+        interval = self._stability_interval or DEFAULT_STABILITY_INTERVAL
+        return now - pending.stable_since >= interval.total_seconds()
+
+    def complete(self) -> list[str]:
+        """
+        Remove and return the pending files which are now complete, oldest first.
+        Files which were already returned with the same size and modification time
+        are dropped.
+        """
+        now = time.monotonic()
+        completed = []
+        with self._lock:
+            for path, pending in list(self._pending.items()):
+                if self._success_marker and not os.path.exists(
+                    os.path.join(os.path.dirname(path), self._success_marker)
+                ):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._pending[path]
+                    continue
+
+                info = (stat.st_size, stat.st_mtime)
+                if info != (pending.size, pending.mtime):
+                    pending.size, pending.mtime = info
+                    pending.stable_since = now
+                if not self._is_ready(pending, now):
+                    continue
+
+                del self._pending[path]
+                if self._completed.get(path) != info:
+                    self._completed[path] = info
+                    completed.append((info[1], path))
+        return [path for _, path in sorted(completed)]
@@ -0,0 +1,115 @@
+from functools import partial
+
+import polars as pl
+import pyarrow as pa  # type: ignore
+from polars.expr.expr import Expr
+
+from polar_streams.statestore import StateStore
+
+# Recorded with state laid out by key hash, so a checkpoint is never read with its
+# keys assigned to buckets or partitions by another hash
+HASH_SCHEME = "splitmix64-v1"
+NULL_HASH = 0x6A09E667F3BCC909
+# Hex digits of the bytes of a value hashed at a time, which fit an Int64
+BYTES_CHUNK = 14
+
+
+def _u64(value: int) -> Expr:
+    return pl.lit(value, pl.UInt64)
+
+
+def _mix(x: Expr) -> Expr:
+    # The splitmix64 finaliser, on integers which wrap around on overflow
+    x = x + _u64(0x9E3779B97F4A7C15)
+    x = x.xor(x // _u64(1 << 30)) * _u64(0xBF58476D1CE4E5B9)
+    x = x.xor(x // _u64(1 << 27)) * _u64(0x94D049BB133111EB)
+    return x.xor(x // _u64(1 << 31))
+
+
+def _bytes_bits(series: pl.Series) -> pl.Series:
+    chunks = (
+        pl.col("bytes")
+        .bin.encode("hex")
+        .str.extract_all(f".{{1,{BYTES_CHUNK}}}")
+        .list.eval(
+            pl.element().str.to_integer(base=16).cast(pl.UInt64)
+            * _mix(pl.int_range(pl.len(), dtype=pl.UInt64))
+        )
+        .list.sum()
+    )
+    return (
+        series.to_frame("bytes")
+        .select(chunks.xor(pl.col("bytes").bin.size().cast(pl.UInt64)))
+        .to_series()
+    )
+
+
+def _value_bits(series: pl.Series) -> pl.Series:
+    dtype = series.dtype
+    if dtype.is_decimal() or dtype in (pl.String, pl.Categorical, pl.Enum):
+        return _bytes_bits(series.cast(pl.String).cast(pl.Binary))
+    if dtype == pl.Binary:
+        return _bytes_bits(series)
+    if dtype == pl.UInt64:
+        return series
+    if dtype.is_integer() or dtype.is_temporal():
+        return series.to_physical().cast(pl.Int64).reinterpret(signed=False)
+    if dtype == pl.Boolean:
+        return series.cast(pl.UInt64)
+    if dtype.is_float():
+        # Zeros and NaNs are equal whatever their sign and payload
+        series = series.cast(pl.Float64)
+        series = series.set(series == 0.0, 0.0).set(series.is_nan(), float("nan"))
+        return pl.Series(series.name, series.to_arrow().view(pa.uint64()))
+    if dtype == pl.Null:
+        return series.cast(pl.UInt64)
+    raise ValueError(f"Hashing {dtype} keys is not supported")
+
+
+def _hash_keys(keys: pl.Series, seed: int) -> pl.Series:
+    hashed = pl.Series("hash", [seed] * len(keys), pl.UInt64)
+    for field in keys.struct.fields:
+        bits = _value_bits(keys.struct.field(field)).fill_null(NULL_HASH)
+        hashed = pl.DataFrame({"hash": hashed, "bits": bits}).select(
+            _mix(pl.col("hash").xor(pl.col("bits")))
+        )["hash"]
+    return hashed
+
+
+def key_hash(key: list, seed: int = 0) -> Expr:
+    """
+    Hash of the key of each record, computed from the values of the key alone so
+    that it does not change with the polars version, unlike Expr.hash. Integer and
+    temporal keys hash by their value whatever their width.
+    """
+    return pl.struct(key).map_batches(
+        partial(_hash_keys, seed=seed), return_dtype=pl.UInt64, is_elementwise=True
+    )
+
+
+def check_layout(
+    state_store: StateStore, table_name: str, name: str, count: int, existing: bool
+) -> None:
+    """
+    Check the state of an operator laid out across count buckets or partitions by
+    key hash against the layout recorded for an existing checkpoint, or record it
+    for a new one. State laid out before layouts were recorded, when existing, was
+    assigned by the polars hash and cannot be read.
+    """
+    if state_store.state_exists(table_name):
+        recorded = state_store.get_state(table_name).collect()
+    elif existing:
+        recorded = pl.DataFrame({name: [count]})
+    else:
+        state_store.write_state(
+            pl.DataFrame({name: [count], "hash": [HASH_SCHEME]}).lazy(), table_name
+        )
+        return
+
+    if recorded[name].item() != count:
+        raise ValueError(
+            f"Expected {recorded[name].item()} {name} for the existing checkpoint"
+        )
+    scheme = recorded["hash"].item() if "hash" in recorded.columns else "polars"
+    if scheme != HASH_SCHEME:
+        raise ValueError(f"Keys hashed with {scheme} are not supported")
@@ -0,0 +1,96 @@
+import base64
+import io
+import json
+import os
+from pathlib import Path
+from threading import Lock
+
+import polars as pl
+
+from polar_streams.util import log
+
+MANIFEST_DIR = "_manifest"
+
+
+def encode_schema(schema: pl.Schema) -> str:
+    # Arrow IPC schemas stay readable across polars versions, unlike serialize
+    buffer = io.BytesIO()
+    pl.DataFrame(schema=schema).write_ipc(buffer)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def decode_schema(encoded: str) -> pl.Schema:
+    return pl.read_ipc(io.BytesIO(base64.b64decode(encoded))).schema
+
+
+class SinkManifest:
+    """
+    Log of the files making up the output of a file sink, relative to its
+    directory. Each version of the manifest is a JSON file listing the files it
+    adds and removes and the microbatch it belongs to, written to a temporary file
+    and renamed into place, so a version is either fully recorded or not at all.
+    The files of the output are those added and not since removed by any version,
+    and readers wanting a consistent view of the output should list them here
+    rather than from the directory. Versions also record the schema their files
+    were written with, as formats like CSV do not keep it.
+    """
+
+    def __init__(self, path: Path):
+        self._dir = path / MANIFEST_DIR
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._version = -1
+        self._files: dict[str, None | str] = dict()
+        self._batches: set[str] = set()
+        for version_path in sorted(self._dir.glob("*.json")):
+            self._apply(json.loads(version_path.read_text()))
+            self._version = int(version_path.stem)
+
+    def _apply(self, version: dict) -> None:
+        for file in version["removed"]:
+            self._files.pop(file, None)
+        self._files.update(dict.fromkeys(version["added"], version.get("schema")))
+        self._batches.add(version["batch"])
+
+    def files(self) -> list[str]:
+        """
+        Files of the output, in the order they were added.
+        """
+        with self._lock:
+            return list(self._files)
+
+    def schema(self, file: str) -> None | pl.Schema:
+        """
+        Schema the file of the output was written with, if it was recorded.
+        """
+        with self._lock:
+            encoded = self._files.get(file)
+        return decode_schema(encoded) if encoded else None
+
+    def contains(self, batch: str) -> bool:
+        with self._lock:
+            return batch in self._batches
+
+    @log()
+    def commit(
+        self,
+        batch: str,
+        added: list[str],
+        removed: None | list[str] = None,
+        wal_ids: None | list[int] = None,
+        schema: None | str = None,
+    ) -> None:
+        version = dict(
+            batch=batch,
+            added=added,
+            removed=removed or [],
+            wal_ids=wal_ids or [],
+            schema=schema,
+        )
+        with self._lock:
+            path = self._dir / f"{self._version + 1:020d}.json"
+            tmp_path = self._dir / f".{path.name}.tmp"
+            tmp_path.write_text(json.dumps(version))
+            os.replace(tmp_path, path)
+            self._version += 1
+            self._apply(version)
@@ -1,10 +1,16 @@
-from dataclasses import dataclass
-from datetime import datetime
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
 from enum import Enum
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
 
 import polars as pl
 
+if TYPE_CHECKING:
+    from polar_streams.profiler import BatchProfile
+
 
 class OutputMode(Enum):
     COMPLETE = "complete"
@@ -18,17 +24,61 @@ class Config:
     output_mode: OutputMode
 
 
+@dataclass
+class BatchMetrics:
+    """
+    Measurements taken of a microbatch as it passes through a query: seconds spent
+    in each stage, the rows read into the query after the filters pushed down to
+    the source, the rows written to the sink, and the microbatches queued behind it
+    in the pipeline when it was written.
+    """
+
+    durations: dict[str, float] = field(default_factory=dict)
+    input_rows: None | int = None
+    output_rows: None | int = None
+    queued_batches: int = 0
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(name, time.perf_counter() - start)
+
+    def add_duration(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+
 @dataclass
 class Metadata:
     start_time: datetime
     source_files: list[Path]
     wal_ids: list[int]
+    metrics: BatchMetrics = field(default_factory=BatchMetrics)
+    profile: "None | BatchProfile" = None
+
+
+@dataclass
+class Watermark:
+    event_time_col: str
+    delay: timedelta
+    # Typed as the event time column, so a date for date columns
+    timestamp: None | date | datetime = None
 
 
 @dataclass
 class MicroBatch:
     pl_df: pl.LazyFrame
     metadata: Metadata
+    watermark: None | Watermark = None
+    # Index of the input of a stream-stream join the microbatch was read from
+    side: int = 0
 
     def new(self, pl_df: pl.LazyFrame) -> "MicroBatch":
-        return MicroBatch(pl_df=pl_df, metadata=self.metadata)
+        return MicroBatch(
+            pl_df=pl_df,
+            metadata=self.metadata,
+            watermark=self.watermark,
+            side=self.side,
+        )
@@ -0,0 +1,185 @@
+import os
+from dataclasses import replace
+from multiprocessing import get_context
+from queue import Empty
+from typing import TYPE_CHECKING, Any, Callable
+
+import polars as pl
+
+from polar_streams.hashing import key_hash
+from polar_streams.model import Config, MicroBatch
+from polar_streams.pipeline import StageFailed
+from polar_streams.statestore import StateChange, StateStore
+from polar_streams.transport import ArrowTransport
+from polar_streams.util import log
+
+if TYPE_CHECKING:
+    from polar_streams.dataframe import COL_TYPE
+
+PARTITION_COL = "__partition"
+# Partitions must not line up with the hash buckets of drop_duplicates, or each
+# partition would only ever use a fraction of its buckets
+PARTITION_SEED = 1
+PARENT_CHECK_INTERVAL = 1.0
+
+ApplyStages = Callable[[list, MicroBatch, StateStore, Config, bool], MicroBatch]
+
+
+def _run_partition(
+    apply: ApplyStages,
+    stages: list,
+    open_state_store: Callable[[], StateStore],
+    config: Config,
+    transport_dir: str,
+    inbox: Any,
+    outbox: Any,
+    parent_pid: int,
+) -> None:
+    state_store = open_state_store()
+    transport = ArrowTransport(transport_dir)
+    engine = config.write_options.get("engine", "auto")
+    while True:
+        try:
+            item = inbox.get(timeout=PARENT_CHECK_INTERVAL)
+        except Empty:
+            # A terminated query cannot stop its partitions, so they stop once
+            # the query process has gone
+            if os.getppid() != parent_pid:
+                return
+            continue
+        if item is None:
+            return
+
+        handle, metadata, watermark = item
+        try:
+            pl_df = transport.receive(handle)
+            microbatch = apply(
+                stages,
+                MicroBatch(pl_df=pl_df.lazy(), metadata=metadata, watermark=watermark),
+                state_store,
+                config,
+                True,
+            )
+            result = microbatch.pl_df.collect(engine=engine)  # type: ignore
+            states = {
+                table_name: (transport.send(change.pl_df)[0], change.append)
+                for table_name, change in state_store.end_batch().items()
+            }
+            outbox.put((transport.send(result)[0], states))
+        except BaseException as e:
+            outbox.put(StageFailed(e))
+
+
+class Partitions:
+    """
+    Runs a keyed stateful stage of a query in num_partitions worker processes.
+    Each microbatch is hash partitioned by the key of the stage, so every record of
+    a key is processed by the same partition, which keeps the state of its keys in
+    its own partition of the state store. The results of the partitions are
+    concatenated, and the state they changed is handed to the query's state store
+    to be committed with the microbatch, so a microbatch is committed for every
+    partition at once. Records, results and state are passed between processes
+    through an ArrowTransport, so they are never pickled.
+
+    Partitions are spawned rather than forked, as the polars thread pool does not
+    survive a fork, so scripts running partitioned queries must guard their entry
+    point with if __name__ == "__main__". The number of partitions and the hash
+    assigning keys to them are recorded in state, and must not change for an
+    existing checkpoint.
+    """
+
+    def __init__(
+        self,
+        apply: ApplyStages,
+        stage: Any,
+        key: list["COL_TYPE"],
+        num_partitions: int,
+        state_store: StateStore,
+        config: Config,
+    ):
+        self._key = key
+        self._num_partitions = num_partitions
+        self._state_store = state_store
+        self._config = config
+
+        self._transport = ArrowTransport()
+        ctx = get_context("spawn")
+        self._inboxes = [ctx.Queue() for _ in range(num_partitions)]
+        self._outboxes = [ctx.Queue() for _ in range(num_partitions)]
+        self._processes = [
+            ctx.Process(
+                target=_run_partition,
+                args=(
+                    apply,
+                    [stage],
+                    state_store.partition(i),
+                    config,
+                    self._transport.directory,
+                    inbox,
+                    outbox,
+                    os.getpid(),
+                ),
+                name=f"partition-{i}",
+                daemon=True,
+            )
+            for i, (inbox, outbox) in enumerate(zip(self._inboxes, self._outboxes))
+        ]
+        for process in self._processes:
+            process.start()
+
+    def _receive(self, i: int) -> Any:
+        while True:
+            try:
+                return self._outboxes[i].get(timeout=PARENT_CHECK_INTERVAL)
+            except Empty:
+                if not self._processes[i].is_alive():
+                    raise RuntimeError(
+                        f"Partition {i} exited with code {self._processes[i].exitcode}"
+                    )
+
+    @log()
+    def process(self, microbatch: MicroBatch) -> MicroBatch:
+        engine = self._config.write_options.get("engine", "auto")
+        pl_df = microbatch.pl_df.collect(engine=engine)  # type: ignore
+        partitions = pl_df.with_columns(
+            (key_hash(self._key, seed=PARTITION_SEED) % self._num_partitions)
+            .cast(pl.Int64)
+            .alias(PARTITION_COL)
+        ).partition_by(PARTITION_COL, as_dict=True, include_key=False)
+
+        # Every partition receives every microbatch, so partitions without records
+        # still emit their state in complete mode and evict expired state
+        empty = pl_df.clear()
+        # Profiles are not picklable, and partitions are not profiled
+        metadata = replace(microbatch.metadata, profile=None)
+        for i, inbox in enumerate(self._inboxes):
+            (handle,) = self._transport.send(partitions.get((i,), empty))
+            inbox.put((handle, metadata, microbatch.watermark))
+
+        results = [self._receive(i) for i in range(self._num_partitions)]
+        for result in results:
+            if isinstance(result, StageFailed):
+                raise result.error
+
+        states = {
+            table_name: StateChange(self._transport.receive(handle), append)
+            for _, partition_states in results
+            for table_name, (handle, append) in partition_states.items()
+        }
+        self._state_store.add_batch_states(states)
+        return microbatch.new(
+            pl.concat(
+                [self._transport.receive(handle) for handle, _ in results],
+                how="vertical_relaxed",
+            ).lazy()
+        )
+
+    @log()
+    def close(self) -> None:
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            process.join(timeout=PARENT_CHECK_INTERVAL)
+            if process.is_alive():
+                process.terminate()
+        self._transport.close()
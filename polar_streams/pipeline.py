@@ -0,0 +1,134 @@
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from queue import Queue
+from threading import Thread
+from typing import TYPE_CHECKING, Callable, Generator, Iterator
+
+from polar_streams.model import Config, MicroBatch
+from polar_streams.profiler import Profiler, collect, profiled, write_profile
+from polar_streams.statestore import StateChange, StateStore
+from polar_streams.util import log
+
+if TYPE_CHECKING:
+    from polar_streams.dataframe import QueryPlan
+
+DONE = object()
+
+
+@dataclass
+class StageFailed:
+    error: BaseException
+
+
+class Pipeline:
+    """
+    Runs a query as three stages connected by bounded queues, so reading the next
+    microbatch, processing the current one and writing the previous one overlap.
+    The source is read and the query plan applied on their own threads, while
+    microbatches are written and committed in order on the calling thread. Each
+    queue holds at most queue_depth microbatches, applying backpressure to the
+    stages before it. The stages run on the given executor if there is one, which
+    must have two workers free for them.
+
+    The result of each microbatch is collected on the transform thread, and the
+    time spent in each stage is recorded in the BatchMetrics of the microbatch,
+    which is passed to report once the microbatch has been committed. Microbatches
+    are profiled as they are read, when enabled by the profile option, see
+    Profiler.
+    """
+
+    def __init__(
+        self,
+        plan: "QueryPlan",
+        state_store: StateStore,
+        config: Config,
+        write: Callable[[MicroBatch], None],
+        queue_depth: int = 2,
+        executor: None | Executor = None,
+        report: None | Callable[[MicroBatch], None] = None,
+    ):
+        self._plan = plan
+        self._state_store = state_store
+        self._config = config
+        self._write = write
+        self._queue_depth = queue_depth
+        self._executor = executor
+        self._report = report
+        self._profiler = Profiler.from_config(config)
+
+    def _start(self, items: Iterator, outbox: Queue, name: str) -> None:
+        if self._executor:
+            self._executor.submit(self._stage, items, outbox)
+        else:
+            Thread(
+                target=self._stage, args=(items, outbox), name=name, daemon=True
+            ).start()
+
+    @staticmethod
+    def _stage(items: Iterator, outbox: Queue) -> None:
+        try:
+            for item in items:
+                outbox.put(item)
+            outbox.put(DONE)
+        except BaseException as e:
+            outbox.put(StageFailed(e))
+
+    @staticmethod
+    def _drain(inbox: Queue) -> Generator:
+        while (item := inbox.get()) is not DONE:
+            if isinstance(item, StageFailed):
+                raise item.error
+            yield item
+
+    def _read(self) -> Generator[MicroBatch, None, None]:
+        for microbatch in self._plan.source.process(self._state_store, self._config):
+            if self._profiler:
+                self._profiler.start(microbatch)
+            with (
+                microbatch.metadata.metrics.timed("read"),
+                profiled(microbatch, "read"),
+            ):
+                microbatch = self._plan.read(
+                    microbatch, self._state_store, self._config
+                )
+            yield microbatch
+
+    def _transform(
+        self, inbox: Queue
+    ) -> Generator[tuple[MicroBatch, dict[str, StateChange]], None, None]:
+        engine = self._config.write_options.get("engine", "auto")
+        for microbatch in self._drain(inbox):
+            metrics = microbatch.metadata.metrics
+            microbatch = self._plan.transform(
+                microbatch, self._state_store, self._config
+            )
+            with metrics.timed("collect"), profiled(microbatch, "collect"):
+                pl_df = collect(microbatch, "output", engine)
+            metrics.output_rows = pl_df.height
+            for name, seconds in self._state_store.take_durations().items():
+                metrics.add_duration(name, seconds)
+            # The state of this microbatch is committed with it, even if the next
+            # microbatch has been processed by the time it is written
+            yield microbatch.new(pl_df.lazy()), self._state_store.end_batch()
+
+    @log()
+    def run(self) -> None:
+        read_queue: Queue = Queue(maxsize=self._queue_depth)
+        transform_queue: Queue = Queue(maxsize=self._queue_depth)
+        self._start(self._read(), read_queue, "read")
+        self._start(self._transform(read_queue), transform_queue, "transform")
+
+        try:
+            for microbatch, states in self._drain(transform_queue):
+                metrics = microbatch.metadata.metrics
+                metrics.queued_batches = read_queue.qsize() + transform_queue.qsize()
+                with metrics.timed("write"), profiled(microbatch, "write"):
+                    self._write(microbatch)
+                with metrics.timed("commit"), profiled(microbatch, "commit"):
+                    self._state_store.commit_batch(microbatch.metadata.wal_ids, states)
+                if self._report:
+                    self._report(microbatch)
+                write_profile(microbatch)
+            self._state_store.checkpoint(wait=True)
+        finally:
+            self._plan.close()
@@ -1,5 +1,23 @@
-from polar_streams.source import SourceFactory
+from datetime import timedelta
+
+from polar_streams.context import StreamingContext
+from polar_streams.source import SourceFactory, StaticFactory
+from polar_streams.window import Window
 
 
 def read_stream() -> SourceFactory:
     return SourceFactory()
+
+
+def read_static() -> StaticFactory:
+    return StaticFactory()
+
+
+def streaming_context(max_workers: None | int = None) -> StreamingContext:
+    return StreamingContext(max_workers)
+
+
+def window(
+    time_col: str, size: str | timedelta, slide: None | str | timedelta = None
+) -> Window:
+    return Window(time_col, size, slide)
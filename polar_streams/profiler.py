@@ -0,0 +1,199 @@
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from pathlib import Path
+from threading import Lock
+from typing import Iterator
+
+import polars as pl
+
+from polar_streams.model import Config, MicroBatch
+
+PROFILE_DIR = "profile"
+PROFILE_KINDS = ("cpu", "memory", "plan")
+# Entries of the text reports, which are ranked by cumulative time or size
+REPORT_ENTRIES = 50
+
+
+class BatchProfile:
+    """
+    Profile of a single microbatch, written to its own directory once the
+    microbatch has been committed:
+
+    - cpu: a cProfile of each stage of the query the microbatch passed through,
+      i.e. read, each stateful operator, collect, write and commit, as <stage>.prof
+      for pstats or snakeviz along with a summary in <stage>.txt
+    - memory: the Python allocations made since the previous profiled microbatch,
+      and the peak in between, in memory.txt
+    - plan: the unoptimised and optimised plans of each LazyFrame collected, and
+      the time spent collecting them, in plans.txt, with timings of each node of
+      the plan in <stage>_timings.csv where polars can profile queries
+    """
+
+    def __init__(self, profiler: "Profiler", directory: Path):
+        self._profiler = profiler
+        self._directory = directory
+        self._cpu: dict[str, cProfile.Profile] = dict()
+        self._plans: list[str] = []
+        self._timings: dict[str, pl.DataFrame] = dict()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if "cpu" not in self._profiler.kinds:
+            yield
+            return
+        # Stages run on different threads, and cProfile only profiles its own
+        profile = self._cpu.setdefault(name, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 only one profiler can be active across threads, so
+            # stages overlapping a profiled stage are not profiled
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def collect(self, name: str, pl_df: pl.LazyFrame, engine: str) -> pl.DataFrame:
+        if "plan" not in self._profiler.kinds:
+            return pl_df.collect(engine=engine)  # type: ignore
+        plan = [
+            f"{name} plan:\n{pl_df.explain(optimized=False)}",
+            f"{name} optimised plan:\n{pl_df.explain()}",
+        ]
+        start = time.perf_counter()
+        result = None
+        if hasattr(pl_df, "profile"):
+            try:
+                result, self._timings[name] = pl_df.profile(engine=engine)  # type: ignore
+            except pl.exceptions.ComputeError:
+                # Plans reading in-memory data have no nodes to time
+                pass
+        if result is None:
+            result = pl_df.collect(engine=engine)  # type: ignore
+        plan.append(f"{name} collected in {time.perf_counter() - start:.6f}s")
+        self._plans.append("\n".join(plan))
+        return result
+
+    def write(self) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        for name, profile in self._cpu.items():
+            profile.dump_stats(self._directory / f"{name}.prof")
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(
+                REPORT_ENTRIES
+            )
+            (self._directory / f"{name}.txt").write_text(report.getvalue())
+        if self._plans:
+            (self._directory / "plans.txt").write_text("\n\n".join(self._plans) + "\n")
+        for name, timings in self._timings.items():
+            timings.write_csv(self._directory / f"{name}_timings.csv")
+        if "memory" in self._profiler.kinds:
+            (self._directory / "memory.txt").write_text(self._profiler.memory_report())
+
+
+class Profiler:
+    """
+    Profiles every interval-th microbatch of a query, enabled by the profile option
+    of a sink, a comma separated selection of the kinds of profile, or "true" for
+    all of them, see BatchProfile. The profileInterval option sets the interval,
+    and profiles are written to the profile directory of the checkpoint location.
+
+    Memory is traced from the first profiled microbatch onwards, which slows down
+    every microbatch after it. Only memory allocated by Python is traced, so data
+    allocated by polars does not show up, and neither do the stages of partitions,
+    which run in their own processes. Microbatches overlap in the pipeline, so
+    profiles may include work on the microbatches either side of them.
+    """
+
+    def __init__(self, directory: Path, kinds: list[str], interval: int):
+        self.kinds = kinds
+        self._directory = directory
+        self._interval = interval
+        self._batches = 0
+        self._lock = Lock()
+        self._snapshot: None | tracemalloc.Snapshot = None
+
+    @staticmethod
+    def from_config(config: Config) -> "None | Profiler":
+        option = config.write_options.get("profile", "false") if config else "false"
+        if option == "false":
+            return None
+        kinds = list(PROFILE_KINDS) if option == "true" else option.split(",")
+        for kind in kinds:
+            if kind not in PROFILE_KINDS:
+                raise ValueError(f"{kind} is not supported")
+        return Profiler(
+            Path(config.write_options["checkpointLocation"]) / PROFILE_DIR,
+            kinds,
+            int(config.write_options.get("profileInterval", 10)),
+        )
+
+    def start(self, microbatch: MicroBatch) -> None:
+        """
+        Profile the microbatch if it is due, before it enters the query.
+        """
+        with self._lock:
+            batch = self._batches
+            self._batches += 1
+        if batch % self._interval:
+            return
+        if "memory" in self.kinds and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        microbatch.metadata.profile = BatchProfile(
+            self, self._directory / f"batch-{batch:010d}"
+        )
+
+    def memory_report(self) -> str:
+        with self._lock:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+            previous, self._snapshot = self._snapshot, snapshot
+
+        if previous is None:
+            title = "Top allocations"
+            stats = [str(stat) for stat in snapshot.statistics("lineno")]
+        else:
+            title = "Top allocations since the previous profile"
+            stats = [str(stat) for stat in snapshot.compare_to(previous, "lineno")]
+        return "\n".join(
+            [
+                f"Traced memory: {current} bytes, peak {peak} bytes",
+                "",
+                f"{title}:",
+                *stats[:REPORT_ENTRIES],
+                "",
+            ]
+        )
+
+
+def profiled(microbatch: MicroBatch, stage: str) -> AbstractContextManager[None]:
+    """
+    Profile a stage of the query for the microbatch, if it is being profiled.
+    """
+    if microbatch.metadata is None or microbatch.metadata.profile is None:
+        return nullcontext()
+    return microbatch.metadata.profile.stage(stage)
+
+
+def collect(microbatch: MicroBatch, stage: str, engine: str) -> pl.DataFrame:
+    """
+    Collect the microbatch, recording its plan if it is being profiled.
+    """
+    if microbatch.metadata is None or microbatch.metadata.profile is None:
+        return microbatch.pl_df.collect(engine=engine)  # type: ignore
+    return microbatch.metadata.profile.collect(stage, microbatch.pl_df, engine)
+
+
+def write_profile(microbatch: MicroBatch) -> None:
+    """
+    Write the profile of a committed microbatch, if it was profiled.
+    """
+    if microbatch.metadata is not None and microbatch.metadata.profile is not None:
+        microbatch.metadata.profile.write()
@@ -0,0 +1,97 @@
+import json
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from queue import Empty, Full
+from typing import Any
+
+from polar_streams.model import Config, MicroBatch
+from polar_streams.statestore import StateStore
+
+# Reports kept by a QueryManager, and queued for it by the query
+RECENT_PROGRESS = 100
+# Seconds to wait for the oldest report to be dropped from a full queue
+DROP_TIMEOUT = 0.1
+
+
+@dataclass
+class QueryProgress:
+    """
+    Progress of a query once it has committed a microbatch. duration is the time
+    from the microbatch being triggered by the source until it was committed, and
+    durations the time spent in each stage, see BatchMetrics. rows_per_second is
+    the throughput of the microbatch, of its input rows or, where those are not
+    known, its output rows. state_rows counts the rows of each state table written
+    since the query started, and source_backlog the files waiting to be read.
+    """
+
+    batch_id: int
+    start_time: datetime
+    duration: float
+    source_files: int
+    input_rows: None | int
+    output_rows: None | int
+    rows_per_second: None | float
+    durations: dict[str, float]
+    state_rows: dict[str, int]
+    source_backlog: int
+    queued_batches: int
+
+    def to_json(self) -> str:
+        progress = asdict(self)
+        progress["start_time"] = self.start_time.isoformat()
+        return json.dumps(progress)
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a query after each microbatch it commits, to its
+    QueryManager through queue, and as JSON lines appended to the file given by
+    the metricsFile option. Once the queue is full of unread reports, the oldest
+    report is dropped for every new one, so a query is never held up by nobody
+    reading its progress, and the last report queued is always the latest.
+    """
+
+    def __init__(
+        self, config: Config, state_store: StateStore, source: Any, queue: Any
+    ):
+        self._metrics_file = config.write_options.get("metricsFile")
+        self._state_store = state_store
+        self._source = source
+        self._queue = queue
+        self._batch_id = 0
+
+    def report(self, microbatch: MicroBatch) -> None:
+        metadata = microbatch.metadata
+        metrics = metadata.metrics
+        duration = (datetime.now() - metadata.start_time).total_seconds()
+        rows = metrics.output_rows if metrics.input_rows is None else metrics.input_rows
+        backlog = getattr(self._source, "backlog", None)
+        progress = QueryProgress(
+            batch_id=self._batch_id,
+            start_time=metadata.start_time,
+            duration=duration,
+            source_files=len(metadata.source_files),
+            input_rows=metrics.input_rows,
+            output_rows=metrics.output_rows,
+            rows_per_second=rows / duration if rows is not None and duration else None,
+            durations=dict(metrics.durations),
+            state_rows=self._state_store.state_rows(),
+            source_backlog=backlog() if backlog else 0,
+            queued_batches=metrics.queued_batches,
+        )
+        self._batch_id += 1
+
+        if self._metrics_file:
+            with open(self._metrics_file, "a") as f:
+                f.write(progress.to_json() + "\n")
+        while True:
+            try:
+                self._queue.put_nowait(progress)
+                return
+            except Full:
+                pass
+            try:
+                self._queue.get(timeout=DROP_TIMEOUT)
+            except Empty:
+                # The QueryManager read the queue in the meantime
+                pass
@@ -1,30 +1,113 @@
+import json
+import logging
+import os
+import shutil
+import time
 from abc import ABC, abstractmethod
-from multiprocessing import Process
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Process, Queue
 from pathlib import Path
-from uuid import uuid1
+from queue import Empty
+from uuid import uuid1, uuid4
 
+import polars as pl
+
+from polar_streams.manifest import SinkManifest, encode_schema
 from polar_streams.model import Config, MicroBatch, OutputMode
+from polar_streams.pipeline import Pipeline
+from polar_streams.profiler import collect, profiled, write_profile
+from polar_streams.progress import RECENT_PROGRESS, ProgressReporter, QueryProgress
 from polar_streams.statestore import StateStore
 from polar_streams.util import log
 
+logger = logging.getLogger(__name__)
+
+STAGING_DIR = "_staging"
+BATCH_FILE = "_batch.json"
+HIVE_DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+DEFAULT_TARGET_FILE_SIZE = 128 * 1024 * 1024
+
 
 class Sink(ABC):
     def __init__(self, config: Config, df) -> None:
         self._config = config
         self._df = df
+
+        # State is checkpointed together with the WAL commit of every batch unless
+        # an interval is configured, so a restart never sees state ahead of the WAL
+        checkpoint_seconds = float(
+            self._config.write_options.get("checkpointIntervalSeconds", 0)
+        )
+        checkpoint_batches = int(
+            self._config.write_options.get(
+                "checkpointInterval", 0 if checkpoint_seconds else 1
+            )
+        )
+        if checkpoint_batches <= 0 and checkpoint_seconds <= 0:
+            raise ValueError(
+                "Expected a positive checkpointInterval or checkpointIntervalSeconds"
+            )
         self._state_store: StateStore = StateStore(
-            self._config.write_options["checkpointLocation"]
+            self._config.write_options["checkpointLocation"],
+            backend=self._config.write_options.get("stateBackend", "sqlite"),
+            checkpoint_batches=checkpoint_batches,
+            checkpoint_seconds=checkpoint_seconds,
+            synchronous=self._config.write_options.get("synchronous"),
         )
+        # Created before the query process starts, so both ends share it
+        self.progress: Queue = Queue(maxsize=RECENT_PROGRESS)
 
     @log()
     def save(self) -> "QueryManager":
-        def pull_loop() -> None:
-            for microbatch in self._df.process(self._state_store, self._config):
-                self.write(microbatch)
+        # Queries over a source loaded through a StreamingContext run in its process
+        context = getattr(self._df.query_plan().source, "context", None)
+        if context:
+            return context.add_query(self)
 
-        p = Process(target=pull_loop)
+        p = Process(target=self.run)
         p.start()
-        return QueryManager(p)
+        return QueryManager(p, self.progress)
+
+    @property
+    def queue_depth(self) -> int:
+        return int(self._config.write_options.get("queueDepth", 2))
+
+    def run(self, executor: None | Executor = None) -> None:
+        # Unread progress must not keep the query process from exiting
+        self.progress.cancel_join_thread()
+        reporter = ProgressReporter(
+            self._config, self._state_store, self._df.query_plan().source, self.progress
+        )
+        if self.queue_depth > 0:
+            Pipeline(
+                self._df.query_plan(),
+                self._state_store,
+                self._config,
+                self.write,
+                self.queue_depth,
+                executor,
+                reporter.report,
+            ).run()
+            return
+
+        engine = self._config.write_options.get("engine", "auto")
+        for microbatch in self._df.process(self._state_store, self._config):
+            metrics = microbatch.metadata.metrics
+            with metrics.timed("collect"), profiled(microbatch, "collect"):
+                pl_df = collect(microbatch, "output", engine)
+            metrics.output_rows = pl_df.height
+            for name, seconds in self._state_store.take_durations().items():
+                metrics.add_duration(name, seconds)
+            microbatch = microbatch.new(pl_df.lazy())
+            with metrics.timed("write"), profiled(microbatch, "write"):
+                self.write(microbatch)
+            with metrics.timed("commit"), profiled(microbatch, "commit"):
+                self._state_store.commit_batch(microbatch.metadata.wal_ids)
+            reporter.report(microbatch)
+            write_profile(microbatch)
+        self._state_store.checkpoint(wait=True)
 
     @abstractmethod
     def write(self, microbatch: MicroBatch):
@@ -34,32 +117,227 @@ class Sink(ABC):
 class ConsoleSink(Sink):
     @log()
     def write(self, microbatch: MicroBatch):
-        print(microbatch.pl_df.lazy().collect())
-        for wal_id in microbatch.metadata.wal_ids:
-            self._state_store.wal_commit(wal_id)
+        engine = self._config.write_options.get("engine", "auto")
+        print(microbatch.pl_df.lazy().collect(engine=engine))  # type: ignore
 
 
 class FileSink(Sink):
+    """
+    Writes each microbatch to a staging directory and publishes it once the
+    microbatch has been committed, by moving its files into place and recording
+    them in the sink's manifest. On restart, staged microbatches which were
+    committed are published and the rest are discarded, as their source files are
+    read again, so every microbatch is published exactly once.
+
+    Files hold at most maxRowsPerFile rows and about targetFileSize bytes, and are
+    written to Hive style partition directories by the partitionBy columns. With
+    compaction enabled, the small files of a partition directory are merged into
+    files of targetFileSize in the background once compactionMinFiles of them
+    accumulate. Compactions are staged and published like microbatches.
+    """
+
     def __init__(self, config: Config, df, fmt: str, path: Path):
         super().__init__(config, df)
         self._path = path
         self._path.mkdir(parents=True, exist_ok=True)
         self._format = fmt
+        options = self._config.write_options
+        self._partition_by = [
+            col for col in options.get("partitionBy", "").split(",") if col
+        ]
+        self._max_rows = int(options.get("maxRowsPerFile", 0))
+        self._target_size = int(options.get("targetFileSize", 0))
+        self._compaction = options.get("compaction", "false") == "true"
+        self._compaction_min_files = int(options.get("compactionMinFiles", 8))
+        self._staging = self._path / STAGING_DIR
+        self._manifest = SinkManifest(self._path)
+        self._compactor: None | ThreadPoolExecutor = None
+        self._compaction_future: None | Future = None
+        self._recover()
 
-    @log()
-    def write(self, microbatch: MicroBatch):
-        # TODO: Consider using a monotonic counter if ordering of files is important
-        path = self._path / f"{uuid1()}.{self._format}"
+    def _recover(self) -> None:
+        if not self._staging.is_dir():
+            return
+        for batch_dir in sorted(self._staging.iterdir()):
+            batch_file = batch_dir / BATCH_FILE
+            if batch_file.exists():
+                batch = json.loads(batch_file.read_text())
+                if self._state_store.wal_committed(batch["wal_ids"]):
+                    self._publish(batch_dir)
+                    continue
+            logger.info(f"Discarding uncommitted microbatch {batch_dir.name}")
+            shutil.rmtree(batch_dir)
+
+    def _chunks(self, pl_df: pl.DataFrame) -> list[pl.DataFrame]:
+        limits = []
+        if self._max_rows:
+            limits.append(self._max_rows)
+        if self._target_size and pl_df.estimated_size():
+            limits.append(
+                int(pl_df.height * self._target_size // pl_df.estimated_size())
+            )
+        if not limits:
+            return [pl_df]
+        rows = max(1, min(limits))
+        return [pl_df.slice(offset, rows) for offset in range(0, pl_df.height, rows)]
+
+    def _write_file(self, pl_df: pl.DataFrame, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
         match self._format:
             case "csv":
-                microbatch.pl_df.sink_csv(path)
+                pl_df.write_csv(path)
             case "parquet":
-                microbatch.pl_df.sink_parquet(path)
+                pl_df.write_parquet(path)
             case "json":
-                microbatch.pl_df.sink_ndjson(path)
+                pl_df.write_ndjson(path)
             case _:
                 raise ValueError(f"{self._format} is not supported")
 
+    def _stage(
+        self,
+        pl_df: pl.DataFrame,
+        wal_ids: list[int],
+        partition_dir: None | str = None,
+        removed: None | list[str] = None,
+    ) -> Path:
+        """
+        Write a batch of files to a new staging directory, recording the batch
+        last, so only completely staged batches are ever published.
+        """
+        # Batches are named in staging order, so they are published in that order
+        batch_dir = self._staging / f"{time.time_ns():020d}-{uuid4().hex}"
+        if partition_dir is not None:
+            parts = {partition_dir: pl_df}
+        elif self._partition_by:
+            parts = {
+                "/".join(
+                    f"{col}={HIVE_DEFAULT_PARTITION if value is None else value}"
+                    for col, value in zip(self._partition_by, key)
+                ): part
+                for key, part in pl_df.partition_by(
+                    self._partition_by, as_dict=True, include_key=False
+                ).items()
+            }
+        else:
+            parts = {"": pl_df}
+
+        files = []
+        for subdir, part in parts.items():
+            for chunk in self._chunks(part):
+                file = os.path.join(subdir, f"{uuid1()}.{self._format}")
+                self._write_file(chunk, batch_dir / file)
+                files.append(file)
+
+        # Every part has the same columns, less those partitioned by
+        schema = next(iter(parts.values())).schema if parts else None
+        batch = dict(
+            files=files,
+            removed=removed or [],
+            wal_ids=wal_ids,
+            schema=encode_schema(schema) if schema is not None else None,
+        )
+        batch_dir.mkdir(parents=True, exist_ok=True)
+        (batch_dir / f".{BATCH_FILE}.tmp").write_text(json.dumps(batch))
+        os.replace(batch_dir / f".{BATCH_FILE}.tmp", batch_dir / BATCH_FILE)
+        return batch_dir
+
+    @log()
+    def _publish(self, batch_dir: Path) -> None:
+        batch = json.loads((batch_dir / BATCH_FILE).read_text())
+        if not self._manifest.contains(batch_dir.name):
+            # Files may already have been moved before a restart
+            for file in batch["files"]:
+                if (batch_dir / file).exists():
+                    (self._path / file).parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(batch_dir / file, self._path / file)
+            self._manifest.commit(
+                batch_dir.name,
+                batch["files"],
+                batch["removed"],
+                batch["wal_ids"],
+                batch.get("schema"),
+            )
+        for file in batch["removed"]:
+            (self._path / file).unlink(missing_ok=True)
+        shutil.rmtree(batch_dir)
+
+        if self._compaction and not batch["removed"]:
+            self._schedule_compaction()
+
+    def _schedule_compaction(self) -> None:
+        if self._compaction_future and not self._compaction_future.done():
+            return
+        if not self._compactor:
+            self._compactor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="compaction"
+            )
+        self._compaction_future = self._compactor.submit(self._compact)
+
+    def _read_file(self, file: str) -> pl.DataFrame:
+        path = (self._path / file).as_posix()
+        # Files are read with the schema they were written with, when recorded,
+        # as CSV and JSON would otherwise have their types inferred again
+        schema = self._manifest.schema(file)
+        match self._format:
+            case "parquet":
+                return pl.read_parquet(path)
+            case "csv" if schema is not None:
+                # Null columns cannot be read from CSV, so they are read as strings
+                read_schema = {
+                    name: pl.String if dtype == pl.Null else dtype
+                    for name, dtype in schema.items()
+                }
+                return pl.read_csv(path, schema=read_schema).cast(schema)
+            case "csv":
+                return pl.read_csv(path)
+            case _:
+                return pl.read_ndjson(path, schema=schema)
+
+    def _read_files(self, files: list[str]) -> pl.DataFrame:
+        return pl.concat(
+            [self._read_file(file) for file in files], how="diagonal_relaxed"
+        )
+
+    @log()
+    def _compact(self) -> None:
+        target_size = self._target_size or DEFAULT_TARGET_FILE_SIZE
+        small_files: dict[str, list[str]] = dict()
+        for file in self._manifest.files():
+            path = self._path / file
+            if path.exists() and path.stat().st_size < target_size:
+                small_files.setdefault(os.path.dirname(file), []).append(file)
+
+        for partition_dir, files in small_files.items():
+            if len(files) < self._compaction_min_files:
+                continue
+            logger.info(f"Compacting {len(files)} files in {partition_dir or '.'}")
+            batch_dir = self._stage(
+                self._read_files(files), [], partition_dir, removed=files
+            )
+            self._publish(batch_dir)
+
+    def wait_for_compaction(self) -> None:
+        """
+        Wait for the running compaction, if any, raising any error it failed with.
+        """
+        if self._compaction_future:
+            self._compaction_future.result()
+
+    def run(self, executor: None | Executor = None) -> None:
+        try:
+            super().run(executor)
+        finally:
+            if self._compactor:
+                self._compactor.shutdown(wait=True)
+
+    @log()
+    def write(self, microbatch: MicroBatch):
+        pl_df = microbatch.pl_df.collect()
+        if pl_df.is_empty():
+            return
+        batch_dir = self._stage(pl_df, microbatch.metadata.wal_ids)
+        self._state_store.after_commit(partial(self._publish, batch_dir))
+
 
 class SinkFactory:
     def __init__(self, df):
@@ -107,10 +385,46 @@ class SinkFactory:
 
 
 class QueryManager:
-    def __init__(self, query_process: Process):
+    """
+    Reports the progress of a query and stops it. Queries of a StreamingContext
+    share its process, so their managers only report progress, and the context is
+    stopped through the manager returned by its start.
+    """
+
+    def __init__(self, query_process: None | Process, progress: "None | Queue" = None):
         self._query_process = query_process
+        self._progress = progress
+        self._recent_progress: deque[QueryProgress] = deque(maxlen=RECENT_PROGRESS)
+
+    def _receive_progress(self) -> None:
+        while self._progress is not None:
+            try:
+                self._recent_progress.append(self._progress.get_nowait())
+            except Empty:
+                return
+
+    @property
+    def last_progress(self) -> None | QueryProgress:
+        """
+        Progress of the last microbatch committed by the query, if any.
+        """
+        self._receive_progress()
+        return self._recent_progress[-1] if self._recent_progress else None
+
+    @property
+    def recent_progress(self) -> list[QueryProgress]:
+        """
+        Progress of the most recent microbatches committed by the query, oldest
+        first.
+        """
+        self._receive_progress()
+        return list(self._recent_progress)
 
     @log()
     def stop(self) -> None:
+        if self._query_process is None:
+            raise ValueError(
+                "Expected the StreamingContext to be stopped rather than its queries"
+            )
         self._query_process.terminate()
         self._query_process.join()
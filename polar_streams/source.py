@@ -1,21 +1,40 @@
 import logging
+import os
+import time
 from abc import ABC, abstractmethod
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 from multiprocessing import Queue
 from pathlib import Path
-from typing import Generator
+from queue import Empty
+from threading import Event, Thread
+from typing import TYPE_CHECKING, Callable, Generator
 
 import polars as pl
-from watchdog.events import EVENT_TYPE_CREATED, FileSystemEvent, FileSystemEventHandler
+from watchdog.events import FileCreatedEvent, FileSystemEvent, FileSystemEventHandler
 from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver
 
 from polar_streams.dataframe import DataFrame
+from polar_streams.discovery import (
+    DEFAULT_STABILITY_INTERVAL,
+    TEMP_FILE_SUFFIXES,
+    FileCompletionTracker,
+    FileLister,
+)
 from polar_streams.model import Config, Metadata, MicroBatch, OutputMode
-from polar_streams.statestore import StateStore
-from polar_streams.util import log
+from polar_streams.statestore import SourceLog, StateStore
+from polar_streams.util import log, parse_duration
+
+if TYPE_CHECKING:
+    from polar_streams.context import StreamingContext
 
 logger = logging.getLogger(__name__)
 
+COMPLETION_CHECK_INTERVAL = timedelta(milliseconds=100)
+# Bytes of source files read into each microbatch of the initial backfill
+DEFAULT_BACKFILL_BYTES = 128 * 1024 * 1024
+
 
 class Source(ABC):
     def __init__(self, options: dict[str, str]):
@@ -31,23 +50,81 @@ class Source(ABC):
 
 
 class FileSource(Source):
-    def __init__(self, options: dict[str, str], fmt: str):
+    """
+    Streams the files written to a directory. Every file is read with the same
+    schema, so microbatches never drift apart and files are scanned without
+    inferring their schema. The schema is the one given to read_stream, or else
+    inferred from the first file the query reads and pinned in its checkpoint, so
+    it is kept across restarts. Files which do not match the schema fail the query.
+    """
+
+    def __init__(
+        self, options: dict[str, str], fmt: str, schema: None | pl.Schema = None
+    ):
         super().__init__(options)
         self._path: None | Path = None
+        self._lister: None | FileLister = None
+        self._events: None | Queue = None
+        self._pending: deque[str] = deque()
         self._options = options
         self._format = fmt
-        match fmt:
+        self._schema = schema
+        # Schema the files are read with, once pinned
+        self._read_schema = schema
+
+    def _scan(self, paths: list[str], schema: None | pl.Schema) -> pl.LazyFrame:
+        match self._format:
             case "csv":
-                self._read_func = pl.scan_csv  # type: ignore
+                return pl.scan_csv(paths, schema=schema)
             case "parquet":
-                self._read_func = pl.scan_parquet  # type: ignore
+                return pl.scan_parquet(paths, schema=schema)
             case "ndjson":
-                self._read_func = pl.scan_ndjson  # type: ignore
+                return pl.scan_ndjson(paths, schema=schema)
             case "json":
-                self._read_func = pl.read_json  # type: ignore
+                if schema is None:
+                    return pl.concat([pl.read_json(path) for path in paths]).lazy()
+                # JSON documents cannot be scanned, but with a known schema reading
+                # them can still be deferred until the microbatch is collected
+                return pl.defer(
+                    lambda: pl.concat(
+                        [pl.read_json(path, schema=schema) for path in paths]
+                    ),
+                    schema=schema,
+                )
+            case _:
+                raise ValueError(f"{self._format} is not supported")
 
     def _read_path(self, path: str) -> pl.LazyFrame:
-        return self._read_func(path).lazy()
+        return self._read_paths([path])
+
+    def _read_paths(self, paths: list[str]) -> pl.LazyFrame:
+        return self._scan(paths, self._read_schema)
+
+    def _pin_schema(self, state_store: SourceLog, path: str) -> None:
+        """
+        Infer the schema of the source from a file, unless it has one already, and
+        pin it in the checkpoint.
+        """
+        if self._read_schema is not None:
+            return
+        assert self._path is not None
+        self._read_schema = self._scan([path], None).collect_schema()
+        logger.info(f"Pinning the schema of {self._path}: {self._read_schema}")
+        state_store.write_source_schema(
+            self._path.resolve().as_posix(), self._read_schema
+        )
+
+    def backlog(self) -> int:
+        """
+        Number of files discovered while streaming which wait to be read into a
+        microbatch, counting files with several events more than once.
+        """
+        try:
+            queued = self._events.qsize() if self._events else 0
+        except NotImplementedError:
+            # Queue sizes are not available on macOS
+            queued = 0
+        return queued + len(self._pending)
 
     @log()
     def load(self, path: None | str) -> DataFrame:
@@ -59,81 +136,354 @@ class FileSource(Source):
         return df
 
     class FileEventHandler(FileSystemEventHandler):
-        def __init__(self, q: Queue):
+        def __init__(
+            self,
+            q: Queue,
+            tracker: FileCompletionTracker,
+            matches: Callable[[str], bool] = lambda _: True,
+        ):
             self._q = q
+            self._tracker = tracker
+            self._matches = matches
 
         def on_any_event(self, event: FileSystemEvent) -> None:
-            if event.event_type == EVENT_TYPE_CREATED:
-                self._q.put(event)
+            if event.is_directory:
+                return
+            match event.event_type:
+                case "created" | "modified" if self._matches(str(event.src_path)):
+                    self._tracker.add(str(event.src_path))
+                    return
+                case "closed" if self._matches(str(event.src_path)):
+                    self._tracker.add(str(event.src_path), closed=True)
+                case "moved" if self._matches(str(event.dest_path)):
+                    self._tracker.add(str(event.dest_path), closed=True)
+                case _:
+                    return
+            # Closed and moved files are usually complete, so don't wait for the
+            # completion thread to pick them up
+            for path in self._tracker.complete():
+                self._q.put(FileCreatedEvent(path))
+
+    def _file_lister(self) -> FileLister:
+        assert self._path is not None
+        partition_filter = self._options.get("partitionFilter", "")
+        return FileLister(
+            self._path,
+            recursive=self._options.get("recursiveFileLookup", "true") == "true",
+            glob=self._options.get("pathGlobFilter", "*"),
+            partition_filter=dict(
+                partition.split("=", 1)
+                for partition in partition_filter.split(",")
+                if partition
+            ),
+            temp_suffixes=self._temp_suffixes(),
+            success_marker=self._options.get("successMarker"),
+        )
+
+    def _temp_suffixes(self) -> tuple[str, ...]:
+        if "tempFileSuffixes" not in self._options:
+            return TEMP_FILE_SUFFIXES
+        return tuple(
+            suffix for suffix in self._options["tempFileSuffixes"].split(",") if suffix
+        )
+
+    def _stability_interval(self) -> None | timedelta:
+        if "fileStabilityInterval" not in self._options:
+            return None
+        return parse_duration(self._options["fileStabilityInterval"])
+
+    def _discover(
+        self,
+        lister: FileLister,
+        tracker: FileCompletionTracker,
+        q: Queue,
+        stop: Event,
+        poll: bool,
+    ) -> None:
+        """
+        Pass files on to the trigger queue once they are complete. When polling,
+        new files are discovered by diffing directory listings every pollInterval,
+        for filesystems where inotify events are unavailable or get dropped.
+        """
+        if poll:
+            interval = parse_duration(self._options.get("pollInterval", "1s"))
+        else:
+            interval = COMPLETION_CHECK_INTERVAL
+        while not stop.wait(interval.total_seconds()):
+            if poll:
+                for path in lister.refresh():
+                    tracker.add(path.as_posix())
+            for path in tracker.complete():
+                q.put(FileCreatedEvent(path))
+
+    def _trigger_limits(self) -> tuple[int, int]:
+        return (
+            int(self._options.get("maxFilesPerTrigger", 0)),
+            int(self._options.get("maxBytesPerTrigger", 0)),
+        )
+
+    def _backfill_batches(
+        self, source_files: list[Path], streaming: bool
+    ) -> Generator[list[Path], None, None]:
+        """
+        Split the files already in the source directory into batches bounded by
+        maxFilesPerTrigger and maxBytesPerTrigger, so a large backlog is streamed
+        through the query instead of being read as a single microbatch. Batches are
+        also bounded by maxBytesPerBackfill, or 0 to read the backfill in a single
+        microbatch when there are no trigger limits. It defaults to 128MiB when
+        streaming, and to 0 in complete output mode, where each microbatch is
+        written out as a full snapshot of the result.
+        """
+        max_files, max_bytes = self._trigger_limits()
+        default_bytes = DEFAULT_BACKFILL_BYTES if streaming else 0
+        backfill_bytes = int(self._options.get("maxBytesPerBackfill", default_bytes))
+        if backfill_bytes and (not max_bytes or backfill_bytes < max_bytes):
+            max_bytes = backfill_bytes
+        batch: list[Path] = []
+        size = 0
+        for path in source_files:
+            file_size = os.path.getsize(path) if max_bytes and path.exists() else 0
+            if batch and (
+                (max_files and len(batch) >= max_files)
+                or (max_bytes and size + file_size > max_bytes)
+            ):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(path)
+            size += file_size
+        if batch:
+            yield batch
+
+    def _next_trigger(self, q: Queue, pending: deque[str]) -> list[str]:
+        """
+        Block until at least one new file is available, then coalesce the queued
+        files into a single trigger. The trigger is bounded by maxFilesPerTrigger
+        and maxBytesPerTrigger, and waits up to triggerInterval from its first
+        file for more files to arrive. Files which do not fit are kept in pending
+        for the next trigger.
+        """
+        max_files, max_bytes = self._trigger_limits()
+        interval = parse_duration(self._options.get("triggerInterval", "0s"))
+
+        paths: list[str] = []
+        size = 0
+        deadline = 0.0
+        while not max_files or len(paths) < max_files:
+            if pending:
+                path = pending.popleft()
+            else:
+                try:
+                    if not paths:
+                        event = q.get()
+                    elif (remaining := deadline - time.monotonic()) > 0:
+                        event = q.get(timeout=remaining)
+                    else:
+                        event = q.get_nowait()
+                except Empty:
+                    break
+                path = event.src_path
+
+            if max_bytes:
+                file_size = os.path.getsize(path) if os.path.exists(path) else 0
+                if paths and size + file_size > max_bytes:
+                    pending.appendleft(path)
+                    break
+                size += file_size
+
+            if not paths:
+                deadline = time.monotonic() + interval.total_seconds()
+            paths.append(path)
+        return paths
+
+    def _unprocessed_files(
+        self, state_store: SourceLog, listed_files: list[Path]
+    ) -> list[Path]:
+        """
+        Select the listed files which have not been committed by a previous run of
+        the query. Files are matched against the processed file index by path, size
+        and modification time, so files which were read but not committed before a
+        restart, or which have since changed, are replayed.
+        """
+        assert self._lister is not None
+        processed = state_store.processed_source_files()
+        uncommitted = state_store.wal_uncommitted_entries()
+        if uncommitted:
+            logger.info(f"Replaying {len(uncommitted)} uncommitted source files")
+
+        return [
+            path
+            for path in listed_files
+            if processed.get(path.as_posix()) != self._lister.file_info(path.as_posix())
+        ]
+
+    @staticmethod
+    def _wal_append(
+        state_store: SourceLog, paths: list[Path]
+    ) -> tuple[list[Path], list[int]]:
+        """
+        Append files to the WAL and the source file index in one transaction,
+        returning the files appended and their WAL ids. Files deleted since they
+        were discovered are dropped.
+        """
+        appended = []
+        stats = []
+        for path in paths:
+            try:
+                stats.append(path.stat())
+            except FileNotFoundError:
+                logger.warning(f"Skipping {path}, which no longer exists")
+                continue
+            appended.append(path)
+        if not appended:
+            return [], []
+        return appended, state_store.wal_append_many(
+            [path.as_posix() for path in appended],
+            [(stat.st_size, stat.st_mtime) for stat in stats],
+        )
+
+    def _start_observer(
+        self, q: Queue, tracker: FileCompletionTracker
+    ) -> None | BaseObserver:
+        assert self._path is not None and self._lister is not None
+        match self._options.get("discoveryMode", "events"):
+            case "events":
+                observer = Observer()
+                observer.schedule(
+                    self.FileEventHandler(q, tracker, self._lister.matches),
+                    self._path.as_posix(),
+                    recursive=self._options.get("recursiveFileLookup", "true")
+                    == "true",
+                )
+                observer.start()
+                return observer
+            case "polling":
+                return None
+            case mode:
+                raise ValueError(f"{mode} is not supported")
 
     @log()
     def process(
-        self, state_store: StateStore, config: Config
+        self, state_store: SourceLog, config: Config
     ) -> Generator[MicroBatch, None, None]:
         if not self._path:
             raise ValueError("path cannot be of type None")
 
-        # batch process all files and then listen for new ones
-        run_initial_batch = self._options.get("run_initial_batch", "true") == "true"
-        source_files = [p for p in self._path.iterdir() if not p.is_dir()]
-        wal_ids = (state_store.wal_append(p.as_posix()) for p in source_files)
-        source_batches = (self._read_path(p.as_posix()) for p in source_files)
-        if run_initial_batch:
-            yield MicroBatch(
-                pl_df=pl.concat(pl.collect_all(list(source_batches))).lazy(),
-                metadata=Metadata(
-                    source_files=source_files,
-                    wal_ids=list(wal_ids),
-                    start_time=datetime.now(),
-                ),
-            )
-        else:
-            for pl_df, source_file, wal_id in zip(
-                source_batches, source_files, wal_ids
-            ):
-                yield MicroBatch(
-                    pl_df=pl_df,
-                    metadata=Metadata(
-                        source_files=[source_file],
-                        wal_ids=[wal_id],
-                        start_time=datetime.now(),
-                    ),
-                )
+        self._read_schema = self._schema or state_store.source_schema(
+            self._path.resolve().as_posix()
+        )
 
-        # For complete output mode don't create source thread
-        if config.output_mode == OutputMode.COMPLETE:
-            return
+        # For complete output mode don't listen for new files
+        streaming = config.output_mode != OutputMode.COMPLETE
+        run_initial_batch = self._options.get("run_initial_batch", "true") == "true"
+        stability_interval = self._stability_interval()
+        tracker = FileCompletionTracker(
+            stability_interval, self._options.get("successMarker")
+        )
+        self._lister = self._file_lister()
 
-        # search for new files and pass them along using watchdog.
+        # Watch for new files before listing the existing ones, so files arriving
+        # in between are not missed. The tracker drops events for listed files.
         q: Queue = Queue()
-        event_handler = self.FileEventHandler(q)
-        observer = Observer()
-        observer.schedule(event_handler, self._path.as_posix(), recursive=True)
-        observer.start()
+        self._events = q
+        self._pending = deque()
+        stop = Event()
+        observer = self._start_observer(q, tracker) if streaming else None
+        listed_files = self._lister.list()
+        source_files = self._unprocessed_files(state_store, listed_files)
+        recent: set[Path] = set()
+        if streaming:
+            # Files modified within the stability interval may still be written to,
+            # so they are left to the completion tracker instead of the backfill.
+            # Without discovery a batch query reads them as they are.
+            interval = stability_interval or DEFAULT_STABILITY_INTERVAL
+            cutoff = time.time() - interval.total_seconds()
+            recent = {path for path in source_files if path.stat().st_mtime > cutoff}
+            for path in recent:
+                tracker.add(path.as_posix())
+            source_files = [path for path in source_files if path not in recent]
+        for path in listed_files:
+            if path not in recent:
+                tracker.add_completed(
+                    path.as_posix(), self._lister.file_info(path.as_posix())
+                )
+
+        # Files are passed along by the discovery thread once they are completely
+        # written, and found by polling the directory listing when not using events
+        discovery = Thread(
+            target=self._discover,
+            args=(self._lister, tracker, q, stop, observer is None),
+            daemon=True,
+        )
+        if streaming:
+            discovery.start()
 
         try:
+            if run_initial_batch:
+                # Batches are only read once the query pulls them, and are kept lazy
+                # so downstream projections and filters reach the file scans
+                for batch_files in self._backfill_batches(source_files, streaming):
+                    batch_files, wal_ids = self._wal_append(state_store, batch_files)
+                    if not batch_files:
+                        continue
+                    self._pin_schema(state_store, batch_files[0].as_posix())
+                    yield MicroBatch(
+                        pl_df=self._read_paths([p.as_posix() for p in batch_files]),
+                        metadata=Metadata(
+                            source_files=batch_files,
+                            wal_ids=wal_ids,
+                            start_time=datetime.now(),
+                        ),
+                    )
+            else:
+                source_files, wal_ids = self._wal_append(state_store, source_files)
+                for source_file, wal_id in zip(source_files, wal_ids):
+                    self._pin_schema(state_store, source_file.as_posix())
+                    yield MicroBatch(
+                        pl_df=self._read_path(source_file.as_posix()),
+                        metadata=Metadata(
+                            source_files=[source_file],
+                            wal_ids=[wal_id],
+                            start_time=datetime.now(),
+                        ),
+                    )
+
+            if not streaming:
+                return
+
+            pending = self._pending
             while True:
-                event = q.get()
-                wal_id = state_store.wal_append(event.src_path)
-                pl_df = self._read_path(event.src_path)
-                # TODO: schema check
+                paths = self._next_trigger(q, pending)
+                trigger_files, trigger_wal_ids = self._wal_append(
+                    state_store, [Path(path) for path in paths]
+                )
+                if not trigger_files:
+                    continue
+                self._pin_schema(state_store, trigger_files[0].as_posix())
+                pl_df = self._read_paths([path.as_posix() for path in trigger_files])
                 yield MicroBatch(
                     pl_df=pl_df,
                     metadata=Metadata(
-                        source_files=[event.src_path],
-                        wal_ids=[wal_id],
+                        source_files=trigger_files,
+                        wal_ids=trigger_wal_ids,
                         start_time=datetime.now(),
                     ),
                 )
         finally:
-            observer.stop()
-            observer.join()
+            stop.set()
+            if observer:
+                observer.stop()
+                observer.join()
+            if discovery.is_alive():
+                discovery.join()
 
 
 class SourceFactory:
-    def __init__(self) -> None:
+    def __init__(self, context: "None | StreamingContext" = None) -> None:
         self._options: dict[str, str] = dict()
         self._format: str = ""
+        self._schema: None | pl.Schema = None
+        self._context = context
 
     @log()
     def option(self, key: str, value: str) -> "SourceFactory":
@@ -145,10 +495,88 @@ class SourceFactory:
         self._format = fmt
         return self
 
+    @log()
+    def schema(self, schema: pl.Schema | dict[str, pl.DataType]) -> "SourceFactory":
+        """
+        Read the files with schema rather than the one inferred from the first file.
+        """
+        self._schema = pl.Schema(schema)
+        return self
+
     @log()
     def load(self, path: None | str = None) -> DataFrame:
         match self._format:
             case "csv" | "parquet" | "json" | "ndjson":
-                return FileSource(self._options, self._format).load(path)
+                df = FileSource(self._options, self._format, self._schema).load(path)
+                if self._context:
+                    return DataFrame(self._context.shared_source(df._source))
+                return df
+            case _:
+                raise ValueError(f"{self._format} is not supported")
+
+
+class StaticTable:
+    """
+    Files read as a whole rather than as a stream, e.g. reference data joined to a
+    stream. The table is read on first use and kept in memory, and its files are
+    listed and stat'ed on every use, so it is read again once files are added,
+    changed or removed.
+    """
+
+    def __init__(self, source: FileSource):
+        self._source = source
+        self._lister = source._file_lister()
+        self._files: dict[str, tuple[int, float]] = dict()
+        self._pl_df: None | pl.DataFrame = None
+
+    @log()
+    def get(self) -> pl.DataFrame:
+        files = dict()
+        for path in self._lister.list():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files[path.as_posix()] = (stat.st_size, stat.st_mtime)
+        if not files:
+            raise ValueError(f"Expected files in {self._source._path}")
+
+        if self._pl_df is None or files != self._files:
+            self._pl_df = self._source._read_paths(list(files)).collect()
+            self._files = files
+        return self._pl_df
+
+
+class StaticFactory:
+    def __init__(self) -> None:
+        self._options: dict[str, str] = dict()
+        self._format: str = ""
+        self._schema: None | pl.Schema = None
+
+    @log()
+    def option(self, key: str, value: str) -> "StaticFactory":
+        self._options[key] = value
+        return self
+
+    @log()
+    def format(self, fmt: str) -> "StaticFactory":
+        self._format = fmt
+        return self
+
+    @log()
+    def schema(self, schema: pl.Schema | dict[str, pl.DataType]) -> "StaticFactory":
+        """
+        Read the files with schema rather than the one inferred from the first file.
+        """
+        self._schema = pl.Schema(schema)
+        return self
+
+    @log()
+    def load(self, path: None | str = None) -> StaticTable:
+        match self._format:
+            case "csv" | "parquet" | "json" | "ndjson":
+                source = FileSource(self._options, self._format, self._schema)
+                source.load(path)
+                return StaticTable(source)
             case _:
                 raise ValueError(f"{self._format} is not supported")
@@ -1,19 +1,503 @@
+import copy
+import io
+import os
 import sqlite3
-from contextlib import closing
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
+from threading import RLock
+from typing import Callable, Iterator, Protocol
 
+import adbc_driver_sqlite.dbapi as adbc_sqlite
 import polars as pl
 
+from polar_streams.model import BatchMetrics
 from polar_streams.util import log
 
+SQLITE_SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+# How long ADBC connections wait for the locks of other processes, like sqlite3
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# Tables of the state database which hold no state
+INTERNAL_TABLES = (
+    "write_ahead_log",
+    "wal_commits",
+    "source_files",
+    "source_schemas",
+    "state_schemas",
+    "state_versions",
+)
+
+
+class SourceLog(Protocol):
+    """
+    The part of the state store used by sources to record which source files have
+    been read and committed.
+    """
+
+    def processed_source_files(self) -> dict[str, tuple[int, float]]: ...
+
+    def wal_uncommitted_entries(self) -> list[str]: ...
+
+    def wal_append_many(
+        self, keys: list[str], source_files: None | list[tuple[int, float]] = None
+    ) -> list[int]: ...
+
+    def source_schema(self, source: str) -> None | pl.Schema: ...
+
+    def write_source_schema(self, source: str, schema: pl.Schema) -> None: ...
+
+
+@dataclass
+class StateChange:
+    """
+    Change made to a state table by a microbatch, either the whole table or, with
+    append, the rows appended to it.
+    """
+
+    pl_df: pl.DataFrame
+    append: bool = False
+
+    def then(self, change: "StateChange") -> "StateChange":
+        """
+        The change made by this change followed by the given one.
+        """
+        if not change.append:
+            return change
+        return StateChange(
+            pl.concat([self.pl_df, change.pl_df], how="vertical_relaxed"), self.append
+        )
+
+
+class StateBackend(ABC):
+    """
+    Stores state tables as numbered versions, each either a full version or a delta
+    appended to the versions before it. Every write builds on the given base, the
+    version the table was at when last committed, and leaves the versions up to it
+    intact, so the committed version can still be read until a newer one has been
+    committed in its place. Versions after base were written by a checkpoint which
+    never committed, and are discarded by the next write.
+
+    Deltas are compacted into a new full version once compact_after of them
+    accumulate, and retained_versions full versions are kept, as lazy readers may
+    still hold the older ones.
+    """
+
+    def __init__(self, retained_versions: int = 2, compact_after: int = 8):
+        # The committed version is kept until the version replacing it is committed
+        self._retained_versions = max(retained_versions, 2)
+        self._compact_after = compact_after
+
+    @abstractmethod
+    def _versions(self, table_name: str) -> list[tuple[int, bool]]:
+        """
+        Every version of the table as (version, delta), in version order.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _write_version(
+        self, pl_df: pl.DataFrame, table_name: str, version: int, delta: bool
+    ) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _read_versions(
+        self, table_name: str, versions: list[tuple[int, bool]]
+    ) -> pl.LazyFrame:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _drop_version(self, table_name: str, version: int, delta: bool) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def legacy_versions(self) -> dict[str, int]:
+        """
+        Adopt the tables of a checkpoint written before versions were committed,
+        returning the version of each table to treat as committed.
+        """
+        raise NotImplementedError
+
+    def legacy_version(self, table_name: str) -> None | int:
+        """
+        Adopt a single table written before versions were committed, if there is
+        one, returning the version to treat as committed.
+        """
+        return None
+
+    def _live_versions(self, table_name: str, version: int) -> list[tuple[int, bool]]:
+        # The latest full version plus every delta appended after it
+        versions = [v for v in self._versions(table_name) if v[0] <= version]
+        full_versions = [i for i, (_, delta) in enumerate(versions) if not delta]
+        return versions[full_versions[-1] :] if full_versions else versions
+
+    def _next_version(self, table_name: str, base: None | int) -> int:
+        for version, delta in self._versions(table_name):
+            if base is None or version > base:
+                self._drop_version(table_name, version, delta)
+        return 0 if base is None else base + 1
+
+    @log()
+    def write_state(
+        self, pl_df: pl.LazyFrame, table_name: str, base: None | int
+    ) -> int:
+        """
+        Write a full version of the table on top of base, returning its version.
+        """
+        versions = self._versions(table_name)
+        version = self._next_version(table_name, base)
+        self._write_version(pl_df.collect(), table_name, version, delta=False)
+
+        full_versions = [v for v in versions if not v[1] and v[0] < version]
+        kept = self._retained_versions - 1
+        if len(full_versions) > kept:
+            cutoff = full_versions[len(full_versions) - kept]
+            for old_version in versions:
+                if old_version[0] >= cutoff[0]:
+                    break
+                self._drop_version(table_name, *old_version)
+        return version
+
+    @log()
+    def append_state(
+        self, pl_df: pl.LazyFrame, table_name: str, base: None | int
+    ) -> int:
+        """
+        Append a delta version to the table on top of base, returning the version
+        the table is at afterwards.
+        """
+        version = self._next_version(table_name, base)
+        self._write_version(pl_df.collect(), table_name, version, delta=True)
+        if len(self._live_versions(table_name, version)) > self._compact_after:
+            return self.write_state(
+                self.get_state(table_name, version), table_name, version
+            )
+        return version
+
+    @log()
+    def get_state(self, table_name: str, version: int) -> pl.LazyFrame:
+        return self._read_versions(table_name, self._live_versions(table_name, version))
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Stores each version of a state table as a SQLite table. SQLite has no temporal
+    types, so the polars schema of every table is stored alongside it and restored
+    on read.
+
+    The ADBC driver links its own copy of SQLite, and two copies release each
+    other's file locks, so all access to the database must hold the given lock.
+    """
+
+    def __init__(self, con: sqlite3.Connection, path: Path, lock: RLock):
+        super().__init__()
+        self._con = con
+        self._path = path
+        self._lock = lock
+        with closing(self._con.cursor()) as cur:
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS state_schemas (
+                table_name VARCHAR PRIMARY KEY,
+                schema BLOB
+            );
+            """)
+
+    @contextmanager
+    def _adbc(self) -> Iterator[adbc_sqlite.Connection]:
+        # Partition workers read state while checkpoints are written from another
+        # process, so wait for their locks rather than failing at once
+        with closing(adbc_sqlite.connect(self._path.as_posix())) as con:
+            with con.cursor() as cur:
+                cur.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+            yield con
+
+    @staticmethod
+    def _version_table(table_name: str, version: int, delta: bool) -> str:
+        return f"{table_name}__{version:020d}{'_delta' if delta else ''}"
+
+    def _versions(self, table_name: str) -> list[tuple[int, bool]]:
+        prefix = f"{table_name}__"
+        with self._lock, closing(self._con.cursor()) as cur:
+            res = cur.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' "
+                "AND substr(name, 1, ?) = ?",
+                (len(prefix), prefix),
+            )
+            names = [name[len(prefix) :] for (name,) in res.fetchall()]
+        versions = []
+        for name in names:
+            version, _, suffix = name.partition("_")
+            if version.isdigit() and len(version) == 20 and suffix in ("", "delta"):
+                versions.append((int(version), suffix == "delta"))
+        return sorted(versions)
+
+    def _write_version(
+        self, pl_df: pl.DataFrame, table_name: str, version: int, delta: bool
+    ) -> None:
+        name = self._version_table(table_name, version, delta)
+        with self._lock, self._adbc() as adbc_con:
+            pl_df.write_database(
+                table_name=name,
+                connection=adbc_con,
+                engine="adbc",
+                if_table_exists="replace",
+            )
+            # May be called from the checkpoint thread, so use a dedicated connection
+            with closing(sqlite3.connect(self._path, isolation_level=None)) as con:
+                con.execute(
+                    "INSERT OR REPLACE INTO state_schemas (table_name, schema) "
+                    "VALUES (?, ?)",
+                    (name, pl_df.clear().serialize()),
+                )
+
+    def _restore_schema(self, pl_df: pl.DataFrame, table_name: str) -> pl.DataFrame:
+        with closing(self._con.cursor()) as cur:
+            row = cur.execute(
+                "SELECT schema FROM state_schemas WHERE table_name = ?", (table_name,)
+            ).fetchone()
+        if not row:
+            return pl_df
+
+        cols = []
+        for name, dtype in pl.DataFrame.deserialize(io.BytesIO(row[0])).schema.items():
+            col = pl.col(name)
+            if pl_df.schema[name] == dtype:
+                cols.append(col)
+            elif pl_df.schema[name] == pl.String and dtype == pl.Date:
+                cols.append(col.str.to_date())
+            elif pl_df.schema[name] == pl.String and isinstance(dtype, pl.Datetime):
+                cols.append(
+                    col.str.to_datetime(
+                        time_unit=dtype.time_unit, time_zone=dtype.time_zone
+                    )
+                )
+            else:
+                cols.append(col.cast(dtype))
+        return pl_df.select(cols)
+
+    def _read_versions(
+        self, table_name: str, versions: list[tuple[int, bool]]
+    ) -> pl.LazyFrame:
+        pl_dfs = []
+        with self._lock:
+            for version, delta in versions:
+                name = self._version_table(table_name, version, delta)
+                # Closed before the schema is read, which would otherwise wait on
+                # a checkpoint waiting for this read to end
+                with self._adbc() as adbc_con:
+                    pl_df = pl.read_database(
+                        query=f"SELECT * FROM {name}", connection=adbc_con
+                    )
+                pl_dfs.append(self._restore_schema(pl_df, name))
+        return pl.concat(pl_dfs, how="vertical_relaxed").lazy()
+
+    def _drop_version(self, table_name: str, version: int, delta: bool) -> None:
+        name = self._version_table(table_name, version, delta)
+        with (
+            self._lock,
+            closing(sqlite3.connect(self._path, isolation_level=None)) as con,
+        ):
+            con.execute(f"DROP TABLE IF EXISTS {name}")
+            con.execute("DELETE FROM state_schemas WHERE table_name = ?", (name,))
+
+    @staticmethod
+    def _is_legacy_table(name: str) -> bool:
+        # Versioned tables carry a version suffix, which tables written before
+        # versions were committed lack
+        _, _, version = name.rpartition("__")
+        versioned = version.removesuffix("_delta")
+        return not (
+            name in INTERNAL_TABLES
+            or name.startswith("sqlite_")
+            or (versioned.isdigit() and len(versioned) == 20)
+        )
+
+    def legacy_version(self, table_name: str) -> None | int:
+        if not self._is_legacy_table(table_name):
+            return None
+        with self._lock, closing(self._con.cursor()) as cur:
+            exists = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?",
+                (table_name,),
+            ).fetchone()
+            if not exists:
+                return None
+            name = self._version_table(table_name, 0, delta=False)
+            cur.execute(f"ALTER TABLE {table_name} RENAME TO {name}")
+            cur.execute(
+                "UPDATE state_schemas SET table_name = ? WHERE table_name = ?",
+                (name, table_name),
+            )
+        return 0
+
+    def legacy_versions(self) -> dict[str, int]:
+        with self._lock, closing(self._con.cursor()) as cur:
+            res = cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            names = [name for (name,) in res.fetchall()]
+        return {
+            name: version
+            for name in names
+            if (version := self.legacy_version(name)) is not None
+        }
+
+
+class FileStateBackend(StateBackend):
+    """
+    Stores each state table as a directory of versioned Arrow IPC or Parquet files.
+    A new version is written to a temporary file and atomically renamed into place,
+    so readers only ever see complete versions. IPC files are written uncompressed
+    so they can be memory mapped on read.
+    """
+
+    def __init__(
+        self,
+        state_dir: Path,
+        fmt: str,
+        retained_versions: int = 2,
+        compact_after: int = 8,
+    ):
+        super().__init__(retained_versions, compact_after)
+        self._state_dir = state_dir
+        self._format = fmt
+        match fmt:
+            case "ipc":
+                self._suffix = "arrow"
+            case "parquet":
+                self._suffix = "parquet"
+            case _:
+                raise ValueError(f"{fmt} is not supported")
+
+    def _version_path(self, table_name: str, version: int, delta: bool) -> Path:
+        suffix = f"delta.{self._suffix}" if delta else self._suffix
+        return self._state_dir / table_name / f"{version:020d}.{suffix}"
+
+    def _versions(self, table_name: str) -> list[tuple[int, bool]]:
+        table_dir = self._state_dir / table_name
+        if not table_dir.is_dir():
+            return []
+        return sorted(
+            (int(path.name.split(".")[0]), path.name.split(".")[1] == "delta")
+            for path in table_dir.glob(f"*.{self._suffix}")
+        )
+
+    def _write_version(
+        self, pl_df: pl.DataFrame, table_name: str, version: int, delta: bool
+    ) -> None:
+        path = self._version_path(table_name, version, delta)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.parent / f".{path.name}.tmp"
+
+        match self._format:
+            case "ipc":
+                pl_df.write_ipc(tmp_path, compression="uncompressed")
+            case "parquet":
+                pl_df.write_parquet(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _read_versions(
+        self, table_name: str, versions: list[tuple[int, bool]]
+    ) -> pl.LazyFrame:
+        paths = [self._version_path(table_name, *version) for version in versions]
+        match self._format:
+            case "ipc":
+                return pl.scan_ipc(paths)
+            case _:
+                return pl.scan_parquet(paths)
+
+    def _drop_version(self, table_name: str, version: int, delta: bool) -> None:
+        self._version_path(table_name, version, delta).unlink(missing_ok=True)
+
+    def legacy_versions(self) -> dict[str, int]:
+        if not self._state_dir.is_dir():
+            return dict()
+        return {
+            table_dir.name: versions[-1][0]
+            for table_dir in self._state_dir.iterdir()
+            if (versions := self._versions(table_dir.name))
+        }
+
 
 class StateStore:
-    def __init__(self, state_dir):
+    """
+    Keeps the latest state of each operator resident in memory and persists it to
+    the configured backend. By default state is written through on every
+    write_state call. When checkpoint_batches or checkpoint_seconds is set, state
+    is instead checkpointed by a background thread once either threshold is
+    reached, and WAL commits are deferred until the checkpoint covering them has
+    been written. Tables only appended to since the last checkpoint are
+    checkpointed as deltas, while tables written in full are rewritten. WAL entries
+    are written in batched transactions, with synchronous controlling how often the
+    SQLite database is fsynced. The database is journaled in WAL mode unless it also
+    holds the state tables, and synchronous defaults to NORMAL when it is, or to
+    FULL otherwise.
+
+    The backend writes a new version of a state table on every write, and the
+    version to read is only moved to it by a commit, in the same SQLite transaction
+    as the WAL entries it covers. When a checkpoint fails to commit, e.g. as the
+    process crashed, the state is read at its last committed version on restart, and
+    the uncommitted WAL entries are replayed on top of the state they were not yet
+    applied to. Written through, state is committed as soon as it is written, ahead
+    of the WAL entries of its microbatch.
+
+    State table names are prefixed with table_prefix, which keeps the state of key
+    partitions apart within the same state directory.
+    """
+
+    def __init__(
+        self,
+        state_dir,
+        backend: str = "sqlite",
+        checkpoint_batches: None | int = None,
+        checkpoint_seconds: None | float = None,
+        synchronous: None | str = None,
+        table_prefix: str = "",
+    ):
         self._state_dir = Path(state_dir)
         self._state_dir.mkdir(exist_ok=True, parents=True)
         self._path = self._state_dir / "state.db"
         self._uri = f"sqlite:///{state_dir}/state.db"
-        self._con = sqlite3.connect(self._path, isolation_level=None)
+        if synchronous is None:
+            # A rollback journal is only durable, and safe from corruption on power
+            # loss, when every commit is fsynced
+            synchronous = "FULL" if backend == "sqlite" else "NORMAL"
+        if synchronous.upper() not in SQLITE_SYNCHRONOUS_MODES:
+            raise ValueError(f"{synchronous} is not supported")
+        self._synchronous = synchronous.upper()
+        self._backend_name = backend
+        self._table_prefix = table_prefix
+        self._lock = RLock()
+        self._con = self._connect()
+        self._backend: StateBackend
+        match backend:
+            case "sqlite":
+                # The ADBC driver links its own copy of SQLite, and two copies cannot
+                # share the shared-memory index of a WAL journaled database
+                self._backend = SQLiteStateBackend(self._con, self._path, self._lock)
+            case "ipc" | "parquet":
+                self._con.execute("PRAGMA journal_mode=WAL")
+                self._backend = FileStateBackend(self._state_dir / "state", backend)
+            case _:
+                raise ValueError(f"{backend} is not supported")
+        self._cache: dict[str, pl.DataFrame] = dict()
+        self._changes: dict[str, StateChange] = dict()
+        self._write_behind = bool(checkpoint_batches or checkpoint_seconds)
+        self._checkpoint_batches = checkpoint_batches
+        self._checkpoint_seconds = checkpoint_seconds
+        self._pending_batches = 0
+        self._pending_wal_ids: list[int] = []
+        self._pending_states: dict[str, StateChange] = dict()
+        self._batch_states: dict[str, StateChange] = dict()
+        self._batch_callbacks: list[Callable[[], None]] = []
+        self._pending_callbacks: list[Callable[[], None]] = []
+        self._metrics = BatchMetrics()
+        self._state_rows: dict[str, int] = dict()
+        self._last_checkpoint = time.monotonic()
+        self._executor: None | ThreadPoolExecutor = None
+        self._checkpoint_future: None | Future = None
         with closing(self._con.cursor()) as cur:
             cur.execute("""
             CREATE TABLE IF NOT EXISTS write_ahead_log (
@@ -27,49 +511,464 @@ class StateStore:
                 wal_id INTEGER
             );
             """)
+            cur.execute("""
+            CREATE INDEX IF NOT EXISTS wal_commits_wal_id ON wal_commits (wal_id);
+            """)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS source_files (
+                path VARCHAR PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                wal_id INTEGER
+            );
+            """)
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS source_schemas (
+                source VARCHAR PRIMARY KEY,
+                schema BLOB
+            );
+            """)
+            versioned = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='state_versions'"
+            ).fetchone()
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS state_versions (
+                table_name VARCHAR PRIMARY KEY,
+                version INTEGER
+            );
+            """)
+        if not versioned:
+            # Checkpoints written before state versions were committed hold the
+            # state of their last microbatch
+            with self._lock:
+                self._commit(self._con, [], self._backend.legacy_versions())
+
+    def _connect(self) -> sqlite3.Connection:
+        # Queries may read, transform and commit microbatches on separate threads,
+        # so the store's connection is shared and serialised by self._lock
+        con = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+        con.execute(f"PRAGMA synchronous={self._synchronous}")
+        return con
+
+    def _version(self, table_name: str) -> None | int:
+        """
+        Committed version of the state table, if it has been committed.
+        """
+        with self._lock:
+            with closing(self._con.cursor()) as cur:
+                row = cur.execute(
+                    "SELECT version FROM state_versions WHERE table_name = ?",
+                    (table_name,),
+                ).fetchone()
+            if row:
+                return row[0]
+            # Tables written before versions were committed may appear after the
+            # checkpoint was opened, e.g. by an older process sharing it
+            version = self._backend.legacy_version(table_name)
+            if version is not None:
+                self._commit(self._con, [], {table_name: version})
+            return version
+
+    def _write_change(self, table_name: str, change: StateChange) -> int:
+        """
+        Write a change to the backend on top of the committed version of the table,
+        returning the version written.
+        """
+        if change.append:
+            return self._backend.append_state(
+                change.pl_df.lazy(), table_name, self._version(table_name)
+            )
+        return self._backend.write_state(
+            change.pl_df.lazy(), table_name, self._version(table_name)
+        )
+
+    def _write_through(self, table_name: str, change: StateChange) -> None:
+        version = self._write_change(table_name, change)
+        with self._lock:
+            self._commit(self._con, [], {table_name: version})
 
     @log()
     def write_state(self, pl_df: pl.LazyFrame, table_name: str) -> None:
-        pl_df.collect().write_database(
-            table_name=table_name,
-            connection=self._uri,
-            engine="adbc",
-            if_table_exists="replace",
-        )
+        table_name = self._table_prefix + table_name
+        with self._metrics.timed("state_write"):
+            state = pl_df.collect()
+            self._cache[table_name] = state
+            self._state_rows[table_name] = state.height
+            if self._write_behind:
+                self._changes[table_name] = StateChange(state)
+            else:
+                self._write_through(table_name, StateChange(state))
 
     @log()
-    def state_exists(self, table_name: str) -> bool:
-        with closing(self._con.cursor()) as cur:
-            res = cur.execute(
-                f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}';"
+    def append_state(self, pl_df: pl.LazyFrame, table_name: str) -> None:
+        delta = pl_df.collect()
+        change = StateChange(delta, append=True)
+        if self._write_behind:
+            # The whole table is cached, but only the delta is checkpointed
+            state = delta
+            if self.state_exists(table_name):
+                state = pl.concat(
+                    [self.get_state(table_name).collect(), delta],
+                    how="vertical_relaxed",
+                )
+            table_name = self._table_prefix + table_name
+            self._cache[table_name] = state
+            self._state_rows[table_name] = state.height
+            if table_name in self._changes:
+                change = self._changes[table_name].then(change)
+            self._changes[table_name] = change
+            return
+
+        table_name = self._table_prefix + table_name
+        with self._metrics.timed("state_write"):
+            self._write_through(table_name, change)
+        if table_name in self._state_rows:
+            self._state_rows[table_name] += delta.height
+        if table_name in self._cache:
+            self._cache[table_name] = pl.concat(
+                [self._cache[table_name], delta], how="vertical_relaxed"
             )
-            return bool(res.fetchone())
+
+    @log()
+    def state_exists(self, table_name: str) -> bool:
+        table_name = self._table_prefix + table_name
+        return table_name in self._cache or self._version(table_name) is not None
 
     @log()
     def get_state(self, table_name: str) -> pl.LazyFrame:
-        return pl.read_database_uri(
-            query=f"SELECT * FROM {table_name}", uri=self._uri, engine="adbc"
-        ).lazy()
+        table_name = self._table_prefix + table_name
+        if table_name in self._cache:
+            return self._cache[table_name].lazy()
+        version = self._version(table_name)
+        if version is None:
+            raise ValueError(f"Expected state for {table_name}")
+        with self._metrics.timed("state_read"):
+            return self._backend.get_state(table_name, version)
+
+    @log()
+    def end_batch(self) -> dict[str, StateChange]:
+        """
+        Take the changes made to state since the previous call, which belong to the
+        microbatch that was just processed. Passing them to commit_batch lets the
+        next microbatch be processed before this one is committed.
+        """
+        states = dict(self._changes)
+        states.update(self._batch_states)
+        # Cleared in place, as namespaces of the store share these
+        self._changes.clear()
+        self._batch_states.clear()
+        return states
+
+    @log()
+    def add_batch_states(self, states: dict[str, StateChange]) -> None:
+        """
+        Add changes made to state outside this store, such as by the stores of key
+        partitions, to the current microbatch. The state is not cached here, and is
+        persisted along with the microbatch like state written through this store.
+        """
+        for table_name, change in states.items():
+            rows = change.pl_df.height
+            if change.append:
+                rows += self._state_rows.get(table_name, 0)
+            self._state_rows[table_name] = rows
+        if not self._write_behind:
+            with self._metrics.timed("state_write"):
+                for table_name, change in states.items():
+                    self._write_through(table_name, change)
+            return
+        self._merge(self._batch_states, states)
+
+    @staticmethod
+    def _merge(changes: dict[str, StateChange], states: dict[str, StateChange]) -> None:
+        for table_name, change in states.items():
+            if table_name in changes:
+                change = changes[table_name].then(change)
+            changes[table_name] = change
+
+    def take_durations(self) -> dict[str, float]:
+        """
+        Seconds spent reading state from and writing state to the backend since the
+        previous call, in the state_read and state_write stages.
+        """
+        durations = dict(self._metrics.durations)
+        # Cleared in place, as namespaces of the store share these
+        self._metrics.durations.clear()
+        return durations
+
+    def state_rows(self) -> dict[str, int]:
+        """
+        Number of rows of each state table written since the store was opened.
+        """
+        return dict(self._state_rows)
+
+    def namespace(self, prefix: str) -> "StateStore":
+        """
+        View of this store with its state table names prefixed, keeping apart state
+        of the same operator used twice in a query, e.g. on both inputs of a join.
+        The view shares the cache of this store, so state written through it is
+        committed with the microbatches of this store.
+        """
+        view = copy.copy(self)
+        view._table_prefix = self._table_prefix + prefix
+        return view
+
+    def partition(self, index: int) -> "partial[StateStore]":
+        """
+        Opener for the state store of a key partition, which can be sent to and
+        called in another process. The partition store shares the state directory
+        but never commits, so its changed state must be taken with end_batch and
+        passed to add_batch_states of this store.
+        """
+        return partial(
+            StateStore,
+            self._state_dir,
+            backend=self._backend_name,
+            checkpoint_batches=1,
+            synchronous=self._synchronous,
+            table_prefix=f"{self._table_prefix}partition_{index:04d}_",
+        )
+
+    @log()
+    def commit_batch(
+        self, wal_ids: list[int], states: None | dict[str, StateChange] = None
+    ) -> None:
+        """
+        Mark the WAL entries of a fully written microbatch as processed. With
+        write-behind checkpointing the commit is deferred to the next checkpoint,
+        which persists the state of the microbatch given by states, or the state
+        changed since the previous microbatch if states is None.
+        """
+        callbacks = list(self._batch_callbacks)
+        self._batch_callbacks.clear()
+        if not self._write_behind:
+            self.wal_commit_many(wal_ids)
+            for callback in callbacks:
+                callback()
+            return
+
+        self._merge(
+            self._pending_states, self.end_batch() if states is None else states
+        )
+        self._pending_wal_ids.extend(wal_ids)
+        self._pending_callbacks.extend(callbacks)
+        self._pending_batches += 1
+        if (
+            self._checkpoint_batches
+            and self._pending_batches >= self._checkpoint_batches
+        ) or (
+            self._checkpoint_seconds
+            and time.monotonic() - self._last_checkpoint >= self._checkpoint_seconds
+        ):
+            self.checkpoint()
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """
+        Run callback once the microbatch being written has been committed, e.g. to
+        publish its output. Callbacks run in commit order, on the checkpoint thread
+        with write-behind checkpointing.
+        """
+        self._batch_callbacks.append(callback)
+
+    @log()
+    def checkpoint(self, wait: bool = False) -> None:
+        """
+        Persist the state of all microbatches committed since the last checkpoint
+        in the background, committing their WAL entries once the state is durable.
+        Any error from the previous checkpoint is raised here.
+        """
+        if self._checkpoint_future:
+            self._checkpoint_future.result()
+        if (
+            not self._pending_states
+            and not self._pending_wal_ids
+            and not self._pending_callbacks
+        ):
+            return
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="checkpoint"
+            )
+
+        states = self._pending_states
+        wal_ids = self._pending_wal_ids
+        callbacks = self._pending_callbacks
+        self._pending_states = dict()
+        self._pending_wal_ids = []
+        self._pending_callbacks = []
+        self._pending_batches = 0
+        self._last_checkpoint = time.monotonic()
+
+        self._checkpoint_future = self._executor.submit(
+            self._write_checkpoint, states, wal_ids, callbacks
+        )
+        if wait:
+            self._checkpoint_future.result()
+
+    def _write_checkpoint(
+        self,
+        states: dict[str, StateChange],
+        wal_ids: list[int],
+        callbacks: list[Callable[[], None]],
+    ):
+        versions = {
+            table_name: self._write_change(table_name, change)
+            for table_name, change in states.items()
+        }
+
+        # Runs on the checkpoint thread, so it cannot share the store's connection
+        with self._lock, closing(self._connect()) as con:
+            self._commit(con, wal_ids, versions)
+        for callback in callbacks:
+            callback()
 
     @log()
     def wal_append(self, key: str) -> int:
-        with closing(self._con.cursor()) as cur:
-            res = cur.execute(
-                f"INSERT INTO write_ahead_log (key) VALUES ('{key}') RETURNING id;"
+        return self.wal_append_many([key])[0]
+
+    @log()
+    def wal_append_many(
+        self, keys: list[str], source_files: None | list[tuple[int, float]] = None
+    ) -> list[int]:
+        """
+        Append keys to the WAL in a single transaction and return their WAL ids.
+        When source_files holds the size and modification time of each key, the
+        keys are also recorded in the source file index, so they can be skipped on
+        restart once their WAL entries are committed.
+        """
+        if not keys:
+            return []
+
+        with self._lock:
+            # The write lock taken by BEGIN IMMEDIATE makes the id range safe to
+            # reserve across processes
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                res = self._con.execute(
+                    "SELECT COALESCE(MAX(id), 0) FROM write_ahead_log"
+                )
+                first_id = int(res.fetchone()[0]) + 1
+                wal_ids = list(range(first_id, first_id + len(keys)))
+                self._con.executemany(
+                    "INSERT INTO write_ahead_log (id, key) VALUES (?, ?)",
+                    zip(wal_ids, keys),
+                )
+                if source_files is not None:
+                    self._con.executemany(
+                        "INSERT OR REPLACE INTO source_files "
+                        "(path, size, mtime, wal_id) VALUES (?, ?, ?, ?)",
+                        [
+                            (key, size, mtime, wal_id)
+                            for key, (size, mtime), wal_id in zip(
+                                keys, source_files, wal_ids
+                            )
+                        ],
+                    )
+            except BaseException:
+                self._con.execute("ROLLBACK")
+                raise
+            self._con.execute("COMMIT")
+            return wal_ids
+
+    @log()
+    def wal_append_file(self, path: str, size: int, mtime: float) -> int:
+        """
+        Append a source file to the WAL and record it in the source file index.
+        """
+        return self.wal_append_many([path], [(size, mtime)])[0]
+
+    @log()
+    def processed_source_files(self) -> dict[str, tuple[int, float]]:
+        """
+        Size and modification time of every indexed source file whose WAL entry
+        has been committed.
+        """
+        with self._lock, closing(self._con.cursor()) as cur:
+            res = cur.execute("""
+            SELECT path, size, mtime FROM source_files
+            WHERE EXISTS (
+                SELECT 1 FROM wal_commits WHERE wal_commits.wal_id = source_files.wal_id
+            );
+            """)
+            return {path: (size, mtime) for path, size, mtime in res.fetchall()}
+
+    @log()
+    def source_schema(self, source: str) -> None | pl.Schema:
+        """
+        Schema pinned for a source by write_source_schema, if any.
+        """
+        with self._lock, closing(self._con.cursor()) as cur:
+            row = cur.execute(
+                "SELECT schema FROM source_schemas WHERE source = ?", (source,)
+            ).fetchone()
+        if not row:
+            return None
+        return pl.DataFrame.deserialize(io.BytesIO(row[0])).schema
+
+    @log()
+    def write_source_schema(self, source: str, schema: pl.Schema) -> None:
+        with self._lock:
+            self._con.execute(
+                "INSERT OR REPLACE INTO source_schemas (source, schema) VALUES (?, ?)",
+                (source, pl.DataFrame(schema=schema).serialize()),
             )
-            return int(res.fetchone()[0])
 
     @log()
     def wal_commit(self, wal_id: int) -> None:
-        with closing(self._con.cursor()) as cur:
-            cur.execute(f"INSERT INTO wal_commits (wal_id) VALUES ({wal_id})")
+        self.wal_commit_many([wal_id])
+
+    @log()
+    def wal_commit_many(self, wal_ids: list[int]) -> None:
+        with self._lock:
+            self._commit(self._con, wal_ids, dict())
+
+    @staticmethod
+    def _commit(
+        con: sqlite3.Connection, wal_ids: list[int], versions: dict[str, int]
+    ) -> None:
+        """
+        Commit WAL entries together with the versions of the state tables holding
+        their changes, in a single transaction.
+        """
+        if not wal_ids and not versions:
+            return
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.executemany(
+                "INSERT INTO wal_commits (wal_id) VALUES (?)",
+                [(wal_id,) for wal_id in wal_ids],
+            )
+            con.executemany(
+                "INSERT OR REPLACE INTO state_versions (table_name, version) "
+                "VALUES (?, ?)",
+                versions.items(),
+            )
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+    @log()
+    def wal_committed(self, wal_ids: list[int]) -> bool:
+        """
+        Whether every one of the WAL entries has been committed.
+        """
+        wal_ids = sorted(set(wal_ids))
+        if not wal_ids:
+            return True
+        with self._lock, closing(self._con.cursor()) as cur:
+            res = cur.execute(
+                "SELECT COUNT(DISTINCT wal_id) FROM wal_commits "
+                f"WHERE wal_id IN ({', '.join('?' * len(wal_ids))})",
+                wal_ids,
+            )
+            return res.fetchone()[0] == len(wal_ids)
 
     @log()
     def wal_uncommitted_entries(self) -> list[str]:
-        with closing(self._con.cursor()) as cur:
-            res = cur.execute(f"SELECT MAX(wal_id) FROM wal_commits")
+        with self._lock, closing(self._con.cursor()) as cur:
+            res = cur.execute("SELECT COALESCE(MAX(wal_id), 0) FROM wal_commits")
             max_wal_id = res.fetchone()[0]
             missing_entries = cur.execute(
-                f"SELECT key FROM write_ahead_log WHERE id > {max_wal_id}"
+                "SELECT key FROM write_ahead_log WHERE id > ?", (max_wal_id,)
             )
             return [k[0] for k in missing_entries.fetchall()]
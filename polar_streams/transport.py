@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from uuid import uuid4
+
+import polars as pl
+import pyarrow as pa  # type: ignore
+import pyarrow.ipc  # type: ignore
+
+from polar_streams.util import log
+
+# Files under /dev/shm live in memory, elsewhere they are at least memory mapped
+SHARED_MEMORY_DIR = Path("/dev/shm") if os.path.isdir("/dev/shm") else None
+
+
+@dataclass(frozen=True)
+class FrameHandle:
+    """
+    Reference to a DataFrame sent through an ArrowTransport, which is cheap to
+    pickle and can be received once.
+    """
+
+    path: str
+
+
+class ArrowTransport:
+    """
+    Moves DataFrames between processes as Arrow IPC files in shared memory, so
+    only handles cross the process boundary. A DataFrame is written once,
+    uncompressed, and every receiver gets its own handle, a hard link to the file.
+    Receiving memory maps the file without copying it and releases the handle by
+    unlinking it, so the memory is freed once every handle has been released and
+    every DataFrame read from it dropped.
+
+    The transport creating a directory owns it and removes it on close, along with
+    handles never received, e.g. because their receiver failed. Other processes
+    send through the same directory by opening a transport on it.
+    """
+
+    def __init__(self, directory: None | str = None):
+        self._owned = directory is None
+        self.directory = directory or tempfile.mkdtemp(
+            prefix="polar_streams-", dir=SHARED_MEMORY_DIR
+        )
+
+    @log()
+    def send(self, pl_df: pl.DataFrame, receivers: int = 1) -> list[FrameHandle]:
+        name = uuid4().hex
+        paths = [
+            os.path.join(self.directory, f"{name}-{i}.arrow") for i in range(receivers)
+        ]
+        pl_df.write_ipc(paths[0], compression="uncompressed")
+        for path in paths[1:]:
+            os.link(paths[0], path)
+        return [FrameHandle(path) for path in paths]
+
+    @staticmethod
+    def receive(handle: FrameHandle) -> pl.DataFrame:
+        with pa.memory_map(handle.path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        # The mapping outlives the link, so the handle is released straight away
+        os.unlink(handle.path)
+        return pl.DataFrame(pl.from_arrow(table, rechunk=False))
+
+    @log()
+    def close(self) -> None:
+        if self._owned:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,30 +1,67 @@
 import logging
+import os
+import re
+from datetime import timedelta
 from functools import wraps
 
+DURATION_UNITS = {
+    "ns": timedelta(microseconds=1) / 1000,
+    "us": timedelta(microseconds=1),
+    "ms": timedelta(milliseconds=1),
+    "s": timedelta(seconds=1),
+    "m": timedelta(minutes=1),
+    "h": timedelta(hours=1),
+    "d": timedelta(days=1),
+    "w": timedelta(weeks=1),
+}
+DURATION_PATTERN = re.compile(r"(\d+)(ns|us|ms|s|m|h|d|w)")
+# Functions are decorated when their module is imported, so setting
+# POLAR_STREAMS_LOG_CALLS=false before importing polar_streams leaves them unwrapped
+LOG_CALLS = os.environ.get("POLAR_STREAMS_LOG_CALLS", "true") == "true"
 
-def staticlog(level=logging.DEBUG):
-    def dec(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            logging.getLogger(func.__qualname__).log(
-                level, f"{func.__name__}: args({args}), kwargs({kwargs})"
+
+def _log_calls(func, level, skip_self):
+    # Looking the logger up once keeps disabled logging to a cached level check
+    logger = logging.getLogger(func.__qualname__)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if logger.isEnabledFor(level):
+            logger.log(
+                level,
+                "%s: args(%r), kwargs(%r)",
+                func.__name__,
+                args[1:] if skip_self else args,
+                kwargs,
             )
-            return func(*args, **kwargs)
+        return func(*args, **kwargs)
 
-        return wrapper
+    return wrapper
+
+
+def staticlog(level=logging.DEBUG):
+    def dec(func):
+        return _log_calls(func, level, False) if LOG_CALLS else func
 
     return dec
 
 
 def log(level=logging.DEBUG):
     def dec(func):
-        @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            logging.getLogger(func.__qualname__).log(
-                level, f"{func.__name__}: args({args}), kwargs({kwargs})"
-            )
-            return func(self, *args, **kwargs)
-
-        return wrapper
+        return _log_calls(func, level, True) if LOG_CALLS else func
 
     return dec
+
+
+def parse_duration(duration: str | timedelta) -> timedelta:
+    """
+    Parse a fixed duration using the polars duration string language, e.g. "1h30m".
+    Calendar units (months, years) are not supported as they have no fixed length.
+    """
+    if isinstance(duration, timedelta):
+        return duration
+
+    parts = DURATION_PATTERN.findall(duration)
+    if not parts or "".join(n + unit for n, unit in parts) != duration:
+        raise ValueError(f"{duration} is not a valid duration")
+    return sum((int(n) * DURATION_UNITS[unit] for n, unit in parts), timedelta())
@@ -0,0 +1,66 @@
+import math
+from datetime import date, timedelta
+
+import polars as pl
+from polars.expr.expr import Expr
+
+from polar_streams.util import parse_duration
+
+WINDOW_INDEX_COL = "__window_index"
+
+
+class Window:
+    """
+    Event-time window used as a grouping column. Records are assigned to windows by
+    truncating their event time to the slide, in the same way as group_by_dynamic,
+    producing window start and end columns which take the place of the window in
+    the grouping key. When slide is smaller than size, windows overlap and each
+    record is assigned to every window containing it.
+    """
+
+    def __init__(
+        self,
+        time_col: str,
+        size: str | timedelta,
+        slide: None | str | timedelta = None,
+        start_col: str = "window_start",
+        end_col: str = "window_end",
+    ):
+        self.time_col = time_col
+        self.start_col = start_col
+        self.end_col = end_col
+        self._size = parse_duration(size)
+        self._slide = parse_duration(slide) if slide else self._size
+        if self._slide > self._size:
+            raise ValueError("Window slide cannot be larger than its size")
+
+    @property
+    def columns(self) -> list[str]:
+        return [self.start_col, self.end_col]
+
+    def assign(self, pl_df: pl.LazyFrame) -> pl.LazyFrame:
+        time = pl.col(self.time_col)
+        if self._slide == self._size:
+            return pl_df.with_columns(
+                time.dt.truncate(self._size).alias(self.start_col)
+            ).with_columns((pl.col(self.start_col) + self._size).alias(self.end_col))
+
+        windows_per_record = math.ceil(self._size / self._slide)
+        return (
+            pl_df.with_columns(
+                pl.int_ranges(0, windows_per_record).alias(WINDOW_INDEX_COL)
+            )
+            .explode(WINDOW_INDEX_COL)
+            .with_columns(
+                (
+                    time.dt.truncate(self._slide)
+                    - pl.col(WINDOW_INDEX_COL) * pl.lit(self._slide)
+                ).alias(self.start_col)
+            )
+            .with_columns((pl.col(self.start_col) + self._size).alias(self.end_col))
+            .filter(time < pl.col(self.end_col))
+            .drop(WINDOW_INDEX_COL)
+        )
+
+    def expired(self, timestamp: date) -> Expr:
+        return pl.col(self.end_col) <= timestamp
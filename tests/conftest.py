@@ -0,0 +1,43 @@
+# mypy: disable-error-code="no-untyped-def"
+from datetime import datetime
+
+import polars as pl
+from pytest import fixture
+
+from polar_streams.dataframe import DataFrame
+from polar_streams.model import Config, Metadata, MicroBatch
+from polar_streams.statestore import StateStore
+
+
+class MockDataFrame(DataFrame):
+    def __init__(self, microbatches: list[MicroBatch]):
+        super().__init__(None)
+        self._microbatches = microbatches
+
+    def process(self, state_store: StateStore, config: Config):
+        for i, microbatch in enumerate(self._microbatches):
+            microbatch.metadata.wal_ids = state_store.wal_append_many([f"batch-{i}"])
+            yield microbatch
+
+
+def mock_microbatch(pl_df: pl.DataFrame) -> MicroBatch:
+    return MicroBatch(
+        pl_df=pl_df.lazy(),
+        metadata=Metadata(start_time=datetime.now(), source_files=[], wal_ids=[]),
+    )
+
+
+@fixture
+def source_batches():
+    return [
+        pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 6]}),
+        pl.DataFrame({"id": [2, 3, 3], "col2": [7, 8, 9]}),
+        pl.DataFrame({"id": [1, 3, 4], "col2": [1, 2, 3]}),
+    ]
+
+
+@fixture
+def source_df(source_batches):
+    return DataFrame(
+        MockDataFrame([mock_microbatch(pl_df) for pl_df in source_batches])
+    )
@@ -0,0 +1,112 @@
+# mypy: disable-error-code="no-untyped-def"
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from polar_streams.aggregation import (
+    AggregationKind,
+    IncrementalAggregator,
+    PartialAggregate,
+    parse_partial_aggregate,
+)
+
+
+@pytest.mark.parametrize(
+    "expr,expected",
+    [
+        (pl.col("a").sum(), PartialAggregate(AggregationKind.SUM, "a", "a")),
+        (pl.sum("a").alias("b"), PartialAggregate(AggregationKind.SUM, "a", "b")),
+        (pl.col("a").count(), PartialAggregate(AggregationKind.COUNT, "a", "a")),
+        (pl.col("a").len(), PartialAggregate(AggregationKind.LEN, "a", "a")),
+        (pl.len(), PartialAggregate(AggregationKind.LEN, None, "len")),
+        (pl.col("a").min(), PartialAggregate(AggregationKind.MIN, "a", "a")),
+        (pl.col("a").max(), PartialAggregate(AggregationKind.MAX, "a", "a")),
+        (pl.col("a").mean(), PartialAggregate(AggregationKind.MEAN, "a", "a")),
+        (pl.col("a").first(), PartialAggregate(AggregationKind.FIRST, "a", "a")),
+        (pl.col("a").last(), PartialAggregate(AggregationKind.LAST, "a", "a")),
+    ],
+)
+def test_parse_partial_aggregate(expr, expected):
+    assert parse_partial_aggregate(expr) == expected
+
+
+@pytest.mark.parametrize(
+    "expr",
+    [
+        pl.col("a").n_unique(),
+        pl.col("a").median(),
+        (pl.col("a") * 2).sum(),
+        pl.col("a", "b").sum(),
+        "a",
+    ],
+)
+def test_parse_unsupported_aggregate(expr):
+    assert parse_partial_aggregate(expr) is None
+
+
+def test_from_exprs_unsupported_falls_back(caplog):
+    aggregator = IncrementalAggregator.from_exprs(["id"], [pl.col("a").n_unique()])
+
+    assert aggregator is None
+    assert "cannot be computed incrementally" in caplog.text
+
+
+def test_update_merges_partials():
+    # Given
+    aggregator = IncrementalAggregator.from_exprs(
+        ["id"],
+        [
+            pl.col("v").sum().alias("sum"),
+            pl.col("v").mean().alias("mean"),
+            pl.col("v").min().alias("min"),
+            pl.col("v").max().alias("max"),
+            pl.col("v").first().alias("first"),
+            pl.col("v").last().alias("last"),
+            pl.len(),
+        ],
+    )
+    assert aggregator
+    batch_1 = pl.DataFrame({"id": [1, 1, 2], "v": [1, 5, 3]}).lazy()
+    batch_2 = pl.DataFrame({"id": [2, 3, 1], "v": [7, 2, 0]}).lazy()
+
+    # When
+    state, _ = aggregator.update(None, batch_1)
+    state, touched = aggregator.update(state.collect().lazy(), batch_2)
+
+    # Then
+    expected = (
+        pl.concat([batch_1, batch_2])
+        .group_by("id")
+        .agg(
+            pl.col("v").sum().alias("sum"),
+            pl.col("v").mean().alias("mean"),
+            pl.col("v").min().alias("min"),
+            pl.col("v").max().alias("max"),
+            pl.col("v").first().alias("first"),
+            pl.col("v").last().alias("last"),
+            pl.len().cast(pl.Int64),
+        )
+    )
+    assert_frame_equal(
+        aggregator.finalise(state).collect(),
+        expected.collect(),
+        check_row_order=False,
+    )
+    assert sorted(touched.collect()["id"].to_list()) == [1, 2, 3]
+    assert state.collect().height == 3
+
+
+def test_update_counts_nulls_with_len():
+    # Given
+    aggregator = IncrementalAggregator.from_exprs(
+        ["id"],
+        [pl.col("v").len().alias("len"), pl.col("v").count().alias("count")],
+    )
+    assert aggregator
+    batch = pl.DataFrame({"id": [1, 1, 1], "v": [None, None, 3]}).lazy()
+
+    # When
+    state, _ = aggregator.update(None, batch)
+
+    # Then
+    assert aggregator.finalise(state).collect().row(0) == (1, 3, 1)
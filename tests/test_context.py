@@ -0,0 +1,136 @@
+# mypy: disable-error-code="no-untyped-def"
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+from pytest import fixture
+
+from polar_streams.context import SharedSourceLog, StreamingContext
+from polar_streams.source import FileSource
+from polar_streams.statestore import StateStore
+
+
+@fixture
+def source_dir():
+    with TemporaryDirectory() as source_dir:
+        pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 6]}).write_csv(
+            Path(source_dir) / "source-1.csv"
+        )
+        pl.DataFrame({"id": [2, 3], "col2": [7, 8]}).write_csv(
+            Path(source_dir) / "source-2.csv"
+        )
+        yield source_dir
+
+
+def test_shared_source_log():
+    with TemporaryDirectory() as state_dir_1, TemporaryDirectory() as state_dir_2:
+        # Given
+        store_1 = StateStore(state_dir_1)
+        store_2 = StateStore(state_dir_2)
+        store_2.wal_append("other-key")
+        source_log = SharedSourceLog([store_1, store_2])
+
+        # When
+        wal_ids = source_log.wal_append_many(["a.csv", "b.csv"], [(1, 1.0), (2, 2.0)])
+        query_wal_ids = source_log.translate(wal_ids)
+        store_1.wal_commit_many(query_wal_ids[0])
+        store_2.wal_commit_many(query_wal_ids[1][:1])
+
+        # Then
+        assert query_wal_ids == [[1, 2], [2, 3]]
+        assert source_log.processed_source_files() == {"a.csv": (1, 1.0)}
+        assert source_log.wal_uncommitted_entries() == ["b.csv"]
+
+
+def test_context_shares_sources(source_dir, monkeypatch):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        reads = []
+        read_paths = FileSource._read_paths
+        monkeypatch.setattr(
+            FileSource,
+            "_read_paths",
+            lambda self, paths: reads.append(paths) or read_paths(self, paths),
+        )
+        context = StreamingContext()
+        df_1 = context.read_stream().format("csv").load(source_dir)
+        df_2 = context.read_stream().format("csv").load(source_dir)
+        for name, df in [
+            ("sum", df_1.group_by("id").agg(pl.sum("col2"))),
+            ("count", df_2.group_by("id").agg(pl.len())),
+        ]:
+            (
+                df.write_stream()
+                .format("csv")
+                .output_mode("complete")
+                .option("checkpointLocation", f"{out_dir}/checkpoint-{name}")
+                .save(f"{out_dir}/{name}")
+            )
+
+        # When
+        context._run()
+
+        # Then
+        assert df_1._source is df_2._source
+        assert len(reads) == 1
+        assert_frame_equal(
+            pl.read_csv(f"{out_dir}/sum/*.csv"),
+            pl.DataFrame({"id": [1, 2, 3], "col2": [4, 18, 8]}),
+            check_row_order=False,
+        )
+        assert_frame_equal(
+            pl.read_csv(f"{out_dir}/count/*.csv"),
+            pl.DataFrame({"id": [1, 2, 3], "len": [1, 3, 1]}),
+            check_row_order=False,
+            check_dtypes=False,
+        )
+        for name in ["sum", "count"]:
+            state_store = StateStore(f"{out_dir}/checkpoint-{name}")
+            assert state_store.wal_uncommitted_entries() == []
+
+
+def test_context_requires_enough_workers(source_dir):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        context = StreamingContext(max_workers=2)
+        df = context.read_stream().format("csv").load(source_dir)
+        (
+            df.write_stream()
+            .format("csv")
+            .option("checkpointLocation", f"{out_dir}/checkpoint")
+            .save(f"{out_dir}/out")
+        )
+
+        # When
+        with pytest.raises(ValueError) as exc_info:
+            context._run()
+
+        # Then
+        assert str(exc_info.value) == "Expected at least 4 workers for 1 queries"
+
+
+def test_context_queries_stopped_with_context(source_dir):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        context = StreamingContext()
+        df = context.read_stream().format("csv").load(source_dir)
+        manager = (
+            df.write_stream()
+            .format("csv")
+            .option("checkpointLocation", f"{out_dir}/checkpoint")
+            .save(f"{out_dir}/out")
+        )
+
+        # When
+        with pytest.raises(ValueError) as exc_info:
+            manager.stop()
+
+        # Then
+        assert (
+            str(exc_info.value)
+            == "Expected the StreamingContext to be stopped rather than its queries"
+        )
+        assert manager.last_progress is None
+        assert not context._process.is_alive()
@@ -1,41 +1,36 @@
 import logging
+from datetime import date, datetime
 from tempfile import TemporaryDirectory
 
 import polars as pl
+import pytest
 from polars.testing import assert_frame_equal
 from pytest import fixture
 
-from polar_streams.dataframe import DataFrame
-from polar_streams.model import Config, MicroBatch, OutputMode
+from polar_streams.dataframe import (
+    AddColumns,
+    DataFrame,
+    DropDuplicates,
+    Filter,
+    GroupedDataFrame,
+    QueryPlan,
+    StreamJoin,
+)
+from polar_streams.hashing import key_hash
+from polar_streams.model import Config, MicroBatch, OutputMode, Watermark
+from polar_streams.polars import window
 from polar_streams.statestore import StateStore
+from tests.conftest import MockDataFrame, mock_microbatch
 
 logger = logging.getLogger(__name__)
 
 
-class MockDataFrame(DataFrame):
-    def __init__(self, microbatches: list[MicroBatch]):
-        super().__init__(None)
-        self._microbatches = microbatches
-
-    def process(self, state_store: StateStore, config: Config):
-        for microbatch in self._microbatches:
-            logging.info(
-                f"yielding microbatch {microbatch}, {microbatch.pl_df.collect()}"
-            )
-            yield microbatch
-
-
 @fixture
-def source_df():
-    df_1 = pl.DataFrame({"col1": [1, 2, 3], "col2": [4, 5, 6]}).lazy()
-    df_2 = pl.DataFrame({"col1": [7, 8, 9], "col2": [10, 11, 12]}).lazy()
-    source_df = MockDataFrame(
-        [
-            MicroBatch(pl_df=df_1, metadata=None),
-            MicroBatch(pl_df=df_2, metadata=None),
-        ]
-    )
-    return DataFrame(source_df)
+def source_batches():
+    return [
+        pl.DataFrame({"col1": [1, 2, 3], "col2": [4, 5, 6]}),
+        pl.DataFrame({"col1": [7, 8, 9], "col2": [10, 11, 12]}),
+    ]
 
 
 @fixture
@@ -44,17 +39,28 @@ def state_store():
         yield StateStore(state_dir)
 
 
+def _write_legacy_state(
+    state_store: StateStore, pl_df: pl.DataFrame, table_name: str
+) -> None:
+    # State tables were written as is before state was versioned
+    pl_df.write_database(
+        table_name=table_name, connection=state_store._uri, engine="adbc"
+    )
+
+
+def _group_by_partials(state_store: StateStore) -> pl.DataFrame:
+    return pl.concat(
+        state_store.get_state(f"group_by_partials_{bucket:04d}").collect()
+        for bucket in range(32)
+        if state_store.state_exists(f"group_by_partials_{bucket:04d}")
+    )
+
+
 @fixture
 def duplicate_df():
-    df_1 = pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 5]}).lazy()
-    df_2 = pl.DataFrame({"id": [2, 8, 9], "col2": [5, 11, 12]}).lazy()
-    source_df = MockDataFrame(
-        [
-            MicroBatch(pl_df=df_1, metadata=None),
-            MicroBatch(pl_df=df_2, metadata=None),
-        ]
-    )
-    return DataFrame(source_df)
+    df_1 = pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 5]})
+    df_2 = pl.DataFrame({"id": [2, 8, 9], "col2": [5, 11, 12]})
+    return DataFrame(MockDataFrame([mock_microbatch(df_1), mock_microbatch(df_2)]))
 
 
 @fixture
@@ -73,10 +79,10 @@ def update_config():
     )
 
 
-def test_with_columns(source_df):
+def test_with_columns(source_df, state_store):
     result_df = source_df.with_columns((pl.col("col1") * 3).alias("col3"))
 
-    dfs = [mb.pl_df.collect() for mb in result_df.process(None, None)]
+    dfs = [mb.pl_df.collect() for mb in result_df.process(state_store, None)]
     assert_frame_equal(
         dfs[0], pl.DataFrame({"col1": [1, 2, 3], "col2": [4, 5, 6], "col3": [3, 6, 9]})
     )
@@ -86,10 +92,10 @@ def test_with_columns(source_df):
     )
 
 
-def test_with_column(source_df):
+def test_with_column(source_df, state_store):
     result_df = source_df.with_column(pl.lit("test").alias("col3"))
 
-    dfs = [mb.pl_df.collect() for mb in result_df.process(None, None)]
+    dfs = [mb.pl_df.collect() for mb in result_df.process(state_store, None)]
     assert_frame_equal(
         dfs[0],
         pl.DataFrame(
@@ -104,10 +110,10 @@ def test_with_column(source_df):
     )
 
 
-def test_select(source_df):
+def test_select(source_df, state_store):
     result_df = source_df.select("col1", (pl.col("col1") + 1).alias("col3"))
 
-    dfs = [mb.pl_df.collect() for mb in result_df.process(None, None)]
+    dfs = [mb.pl_df.collect() for mb in result_df.process(state_store, None)]
     assert_frame_equal(dfs[0], pl.DataFrame({"col1": [1, 2, 3], "col3": [2, 3, 4]}))
     assert_frame_equal(dfs[1], pl.DataFrame({"col1": [7, 8, 9], "col3": [8, 9, 10]}))
 
@@ -150,10 +156,10 @@ def test_group_by_update(duplicate_df, state_store, update_config):
     )
 
 
-def test_filter(source_df):
+def test_filter(source_df, state_store):
     result_df = source_df.filter(pl.col("col1") != 2)
 
-    dfs = [mb.pl_df.collect() for mb in result_df.process(None, None)]
+    dfs = [mb.pl_df.collect() for mb in result_df.process(state_store, None)]
     assert_frame_equal(dfs[0], pl.DataFrame({"col1": [1, 3], "col2": [4, 6]}))
     assert_frame_equal(dfs[1], pl.DataFrame({"col1": [7, 8, 9], "col2": [10, 11, 12]}))
 
@@ -171,3 +177,685 @@ def test_drop_duplicates(duplicate_df, state_store):
     assert_frame_equal(
         dfs[1], pl.DataFrame({"id": [8, 9], "col2": [11, 12]}), check_row_order=False
     )
+
+
+def test_group_by_incremental_state(duplicate_df, state_store, append_config):
+    # When
+    result_df = duplicate_df.group_by("id").agg(
+        pl.col("col2").mean().alias("mean"), pl.col("col2").max().alias("max")
+    )
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=append_config)
+    ]
+
+    # Then
+    assert_frame_equal(
+        dfs[1],
+        pl.DataFrame(
+            {"id": [1, 2, 8, 9], "mean": [4.0, 5.0, 11.0, 12.0], "max": [4, 5, 11, 12]}
+        ),
+        check_row_order=False,
+    )
+    assert not state_store.state_exists("group_by")
+    assert _group_by_partials(state_store).height == 4
+
+
+def test_group_by_unsupported_aggregation(duplicate_df, state_store, update_config):
+    # When
+    result_df = duplicate_df.group_by("id").agg(pl.col("col2").n_unique())
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=update_config)
+    ]
+
+    # Then
+    assert_frame_equal(
+        dfs[1],
+        pl.DataFrame({"id": [2, 8, 9], "col2": [1, 1, 1]}),
+        check_row_order=False,
+        check_dtypes=False,
+    )
+    assert state_store.state_exists("group_by")
+
+
+def test_drop_duplicates_buckets_legacy_state(duplicate_df, state_store):
+    # Given a checkpoint keeping every key in a single table
+    _write_legacy_state(state_store, pl.DataFrame({"id": [1, 8]}), "drop_duplicates")
+
+    # When
+    result_df = duplicate_df.drop_duplicates("id", num_buckets=4)
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=None)
+    ]
+
+    # Then
+    assert dfs[0]["id"].to_list() == [2]
+    assert dfs[1]["id"].to_list() == [9]
+
+
+@pytest.mark.parametrize("backend", ["ipc", "parquet"])
+def test_drop_duplicates_file_backend(duplicate_df, backend):
+    with TemporaryDirectory() as state_dir:
+        result_df = duplicate_df.drop_duplicates("id")
+
+        dfs = [
+            mb.pl_df.collect()
+            for mb in result_df.process(
+                state_store=StateStore(state_dir, backend=backend), config=None
+            )
+        ]
+        assert_frame_equal(
+            dfs[1],
+            pl.DataFrame({"id": [8, 9], "col2": [11, 12]}),
+            check_row_order=False,
+        )
+
+
+def test_drop_duplicates_buckets(state_store):
+    # Given
+    batches = [
+        pl.DataFrame({"id": list(range(0, 100)), "col2": [1] * 100}),
+        pl.DataFrame({"id": list(range(50, 150)), "col2": [2] * 100}),
+    ]
+    source_df = DataFrame(MockDataFrame([mock_microbatch(df) for df in batches]))
+
+    # When
+    result_df = source_df.drop_duplicates("id", num_buckets=4)
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=None)
+    ]
+
+    # Then
+    assert sorted(dfs[0]["id"].to_list()) == list(range(0, 100))
+    assert sorted(dfs[1]["id"].to_list()) == list(range(100, 150))
+    assert state_store.state_exists("drop_duplicates_0000")
+    assert not state_store.state_exists("drop_duplicates_0004")
+    assert not state_store.state_exists("drop_duplicates")
+
+
+def test_drop_duplicates_bucket_count_cannot_change(duplicate_df, state_store):
+    # Given
+    for _ in duplicate_df.drop_duplicates("id", num_buckets=4).process(
+        state_store=state_store, config=None
+    ):
+        pass
+
+    # When / Then
+    with pytest.raises(ValueError, match="Expected 4 buckets"):
+        for _ in duplicate_df.drop_duplicates("id", num_buckets=8).process(
+            state_store=state_store, config=None
+        ):
+            pass
+
+
+def test_group_by_writes_touched_buckets(
+    duplicate_df, state_store, update_config, monkeypatch
+):
+    # Given
+    result_df = duplicate_df.group_by("id", num_buckets=4).agg(pl.col("col2").sum())
+    microbatches = result_df.process(state_store=state_store, config=update_config)
+    next(microbatches)
+    written = []
+    write_state = state_store.write_state
+    monkeypatch.setattr(
+        state_store,
+        "write_state",
+        lambda pl_df, table_name: (
+            written.append(table_name) or write_state(pl_df, table_name)
+        ),
+    )
+
+    # When
+    next(microbatches)
+
+    # Then only the buckets of the groups in the batch are rewritten
+    assert sorted(written) == sorted(
+        f"group_by_partials_{bucket:04d}"
+        for bucket in pl.DataFrame({"id": [2, 8, 9]})
+        .select(key_hash(["id"]) % 4)
+        .to_series()
+        .unique()
+    )
+    assert _group_by_partials(state_store).height == 4
+
+
+def test_group_by_bucket_count_cannot_change(duplicate_df, state_store, update_config):
+    # Given
+    for _ in (
+        duplicate_df.group_by("id", num_buckets=4)
+        .agg(pl.col("col2").sum())
+        .process(state_store=state_store, config=update_config)
+    ):
+        pass
+
+    # When / Then
+    with pytest.raises(ValueError, match="Expected 4 buckets"):
+        for _ in (
+            duplicate_df.group_by("id", num_buckets=8)
+            .agg(pl.col("col2").sum())
+            .process(state_store=state_store, config=update_config)
+        ):
+            pass
+
+
+@fixture
+def event_time_df():
+    df_1 = pl.DataFrame(
+        {
+            "time": [datetime(2025, 1, 1, 0, 0), datetime(2025, 1, 1, 0, 1)],
+            "id": [1, 2],
+            "col2": [1, 2],
+        }
+    )
+    df_2 = pl.DataFrame(
+        {
+            "time": [
+                datetime(2025, 1, 1, 0, 0),
+                datetime(2025, 1, 1, 0, 1),
+                datetime(2025, 1, 1, 0, 5),
+            ],
+            "id": [1, 2, 3],
+            "col2": [3, 4, 5],
+        }
+    )
+    df_3 = pl.DataFrame(
+        {
+            "time": [datetime(2025, 1, 1, 0, 0), datetime(2025, 1, 1, 0, 6)],
+            "id": [1, 4],
+            "col2": [100, 6],
+        }
+    )
+    return DataFrame(
+        MockDataFrame(
+            [
+                mock_microbatch(df_1),
+                mock_microbatch(df_2),
+                mock_microbatch(df_3),
+            ]
+        )
+    )
+
+
+def test_group_by_converts_history_state(duplicate_df, state_store, update_config):
+    # Given a checkpoint holding the records of each group
+    _write_legacy_state(
+        state_store, pl.DataFrame({"id": [1, 8], "col2": [100, 200]}), "group_by"
+    )
+
+    # When
+    result_df = duplicate_df.group_by("id").agg(pl.col("col2").sum())
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=update_config)
+    ]
+
+    # Then
+    assert_frame_equal(
+        dfs[0], pl.DataFrame({"id": [1, 2], "col2": [104, 10]}), check_row_order=False
+    )
+    assert_frame_equal(
+        dfs[1],
+        pl.DataFrame({"id": [2, 8, 9], "col2": [15, 211, 12]}),
+        check_row_order=False,
+    )
+
+
+@pytest.mark.parametrize(
+    "agg, expected",
+    [
+        (pl.col("col2").sum(), [4, 6]),
+        (pl.col("col2").sort().last().alias("col2"), [3, 4]),
+    ],
+)
+def test_group_by_watermark_append(
+    event_time_df, state_store, append_config, agg, expected
+):
+    # When
+    result_df = event_time_df.with_watermark("time", "3m").group_by("time").agg(agg)
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=append_config)
+    ]
+
+    # Then the watermark set by the second batch finalises the first two minutes
+    # in the third batch, which drops their late record
+    assert dfs[0].is_empty()
+    assert dfs[1].is_empty()
+    assert_frame_equal(
+        dfs[2],
+        pl.DataFrame(
+            {
+                "time": [datetime(2025, 1, 1, 0, 0), datetime(2025, 1, 1, 0, 1)],
+                "col2": expected,
+            }
+        ),
+        check_row_order=False,
+    )
+
+
+def test_group_by_watermark_evicts_state(event_time_df, state_store, append_config):
+    # When
+    result_df = (
+        event_time_df.with_watermark("time", "3m")
+        .group_by("time")
+        .agg(pl.col("col2").sum())
+    )
+    list(result_df.process(state_store=state_store, config=append_config))
+
+    # Then
+    state = _group_by_partials(state_store)
+    assert sorted(state["time"].to_list()) == [
+        datetime(2025, 1, 1, 0, 5),
+        datetime(2025, 1, 1, 0, 6),
+    ]
+    assert state_store.get_state("watermark").collect().item() == datetime(
+        2025, 1, 1, 0, 3
+    )
+
+
+def test_drop_duplicates_within_watermark(event_time_df, state_store):
+    # When
+    result_df = event_time_df.with_watermark("time", "3m").drop_duplicates(
+        "id", num_buckets=1, within_watermark=True
+    )
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=None)
+    ]
+
+    # Then
+    assert sorted(dfs[0]["id"].to_list()) == [1, 2]
+    assert sorted(dfs[1]["id"].to_list()) == [3]
+    assert sorted(dfs[2]["id"].to_list()) == [4]
+    state = state_store.get_state("drop_duplicates_0000").collect()
+    assert state.columns == ["id", "time"]
+    assert sorted(state["id"].to_list()) == [3, 4]
+
+
+def test_drop_duplicates_within_watermark_requires_watermark(duplicate_df, state_store):
+    result_df = duplicate_df.drop_duplicates("id", within_watermark=True)
+
+    with pytest.raises(ValueError) as exc_info:
+        next(result_df.process(state_store=state_store, config=None))
+
+    assert str(exc_info.value) == (
+        "Expected a watermark when dropping duplicates within watermark"
+    )
+
+
+def test_group_by_window(event_time_df, state_store, append_config):
+    # When
+    result_df = (
+        event_time_df.with_watermark("time", "1m")
+        .group_by(window("time", "2m"), "id")
+        .agg(pl.col("col2").sum())
+    )
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=append_config)
+    ]
+
+    # Then the window [00:00, 00:02) is emitted once the watermark passes its end
+    assert dfs[0].is_empty()
+    assert dfs[1].is_empty()
+    assert_frame_equal(
+        dfs[2],
+        pl.DataFrame(
+            {
+                "window_start": [datetime(2025, 1, 1, 0, 0)] * 2,
+                "window_end": [datetime(2025, 1, 1, 0, 2)] * 2,
+                "id": [1, 2],
+                "col2": [4, 6],
+            }
+        ),
+        check_row_order=False,
+    )
+    state = _group_by_partials(state_store)
+    assert sorted(state["window_start"].to_list()) == [
+        datetime(2025, 1, 1, 0, 4),
+        datetime(2025, 1, 1, 0, 6),
+    ]
+
+
+@pytest.mark.parametrize(
+    "output_mode", [OutputMode.APPEND, OutputMode.UPDATE, OutputMode.COMPLETE]
+)
+def test_group_by_window_single_batch(state_store, output_mode):
+    # Given a single batch spanning more than the delay
+    times = [datetime(2025, 1, 1, 0, 0), datetime(2025, 1, 1, 0, 30)]
+    times.append(datetime(2025, 1, 1, 1, 0))
+    source_df = DataFrame(
+        MockDataFrame([mock_microbatch(pl.DataFrame({"t": times, "col2": [1, 2, 3]}))])
+    )
+
+    # When
+    result_df = (
+        source_df.with_watermark("t", "10m")
+        .group_by(window("t", "10m"))
+        .agg(pl.col("col2").sum())
+    )
+    microbatches = list(
+        result_df.process(state_store=state_store, config=Config(dict(), output_mode))
+    )
+
+    # Then none of its records are late, and the windows are kept until the
+    # watermark passes them
+    state = _group_by_partials(state_store)
+    assert sorted(state["window_start"].to_list()) == times
+    assert state_store.get_state("watermark").collect().item() == datetime(
+        2025, 1, 1, 0, 50
+    )
+    result = microbatches[0].pl_df.collect()
+    if output_mode == OutputMode.APPEND:
+        assert result.is_empty()
+    else:
+        assert sorted(result["window_start"].to_list()) == times
+
+
+def test_drop_duplicates_within_watermark_single_batch(state_store):
+    # Given
+    times = [datetime(2025, 1, 1, 0, 0), datetime(2025, 1, 1, 0, 30)]
+    times.append(datetime(2025, 1, 1, 1, 0))
+    source_df = DataFrame(
+        MockDataFrame([mock_microbatch(pl.DataFrame({"t": times, "id": [1, 2, 3]}))])
+    )
+
+    # When
+    result_df = source_df.with_watermark("t", "10m").drop_duplicates(
+        "id", within_watermark=True
+    )
+    microbatches = list(result_df.process(state_store=state_store, config=None))
+
+    # Then
+    assert sorted(microbatches[0].pl_df.collect()["id"].to_list()) == [1, 2, 3]
+
+
+def test_watermark_on_date_column(state_store, append_config):
+    # Given
+    source_df = DataFrame(
+        MockDataFrame(
+            [
+                mock_microbatch(
+                    pl.DataFrame({"d": [date(2025, 1, day)], "col2": [day]})
+                )
+                for day in (1, 3, 1, 4)
+            ]
+        )
+    )
+
+    # When
+    result_df = (
+        source_df.with_watermark("d", "1d").group_by("d").agg(pl.col("col2").sum())
+    )
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=append_config)
+    ]
+
+    # Then the watermark is stored as a date, and the late record is dropped
+    assert state_store.get_state("watermark").collect().schema == pl.Schema(
+        {"watermark": pl.Date}
+    )
+    assert state_store.get_state("watermark").collect().item() == date(2025, 1, 3)
+    assert [df.height for df in dfs] == [0, 0, 1, 0]
+    assert_frame_equal(dfs[2], pl.DataFrame({"d": [date(2025, 1, 1)], "col2": [1]}))
+
+
+def test_watermark_stored_as_string(state_store):
+    # Given a checkpoint storing the watermark as a string
+    state_store.write_state(
+        pl.DataFrame({"watermark": ["2025-01-01T00:02:00"]}).lazy(), "watermark"
+    )
+    source_df = DataFrame(
+        MockDataFrame(
+            [mock_microbatch(pl.DataFrame({"t": [datetime(2025, 1, 1, 0, 10)]}))]
+        )
+    )
+
+    # When
+    microbatch = next(source_df.with_watermark("t", "1m").process(state_store, None))
+
+    # Then
+    assert microbatch.watermark.timestamp == datetime(2025, 1, 1, 0, 2)
+    assert state_store.get_state("watermark").collect().item() == datetime(
+        2025, 1, 1, 0, 9
+    )
+
+
+def test_query_plan_stages(duplicate_df):
+    # Given
+    result_df = (
+        duplicate_df.filter(pl.col("id") != 9)
+        .drop_duplicates("id")
+        .with_columns((pl.col("col2") * 2).alias("col3"))
+        .group_by("id")
+        .agg(pl.col("col3").sum())
+    )
+
+    # When
+    plan = QueryPlan(result_df)
+
+    # Then
+    assert plan.source is duplicate_df._source
+    assert [type(stage) for stage in plan.stages] == [
+        Filter,
+        DropDuplicates,
+        AddColumns,
+        GroupedDataFrame,
+    ]
+    assert [stage.stateful for stage in plan.stages] == [False, True, False, True]
+
+
+def test_query_plan_pipeline(duplicate_df, state_store, update_config):
+    # When
+    result_df = (
+        duplicate_df.filter(pl.col("id") != 9)
+        .drop_duplicates("id")
+        .with_columns((pl.col("col2") * 2).alias("col3"))
+        .group_by("id")
+        .agg(pl.col("col3").sum())
+    )
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=update_config)
+    ]
+
+    # Then
+    assert_frame_equal(
+        dfs[0], pl.DataFrame({"id": [1, 2], "col3": [8, 10]}), check_row_order=False
+    )
+    assert_frame_equal(dfs[1], pl.DataFrame({"id": [8], "col3": [22]}))
+
+
+def test_query_plan_required_columns(duplicate_df):
+    # Given
+    result_df = (
+        duplicate_df.filter(pl.col("col2") > 1)
+        .drop_duplicates("id")
+        .with_columns((pl.col("col3") * 2).alias("col4"))
+        .select("id", "col4")
+        .with_columns(pl.col("col5"))
+    )
+
+    # When
+    plan = QueryPlan(result_df)
+
+    # Then
+    assert plan.required_columns == {"id", "col2", "col3", "col4"}
+
+
+def test_query_plan_required_columns_without_projection(duplicate_df):
+    plan = QueryPlan(duplicate_df.filter(pl.col("col2") > 1).drop_duplicates("id"))
+
+    assert plan.required_columns is None
+
+
+def test_query_plan_required_columns_group_by_window(duplicate_df):
+    plan = QueryPlan(
+        duplicate_df.with_watermark("time", "1m")
+        .group_by(window("time", "5m"), pl.col("id"))
+        .agg(pl.col("col2").sum())
+    )
+
+    assert plan.required_columns == {"time", "id", "col2"}
+
+
+def test_query_plan_projection_pushdown(state_store, append_config):
+    # Given
+    source_df = DataFrame(
+        MockDataFrame(
+            [
+                mock_microbatch(
+                    pl.DataFrame(
+                        {"id": [1, 1, 2], "col2": [1, 2, 3], "wide": ["a", "b", "c"]}
+                    )
+                )
+            ]
+        )
+    )
+    result_df = source_df.drop_duplicates("id").select("id", "col2")
+
+    # When
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=append_config)
+    ]
+
+    # Then
+    assert dfs[0].columns == ["id", "col2"]
+    assert sorted(dfs[0]["id"].to_list()) == [1, 2]
+
+
+def test_query_plan_streaming_engine(duplicate_df, state_store):
+    # Given
+    config = Config(
+        output_mode=OutputMode.APPEND, write_options=dict(engine="streaming")
+    )
+
+    # When
+    result_df = duplicate_df.drop_duplicates("id")
+    dfs = [
+        mb.pl_df.collect()
+        for mb in result_df.process(state_store=state_store, config=config)
+    ]
+
+    # Then
+    assert sorted(dfs[1]["id"].to_list()) == [8, 9]
+
+
+@pytest.mark.parametrize("engine, lazy", [("streaming", True), ("auto", False)])
+def test_query_plan_read_materialised(source_df, state_store, engine, lazy):
+    # Given
+    config = Config(output_mode=OutputMode.APPEND, write_options=dict(engine=engine))
+    plan = source_df.filter(pl.col("col1") > 1).drop_duplicates("col1").query_plan()
+    microbatch = MicroBatch(
+        pl.DataFrame({"col1": [1, 2, 2], "col2": [4, 5, 6]}).lazy(), None
+    )
+
+    # When
+    read = plan.read(microbatch, state_store, config)
+    result = plan.transform(read, state_store, config).pl_df.collect()
+
+    # Then the streaming engine leaves the filter to be streamed into the stage
+    assert ("FILTER" in read.pl_df.explain()) == lazy
+    assert result["col1"].to_list() == [2]
+
+
+def test_static_join(source_df, state_store):
+    # Given
+    static_df = pl.DataFrame({"col1": [1, 3, 7], "name": ["a", "c", "g"]})
+
+    # When
+    result_df = source_df.join(static_df.lazy(), on="col1", how="left")
+    dfs = [mb.pl_df.collect() for mb in result_df.process(state_store, None)]
+
+    # Then
+    assert dfs[0]["name"].to_list() == ["a", None, "c"]
+    assert dfs[1]["name"].to_list() == ["g", None, None]
+
+
+def test_static_join_unsupported(source_df):
+    with pytest.raises(ValueError) as exc_info:
+        source_df.join(pl.DataFrame({"col1": [1]}), on="col1", how="full")
+
+    assert str(exc_info.value) == "full is not supported"
+
+
+def test_stream_join(state_store, append_config):
+    # Given
+    left_df = DataFrame(
+        MockDataFrame(
+            [
+                mock_microbatch(pl.DataFrame({"id": [1, 2], "l": [1, 2]})),
+                mock_microbatch(pl.DataFrame({"id": [3, 4], "l": [3, 4]})),
+            ]
+        )
+    )
+    right_df = DataFrame(
+        MockDataFrame(
+            [
+                mock_microbatch(pl.DataFrame({"id": [2, 3], "r": [20, 30]})),
+                mock_microbatch(pl.DataFrame({"id": [1, 5], "r": [10, 50]})),
+            ]
+        )
+    )
+
+    # When
+    result_df = left_df.join(right_df.filter(pl.col("r") > 0), on="id")
+    dfs = [mb.pl_df.collect() for mb in result_df.process(state_store, append_config)]
+
+    # Then every match is emitted once, whichever input it arrived on first
+    assert len(dfs) == 4
+    assert_frame_equal(
+        pl.concat(dfs),
+        pl.DataFrame({"id": [1, 2, 3], "l": [1, 2, 3], "r": [10, 20, 30]}),
+        check_row_order=False,
+    )
+
+
+def test_stream_join_requires_stateless_inputs(source_df, duplicate_df):
+    with pytest.raises(ValueError) as exc_info:
+        source_df.join(duplicate_df.drop_duplicates("id"), on="id")
+
+    assert str(exc_info.value) == (
+        "Expected only stateless operators and with_watermark on the inputs of a "
+        "stream-stream join"
+    )
+
+
+def test_stream_join_watermark_evicts_state(state_store):
+    # Given
+    left_df = DataFrame(MockDataFrame([])).with_watermark("time", "1m")
+    right_df = DataFrame(MockDataFrame([]))
+    join = StreamJoin(left_df.join(right_df, on="id")._source._source, ["id"], 1)
+
+    def left(minute, id):
+        return MicroBatch(
+            pl.DataFrame(
+                {"time": [datetime(2025, 1, 1, 0, minute)], "id": [id]}
+            ).lazy(),
+            None,
+        )
+
+    def right(id):
+        return MicroBatch(pl.DataFrame({"id": [id], "r": [id]}).lazy(), None, side=1)
+
+    # When
+    join.process(left(0, 1), state_store)
+    join.process(left(5, 2), state_store)
+    late = join.process(left(1, 3), state_store).pl_df.collect()
+    join.process(left(6, 4), state_store)
+    matched = join.process(right(1), state_store).pl_df.collect()
+    state = state_store.get_state("join_left_0000").collect()
+
+    # Then the first record fell behind the watermark and the late one was dropped
+    assert late.is_empty()
+    assert matched.is_empty()
+    assert sorted(state["id"].to_list()) == [2, 4]
+    assert state_store.get_state("join_left_watermark").collect().item() == (
+        datetime(2025, 1, 1, 0, 5)
+    )
+    assert isinstance(join._watermarks[0], Watermark)
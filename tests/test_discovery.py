@@ -0,0 +1,160 @@
+# mypy: disable-error-code="no-untyped-def"
+import os
+import shutil
+import time
+from datetime import timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from pytest import fixture
+
+from polar_streams.discovery import FileCompletionTracker, FileLister
+
+
+def _touch(path: Path, mtime: int) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("col1\n1\n")
+    os.utime(path, (mtime, mtime))
+
+
+@fixture
+def source_dir():
+    with TemporaryDirectory() as source_dir:
+        root = Path(source_dir)
+        _touch(root / "b.csv", 3)
+        _touch(root / "a.csv", 2)
+        _touch(root / "year=2024" / "c.csv", 1)
+        _touch(root / "year=2023" / "d.csv", 4)
+        _touch(root / "notes.txt", 5)
+        yield root
+
+
+def test_list_orders_by_mtime(source_dir):
+    # Given
+    lister = FileLister(source_dir)
+
+    # When
+    files = lister.list()
+
+    # Then
+    assert [p.relative_to(source_dir).as_posix() for p in files] == [
+        "year=2024/c.csv",
+        "a.csv",
+        "b.csv",
+        "year=2023/d.csv",
+        "notes.txt",
+    ]
+    assert lister.file_info((source_dir / "a.csv").as_posix()) == (7, 2.0)
+
+
+def test_list_filters(source_dir):
+    # Given
+    lister = FileLister(source_dir, glob="*.csv", partition_filter={"year": "2024"})
+    flat_lister = FileLister(source_dir, recursive=False)
+
+    # When
+    files = lister.list()
+    flat_files = flat_lister.list()
+
+    # Then
+    assert [p.name for p in files] == ["c.csv", "a.csv", "b.csv"]
+    assert [p.name for p in flat_files] == ["a.csv", "b.csv", "notes.txt"]
+    assert lister.matches((source_dir / "year=2024" / "e.csv").as_posix())
+    assert not lister.matches((source_dir / "year=2023" / "e.csv").as_posix())
+    assert not lister.matches((source_dir / "e.txt").as_posix())
+    assert not flat_lister.matches((source_dir / "year=2024" / "e.csv").as_posix())
+
+
+def test_refresh_returns_new_files(source_dir):
+    # Given
+    lister = FileLister(source_dir)
+    lister.list()
+
+    # When
+    unchanged = lister.refresh()
+    _touch(source_dir / "year=2024" / "e.csv", 6)
+    _touch(source_dir / "year=2025" / "f.csv", 7)
+    shutil.rmtree(source_dir / "year=2023")
+    refreshed = lister.refresh()
+
+    # Then
+    assert unchanged == []
+    assert [p.name for p in refreshed] == ["e.csv", "f.csv"]
+    assert [p.name for p in lister.list()] == [
+        "c.csv",
+        "a.csv",
+        "b.csv",
+        "notes.txt",
+        "e.csv",
+        "f.csv",
+    ]
+
+
+def test_list_skips_hidden_and_incomplete_files(source_dir):
+    # Given
+    _touch(source_dir / "e.csv.tmp", 6)
+    _touch(source_dir / "_temporary" / "f.csv", 7)
+    _touch(source_dir / "year=2024" / "_SUCCESS", 8)
+    lister = FileLister(source_dir, success_marker="_SUCCESS")
+
+    # When
+    files = lister.list()
+    (source_dir / "_SUCCESS").touch()
+    refreshed = lister.refresh()
+
+    # Then
+    assert [p.name for p in files] == ["c.csv"]
+    assert [p.name for p in refreshed] == ["a.csv", "b.csv", "notes.txt"]
+    assert not lister.matches((source_dir / "e.csv.tmp").as_posix())
+    assert not lister.matches((source_dir / "_temporary" / "f.csv").as_posix())
+
+
+def test_completion_tracker_closed_files(source_dir):
+    # Given
+    tracker = FileCompletionTracker()
+    tracker.add((source_dir / "a.csv").as_posix())
+    tracker.add((source_dir / "b.csv").as_posix(), closed=True)
+
+    # When
+    completed = tracker.complete()
+    tracker.add((source_dir / "b.csv").as_posix(), closed=True)
+
+    # Then
+    assert completed == [(source_dir / "b.csv").as_posix()]
+    assert tracker.complete() == []
+
+
+def test_completion_tracker_stability_interval(source_dir):
+    # Given
+    tracker = FileCompletionTracker(stability_interval=timedelta(milliseconds=50))
+    path = source_dir / "a.csv"
+    tracker.add(path.as_posix(), closed=True)
+
+    # When
+    before = tracker.complete()
+    path.write_text("col1\n1\n2\n")
+    time.sleep(0.06)
+    changed = tracker.complete()
+    time.sleep(0.06)
+    stable = tracker.complete()
+
+    # Then
+    assert before == []
+    assert changed == []
+    assert stable == [path.as_posix()]
+
+
+def test_completion_tracker_success_marker(source_dir):
+    # Given
+    tracker = FileCompletionTracker(success_marker="_SUCCESS")
+    path = source_dir / "year=2024" / "c.csv"
+    tracker.add(path.as_posix(), closed=True)
+
+    # When
+    before = tracker.complete()
+    (source_dir / "year=2024" / "_SUCCESS").touch()
+    after = tracker.complete()
+
+    # Then
+    assert before == []
+    assert after == [path.as_posix()]
@@ -0,0 +1,79 @@
+# mypy: disable-error-code="no-untyped-def"
+from datetime import date
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+
+from polar_streams.hashing import HASH_SCHEME, check_layout, key_hash
+from polar_streams.statestore import StateStore
+
+
+def test_key_hash_is_stable():
+    # Given
+    pl_df = pl.DataFrame(
+        {"id": [1, 2, 3, 12345, None], "name": ["a", "", "héllo wörld", None, "x"]}
+    )
+
+    # When
+    hashes = pl_df.select(key_hash(["id", "name"]).alias("hash"))["hash"]
+
+    # Then the hashes are the same for every polars version
+    assert pl_df.select(key_hash(["id"]) % 32)["id"].to_list() == [1, 14, 13, 0, 18]
+    assert hashes.to_list() == [
+        16966709346129430400,
+        7235116703822611636,
+        9061636143456389475,
+        18177187737588033490,
+        1433805964659773214,
+    ]
+
+
+def test_key_hash_by_value():
+    # Given
+    pl_df = pl.DataFrame(
+        {
+            "int32": pl.Series([1, 2], dtype=pl.Int32),
+            "int64": [1, 2],
+            "float": [0.0, float("nan")],
+            "other_float": [-0.0, float("-nan")],
+            "category": pl.Series(["a", "b"], dtype=pl.Categorical),
+            "string": ["a", "b"],
+        }
+    )
+
+    # When
+    hashes = pl_df.select(key_hash([col]).alias(col) for col in pl_df.columns)
+
+    # Then
+    assert hashes["int32"].equals(hashes["int64"])
+    assert hashes["float"].equals(hashes["other_float"])
+    assert hashes["category"].equals(hashes["string"])
+
+
+def test_key_hash_unsupported():
+    with pytest.raises((ValueError, pl.exceptions.ComputeError), match="not supported"):
+        pl.DataFrame({"id": [[1]]}).select(key_hash(["id"]))
+
+
+def test_check_layout():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir)
+        check_layout(state_store, "layout", "buckets", 4, False)
+
+        # When / Then
+        check_layout(state_store, "layout", "buckets", 4, True)
+        with pytest.raises(ValueError, match="Expected 4 buckets"):
+            check_layout(state_store, "layout", "buckets", 8, True)
+        assert state_store.get_state("layout").collect().row(0) == (4, HASH_SCHEME)
+
+
+def test_check_layout_before_layouts_recorded():
+    with TemporaryDirectory() as state_dir:
+        # Given buckets assigned by the polars hash
+        state_store = StateStore(state_dir)
+
+        # When / Then
+        with pytest.raises(ValueError, match="Keys hashed with polars"):
+            check_layout(state_store, "layout", "buckets", 4, True)
@@ -0,0 +1,132 @@
+# mypy: disable-error-code="no-untyped-def"
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from polar_streams.dataframe import DataFrame
+from polar_streams.model import Config, OutputMode
+from polar_streams.pipeline import Pipeline
+from polar_streams.polars import window
+from polar_streams.statestore import StateStore
+
+
+def _config(output_mode: OutputMode, num_partitions: int) -> Config:
+    return Config(
+        write_options={"numPartitions": str(num_partitions)}, output_mode=output_mode
+    )
+
+
+def _run(df: DataFrame, state_dir: str, config: Config) -> list[pl.DataFrame]:
+    results: list[pl.DataFrame] = []
+    Pipeline(
+        df.query_plan(),
+        StateStore(state_dir, checkpoint_batches=1),
+        config,
+        lambda microbatch: results.append(microbatch.pl_df.collect()),
+    ).run()
+    return results
+
+
+@pytest.mark.parametrize(
+    "output_mode", [OutputMode.COMPLETE, OutputMode.UPDATE, OutputMode.APPEND]
+)
+def test_partitioned_group_by_matches_unpartitioned(source_df, output_mode):
+    # Given
+    df = source_df.group_by("id").agg(pl.col("col2").sum())
+
+    # When
+    with TemporaryDirectory() as state_dir, TemporaryDirectory() as partitioned_dir:
+        expected = _run(df, state_dir, _config(output_mode, 1))
+        results = _run(df, partitioned_dir, _config(output_mode, 3))
+
+    # Then
+    for result, expected_result in zip(results, expected, strict=True):
+        assert_frame_equal(result, expected_result, check_row_order=False)
+
+
+def test_partitioned_drop_duplicates(source_df):
+    # Given
+    df = source_df.drop_duplicates("id").select("id")
+    config = _config(OutputMode.APPEND, 2)
+
+    # When
+    with TemporaryDirectory() as state_dir:
+        results = _run(df, state_dir, config)
+        partitions = [StateStore(state_dir).partition(i)() for i in range(2)]
+        partitioned_buckets = [
+            bucket
+            for partition in partitions
+            for bucket in range(32)
+            if partition.state_exists(f"drop_duplicates_{bucket:04d}")
+        ]
+        unpartitioned_buckets = [
+            bucket
+            for bucket in range(32)
+            if StateStore(state_dir).state_exists(f"drop_duplicates_{bucket:04d}")
+        ]
+
+    # Then
+    assert [sorted(result["id"]) for result in results] == [[1, 2], [3], [4]]
+    assert partitioned_buckets
+    assert not unpartitioned_buckets
+
+
+def test_partitioned_state_survives_restart(source_df):
+    # Given
+    df = source_df.group_by("id").agg(pl.col("col2").sum())
+    config = _config(OutputMode.COMPLETE, 2)
+
+    # When
+    with TemporaryDirectory() as state_dir:
+        _run(df, state_dir, config)
+        results = _run(df, state_dir, config)
+
+    # Then
+    assert_frame_equal(
+        results[-1],
+        pl.DataFrame({"id": [1, 2, 3, 4], "col2": [10, 36, 38, 6]}),
+        check_row_order=False,
+    )
+
+
+def test_partition_count_cannot_change(source_df):
+    # Given
+    df = source_df.group_by("id").agg(pl.col("col2").sum())
+
+    with TemporaryDirectory() as state_dir:
+        _run(df, state_dir, _config(OutputMode.COMPLETE, 2))
+
+        # When / Then
+        with pytest.raises(ValueError, match="Expected 2 partitions"):
+            _run(df, state_dir, _config(OutputMode.COMPLETE, 3))
+
+
+def test_partitions_hashed_by_polars_cannot_be_read(source_df):
+    # Given partitions assigned before their hash was recorded
+    df = source_df.group_by("id").agg(pl.col("col2").sum())
+
+    with TemporaryDirectory() as state_dir:
+        StateStore(state_dir).write_state(
+            pl.DataFrame({"partitions": [2]}).lazy(), "partitions"
+        )
+
+        # When / Then
+        with pytest.raises(ValueError, match="Keys hashed with polars"):
+            _run(df, state_dir, _config(OutputMode.COMPLETE, 2))
+
+
+def test_partitioned_group_by_requires_key(source_df):
+    # Given
+    df = (
+        source_df.with_columns(pl.lit(datetime(2024, 1, 1)).alias("ts"))
+        .group_by(window("ts", "1h"))
+        .agg(pl.col("col2").sum())
+    )
+
+    # When / Then
+    with TemporaryDirectory() as state_dir:
+        with pytest.raises(ValueError, match="Expected a key"):
+            _run(df, state_dir, _config(OutputMode.COMPLETE, 2))
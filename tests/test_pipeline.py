@@ -0,0 +1,75 @@
+# mypy: disable-error-code="no-untyped-def"
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+from pytest import fixture
+
+from polar_streams.dataframe import DataFrame
+from polar_streams.model import Config, OutputMode
+from polar_streams.pipeline import Pipeline
+from polar_streams.statestore import StateStore
+
+
+class FailingDataFrame(DataFrame):
+    def __init__(self):
+        super().__init__(None)
+
+    def process(self, state_store: StateStore, config: Config):
+        raise RuntimeError("source failed")
+        yield
+
+
+@fixture
+def update_config():
+    return Config(write_options=dict(), output_mode=OutputMode.UPDATE)
+
+
+def test_pipeline_matches_sequential(source_df, update_config):
+    with TemporaryDirectory() as state_dir, TemporaryDirectory() as expected_dir:
+        # Given
+        df = (
+            source_df.filter(pl.col("col2") > 1)
+            .group_by("id", num_buckets=1)
+            .agg(pl.sum("col2"))
+        )
+        state_store = StateStore(state_dir, checkpoint_batches=1)
+        written: list[pl.DataFrame] = []
+
+        # When
+        Pipeline(
+            df.query_plan(),
+            state_store,
+            update_config,
+            lambda microbatch: written.append(microbatch.pl_df.collect()),
+            queue_depth=1,
+        ).run()
+
+        # Then
+        expected = [
+            microbatch.pl_df.collect()
+            for microbatch in df.process(StateStore(expected_dir), update_config)
+        ]
+        assert len(written) == len(expected) == 3
+        for out_df, expected_df in zip(written, expected):
+            assert_frame_equal(out_df, expected_df, check_row_order=False)
+        assert state_store.wal_uncommitted_entries() == []
+        assert_frame_equal(
+            StateStore(state_dir).get_state("group_by_partials_0000").collect(),
+            state_store.get_state("group_by_partials_0000").collect(),
+            check_row_order=False,
+        )
+
+
+def test_pipeline_raises_stage_errors(update_config):
+    with TemporaryDirectory() as state_dir:
+        # Given
+        df = DataFrame(FailingDataFrame()).select("id")
+
+        # When
+        with pytest.raises(RuntimeError) as exc_info:
+            Pipeline(df.query_plan(), StateStore(state_dir), update_config, print).run()
+
+        # Then
+        assert str(exc_info.value) == "source failed"
@@ -0,0 +1,108 @@
+# mypy: disable-error-code="no-untyped-def"
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+from pytest import fixture
+
+from polar_streams.model import Config, MicroBatch, OutputMode
+from polar_streams.profiler import BatchProfile, Profiler
+from polar_streams.sink import Sink
+
+
+class CollectSink(Sink):
+    def write(self, microbatch: MicroBatch):
+        pass
+
+
+@fixture
+def source_batches():
+    return [
+        pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 6]}),
+        pl.DataFrame({"id": [2, 3], "col2": [7, 8]}),
+        pl.DataFrame({"id": [1, 4], "col2": [1, 2]}),
+    ]
+
+
+@fixture
+def stop_tracing():
+    yield
+    tracemalloc.stop()
+
+
+def _config(out_dir: str, **options) -> Config:
+    return Config(
+        write_options={"checkpointLocation": f"{out_dir}/checkpoint"} | options,
+        output_mode=OutputMode.COMPLETE,
+    )
+
+
+@pytest.mark.parametrize("queue_depth", ["0", "2"])
+def test_profile_every_interval_batches(source_df, stop_tracing, queue_depth):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        config = _config(
+            out_dir, profile="true", profileInterval="2", queueDepth=queue_depth
+        )
+        df = source_df.group_by("id").agg(pl.col("col2").sum())
+
+        # When
+        CollectSink(config, df).run()
+        profile_dir = Path(out_dir) / "checkpoint" / "profile"
+        batches = sorted(path.name for path in profile_dir.iterdir())
+        files = {path.name for path in (profile_dir / batches[-1]).iterdir()}
+        plans = (profile_dir / batches[-1] / "plans.txt").read_text()
+
+    # Then
+    assert batches == ["batch-0000000000", "batch-0000000002"]
+    assert {"GroupBy.prof", "GroupBy.txt", "write.prof", "commit.prof"} <= files
+    assert {"memory.txt", "plans.txt"} <= files
+    assert "output optimised plan" in plans
+
+
+def test_profile_kinds(source_df):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        config = _config(out_dir, profile="cpu", profileInterval="3")
+        df = source_df.group_by("id").agg(pl.col("col2").sum())
+
+        # When
+        CollectSink(config, df).run()
+        batch_dir = Path(out_dir) / "checkpoint" / "profile" / "batch-0000000000"
+        files = {path.name for path in batch_dir.iterdir()}
+
+    # Then
+    assert "GroupBy.prof" in files
+    assert "memory.txt" not in files
+    assert "plans.txt" not in files
+    assert not tracemalloc.is_tracing()
+
+
+def test_unsupported_profile_kind():
+    with TemporaryDirectory() as out_dir:
+        with pytest.raises(ValueError, match="gpu is not supported"):
+            Profiler.from_config(_config(out_dir, profile="cpu,gpu"))
+
+
+def test_plan_collected_when_it_cannot_be_timed(monkeypatch):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        def profile(self, engine):
+            raise pl.exceptions.ComputeError("no data to time")
+
+        monkeypatch.setattr(pl.LazyFrame, "profile", profile, raising=False)
+        profile_dir = Path(out_dir) / "profile"
+        batch_profile = BatchProfile(Profiler(profile_dir, ["plan"], 1), profile_dir)
+
+        # When
+        result = batch_profile.collect(
+            "output", pl.LazyFrame({"id": [1, 2]}), "streaming"
+        )
+        batch_profile.write()
+        plans = (profile_dir / "plans.txt").read_text()
+
+    # Then
+    assert result.equals(pl.DataFrame({"id": [1, 2]}))
+    assert "output collected in" in plans
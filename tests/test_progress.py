@@ -0,0 +1,89 @@
+# mypy: disable-error-code="no-untyped-def"
+import json
+import time
+from multiprocessing import Process, Queue
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+from pytest import fixture
+
+from polar_streams.model import Config, MicroBatch, OutputMode
+from polar_streams.progress import ProgressReporter
+from polar_streams.sink import QueryManager, Sink
+from polar_streams.statestore import StateStore
+from tests.conftest import mock_microbatch
+
+
+class CollectSink(Sink):
+    def write(self, microbatch: MicroBatch):
+        pass
+
+
+@fixture
+def source_batches():
+    return [
+        pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 6]}),
+        pl.DataFrame({"id": [2, 3], "col2": [7, 8]}),
+    ]
+
+
+def _wait_for_progress(manager: QueryManager, batches: int) -> list:
+    deadline = time.monotonic() + 5
+    while len(manager.recent_progress) < batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return manager.recent_progress
+
+
+@pytest.mark.parametrize("queue_depth", ["0", "2"])
+def test_query_progress(source_df, queue_depth):
+    with TemporaryDirectory() as out_dir:
+        # Given
+        metrics_file = Path(out_dir) / "metrics.jsonl"
+        config = Config(
+            write_options={
+                "checkpointLocation": f"{out_dir}/checkpoint",
+                "metricsFile": metrics_file.as_posix(),
+                "queueDepth": queue_depth,
+            },
+            output_mode=OutputMode.COMPLETE,
+        )
+        df = source_df.group_by("id", num_buckets=1).agg(pl.col("col2").sum())
+        sink = CollectSink(config, df)
+        manager = QueryManager(Process(), sink.progress)
+
+        # When
+        sink.run()
+        progress = _wait_for_progress(manager, 2)
+        metrics = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+
+    # Then
+    assert [p.batch_id for p in progress] == [0, 1]
+    assert [p.output_rows for p in progress] == [2, 3]
+    assert progress[-1].state_rows == {
+        "group_by_buckets": 1,
+        "group_by_partials_0000": 3,
+    }
+    assert {"GroupBy", "write", "commit", "state_write"} <= set(progress[-1].durations)
+    assert manager.last_progress == progress[-1]
+    assert [m["batch_id"] for m in metrics] == [0, 1]
+    assert metrics[-1]["durations"] == progress[-1].durations
+
+
+def test_full_queue_drops_oldest_progress():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        queue: Queue = Queue(maxsize=2)
+        config = Config(write_options=dict(), output_mode=OutputMode.APPEND)
+        reporter = ProgressReporter(config, StateStore(state_dir), None, queue)
+        manager = QueryManager(Process(), queue)
+
+        # When
+        for _ in range(5):
+            reporter.report(mock_microbatch(pl.DataFrame({"id": [1]})))
+        progress = _wait_for_progress(manager, 2)
+
+        # Then
+        assert [p.batch_id for p in progress] == [3, 4]
+        assert manager.last_progress.batch_id == 4
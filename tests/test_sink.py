@@ -0,0 +1,168 @@
+# mypy: disable-error-code="no-untyped-def"
+import json
+import os
+from datetime import date
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+from pytest import fixture
+
+from polar_streams.dataframe import DataFrame
+from polar_streams.manifest import SinkManifest
+from polar_streams.model import Config, OutputMode
+from polar_streams.sink import BATCH_FILE, STAGING_DIR, FileSink
+from polar_streams.statestore import StateStore
+from tests.conftest import MockDataFrame, mock_microbatch
+
+
+@fixture
+def source_batches():
+    return [
+        pl.DataFrame({"id": [1, 2, 2], "col2": [4, 5, 6]}),
+        pl.DataFrame({"id": [2, 3], "col2": [7, 8]}),
+        pl.DataFrame({"id": [None, 4], "col2": [1, 2]}),
+    ]
+
+
+@fixture
+def out_dir():
+    with TemporaryDirectory() as out_dir:
+        yield Path(out_dir)
+
+
+def _sink(df: DataFrame, out_dir: Path, fmt: str = "csv", **options) -> FileSink:
+    config = Config(
+        write_options={"checkpointLocation": (out_dir / "checkpoint").as_posix()}
+        | options,
+        output_mode=OutputMode.APPEND,
+    )
+    return FileSink(config, df, fmt, out_dir / "output")
+
+
+def _read_output(out_dir: Path) -> pl.DataFrame:
+    manifest = SinkManifest(out_dir / "output")
+    return pl.concat(
+        [
+            pl.read_csv(out_dir / "output" / file, schema_overrides={"id": pl.Int64})
+            for file in manifest.files()
+        ]
+    )
+
+
+def test_file_sink_publishes_committed_batches(source_df, out_dir):
+    # Given
+    sink = _sink(source_df, out_dir)
+
+    # When
+    sink.run()
+
+    # Then
+    assert_frame_equal(
+        _read_output(out_dir),
+        pl.DataFrame({"id": [1, 2, 2, 2, 3, None, 4], "col2": [4, 5, 6, 7, 8, 1, 2]}),
+    )
+    assert len(SinkManifest(out_dir / "output").files()) == 3
+    assert not list((out_dir / "output" / STAGING_DIR).iterdir())
+
+
+def test_file_sink_recovers_staged_batches(source_df, out_dir):
+    # Given
+    sink = _sink(source_df, out_dir)
+    state_store = StateStore((out_dir / "checkpoint").as_posix())
+    committed = sink._stage(
+        pl.DataFrame({"id": [1], "col2": [2]}), state_store.wal_append_many(["a"])
+    )
+    uncommitted = sink._stage(
+        pl.DataFrame({"id": [3], "col2": [4]}), state_store.wal_append_many(["b"])
+    )
+    state_store.wal_commit_many(
+        json.loads((committed / BATCH_FILE).read_text())["wal_ids"]
+    )
+
+    # When
+    _sink(source_df, out_dir)
+
+    # Then
+    assert_frame_equal(_read_output(out_dir), pl.DataFrame({"id": [1], "col2": [2]}))
+    assert not committed.exists()
+    assert not uncommitted.exists()
+
+
+def test_file_sink_partitions_output(source_df, out_dir):
+    # Given
+    sink = _sink(source_df, out_dir, partitionBy="id")
+
+    # When
+    sink.run()
+
+    # Then
+    files = SinkManifest(out_dir / "output").files()
+    assert {os.path.dirname(file) for file in files} == {
+        "id=1",
+        "id=2",
+        "id=3",
+        "id=4",
+        "id=__HIVE_DEFAULT_PARTITION__",
+    }
+    assert_frame_equal(
+        pl.read_csv(out_dir / "output" / "id=2" / "*.csv"),
+        pl.DataFrame({"col2": [5, 6, 7]}),
+        check_row_order=False,
+    )
+
+
+def test_file_sink_limits_rows_per_file(source_df, out_dir):
+    # Given
+    sink = _sink(source_df, out_dir, maxRowsPerFile="1")
+
+    # When
+    sink.run()
+
+    # Then
+    files = SinkManifest(out_dir / "output").files()
+    assert len(files) == 7
+    assert _read_output(out_dir).height == 7
+
+
+def test_file_sink_compacts_small_files(source_df, out_dir):
+    # Given
+    sink = _sink(source_df, out_dir, compaction="true", compactionMinFiles="3")
+
+    # When
+    sink.run()
+
+    # Then
+    files = SinkManifest(out_dir / "output").files()
+    assert len(files) == 1
+    assert sorted(os.listdir(out_dir / "output")) == sorted(
+        files + ["_manifest", STAGING_DIR]
+    )
+    assert_frame_equal(
+        _read_output(out_dir),
+        pl.DataFrame({"id": [1, 2, 2, 2, 3, None, 4], "col2": [4, 5, 6, 7, 8, 1, 2]}),
+        check_row_order=False,
+    )
+
+
+@pytest.mark.parametrize("fmt", ["csv", "json"])
+def test_file_sink_compaction_keeps_types(out_dir, fmt):
+    # Given
+    batches = [
+        pl.DataFrame({"code": ["00123"], "day": [date(2024, 1, i)], "note": [None]})
+        for i in range(1, 4)
+    ]
+    df = DataFrame(MockDataFrame([mock_microbatch(batch) for batch in batches]))
+    sink = _sink(df, out_dir, fmt, compaction="true", compactionMinFiles="3")
+
+    # When
+    sink.run()
+
+    # Then
+    files = SinkManifest(out_dir / "output").files()
+    assert len(files) == 1
+    assert_frame_equal(
+        sink._read_files(files), pl.concat(batches), check_row_order=False
+    )
@@ -1,4 +1,7 @@
+import os
+from collections import deque
 from pathlib import Path
+from queue import Queue
 from tempfile import TemporaryDirectory
 
 import polars as pl
@@ -7,7 +10,7 @@ from polars.testing import assert_frame_equal
 from pytest import fixture
 
 from polar_streams.model import Config, OutputMode
-from polar_streams.source import FileSource
+from polar_streams.source import FileSource, StaticFactory
 from polar_streams.statestore import StateStore
 
 
@@ -79,3 +82,347 @@ def test_source_without_run_initial_batch(csv_source):
 
             with pytest.raises(StopIteration):
                 next(process_gen)
+
+
+class MockEvent:
+    def __init__(self, src_path: str):
+        self.src_path = src_path
+
+
+def _queue_files(source_dir: str, sizes: list[int]) -> Queue:
+    q: Queue = Queue()
+    for i, size in enumerate(sizes):
+        path = Path(source_dir) / f"source-{i}.csv"
+        path.write_bytes(b"x" * size)
+        q.put(MockEvent(path.as_posix()))
+    return q
+
+
+def test_next_trigger_coalesces_queued_files(csv_source):
+    with TemporaryDirectory() as source_dir:
+        q = _queue_files(source_dir, [10, 10, 10])
+
+        paths = csv_source._next_trigger(q, deque())
+
+        assert [Path(p).name for p in paths] == [
+            "source-0.csv",
+            "source-1.csv",
+            "source-2.csv",
+        ]
+
+
+def test_next_trigger_max_files(csv_source):
+    with TemporaryDirectory() as source_dir:
+        csv_source._options = dict(maxFilesPerTrigger="2")
+        q = _queue_files(source_dir, [10, 10, 10])
+        pending: deque[str] = deque()
+
+        first = csv_source._next_trigger(q, pending)
+        second = csv_source._next_trigger(q, pending)
+
+        assert len(first) == 2
+        assert [Path(p).name for p in second] == ["source-2.csv"]
+
+
+def test_next_trigger_max_bytes(csv_source):
+    with TemporaryDirectory() as source_dir:
+        csv_source._options = dict(maxBytesPerTrigger="25")
+        q = _queue_files(source_dir, [10, 10, 10, 30])
+        pending: deque[str] = deque()
+
+        triggers = [csv_source._next_trigger(q, pending) for _ in range(3)]
+
+        assert [len(paths) for paths in triggers] == [2, 1, 1]
+
+
+def test_read_paths(csv_source):
+    with TemporaryDirectory() as source_dir:
+        df1 = pl.DataFrame({"col1": [1, 2, 3]})
+        df2 = pl.DataFrame({"col1": [4, 5]})
+        df1.write_csv(Path(source_dir) / "source-1.csv")
+        df2.write_csv(Path(source_dir) / "source-2.csv")
+
+        pl_df = csv_source._read_paths(
+            [
+                (Path(source_dir) / "source-1.csv").as_posix(),
+                (Path(source_dir) / "source-2.csv").as_posix(),
+            ]
+        )
+
+        assert_frame_equal(pl_df.collect(), pl.concat([df1, df2]))
+
+
+def test_batch_source_bounded_backfill(csv_source):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            csv_source._path = Path(source_dir)
+            csv_source._options = dict(maxFilesPerTrigger="2")
+            config = Config(dict(), OutputMode.COMPLETE)
+            for i in range(5):
+                pl.DataFrame({"col1": [i]}).write_csv(
+                    Path(source_dir) / f"source-{i}.csv"
+                )
+
+            microbatches = list(csv_source.process(StateStore(state_dir), config))
+
+            assert [len(mb.metadata.source_files) for mb in microbatches] == [2, 2, 1]
+            assert [len(mb.metadata.wal_ids) for mb in microbatches] == [2, 2, 1]
+            assert sorted(
+                pl.concat([mb.pl_df.collect() for mb in microbatches])["col1"]
+            ) == list(range(5))
+
+
+@pytest.mark.parametrize("backfill_bytes, batches", [(None, 5), ("0", 1)])
+def test_streaming_backfill_bounded_by_default(
+    csv_source, monkeypatch, backfill_bytes, batches
+):
+    with TemporaryDirectory() as source_dir:
+        # Given
+        if backfill_bytes is not None:
+            csv_source._options = dict(maxBytesPerBackfill=backfill_bytes)
+        source_files = [Path(source_dir) / f"source-{i}.csv" for i in range(5)]
+        for i, path in enumerate(source_files):
+            pl.DataFrame({"col1": [i]}).write_csv(path)
+        monkeypatch.setattr(
+            "polar_streams.source.DEFAULT_BACKFILL_BYTES",
+            source_files[0].stat().st_size,
+        )
+
+        # When
+        batch_files = list(csv_source._backfill_batches(source_files, True))
+
+        # Then
+        assert len(batch_files) == batches
+        assert [path for paths in batch_files for path in paths] == source_files
+
+
+def test_batch_source_backfill_single_batch_in_complete_mode(csv_source, monkeypatch):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            # Given
+            csv_source._path = Path(source_dir)
+            config = Config(dict(), OutputMode.COMPLETE)
+            for i in range(5):
+                pl.DataFrame({"col1": [i]}).write_csv(
+                    Path(source_dir) / f"source-{i}.csv"
+                )
+            file_size = (Path(source_dir) / "source-0.csv").stat().st_size
+            monkeypatch.setattr(
+                "polar_streams.source.DEFAULT_BACKFILL_BYTES", file_size
+            )
+
+            # When
+            microbatches = list(csv_source.process(StateStore(state_dir), config))
+
+            # Then
+            assert len(microbatches) == 1
+            assert sorted(microbatches[0].pl_df.collect()["col1"]) == list(range(5))
+
+
+def test_batch_source_skips_committed_files(csv_source):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            csv_source._path = Path(source_dir)
+            csv_source._options = dict(run_initial_batch="false")
+            config = Config(dict(), OutputMode.COMPLETE)
+            for i in range(3):
+                pl.DataFrame({"col1": [i]}).write_csv(
+                    Path(source_dir) / f"source-{i}.csv"
+                )
+            state_store = StateStore(state_dir)
+            for microbatch in csv_source.process(state_store, config):
+                if microbatch.metadata.source_files[0].name != "source-2.csv":
+                    state_store.commit_batch(microbatch.metadata.wal_ids)
+
+            pl.DataFrame({"col1": [3]}).write_csv(Path(source_dir) / "source-3.csv")
+            pl.DataFrame({"col1": [1, 1]}).write_csv(Path(source_dir) / "source-1.csv")
+
+            restarted = list(csv_source.process(StateStore(state_dir), config))
+
+            assert sorted(
+                pl.concat([mb.pl_df.collect() for mb in restarted])["col1"]
+            ) == [1, 1, 2, 3]
+
+
+def test_source_skips_deleted_files(csv_source, monkeypatch):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            # Given triggers holding files deleted before they were read
+            csv_source._path = Path(source_dir)
+            config = Config(dict(), OutputMode.APPEND)
+            deleted = (Path(source_dir) / "source-1.csv").as_posix()
+            existing = Path(source_dir) / "source-2.csv"
+            pl.DataFrame({"col1": [1, 2, 3]}).write_csv(existing)
+            triggers = iter([[deleted], [deleted, existing.as_posix()]])
+            monkeypatch.setattr(
+                csv_source, "_next_trigger", lambda q, pending: next(triggers)
+            )
+            state_store = StateStore(state_dir)
+
+            # When
+            process_gen = csv_source.process(state_store, config)
+            microbatch = next(process_gen)
+            process_gen.close()
+
+            # Then
+            assert microbatch.metadata.source_files == [existing]
+            assert len(microbatch.metadata.wal_ids) == 1
+            assert state_store.wal_uncommitted_entries() == [existing.as_posix()]
+
+
+def test_inferred_schema_pinned_across_restarts(csv_source):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            # Given
+            csv_source._path = Path(source_dir)
+            csv_source._options = dict(run_initial_batch="false")
+            config = Config(dict(), OutputMode.COMPLETE)
+            pl.DataFrame({"col1": ["a"]}).write_csv(Path(source_dir) / "source-1.csv")
+            for microbatch in csv_source.process(StateStore(state_dir), config):
+                microbatch.pl_df.collect()
+
+            # When
+            pl.DataFrame({"col1": [1]}).write_csv(Path(source_dir) / "source-2.csv")
+            restarted = FileSource(options=dict(run_initial_batch="false"), fmt="csv")
+            restarted._path = Path(source_dir)
+            microbatches = list(restarted.process(StateStore(state_dir), config))
+
+            # Then
+            assert StateStore(state_dir).source_schema(
+                Path(source_dir).resolve().as_posix()
+            ) == pl.Schema({"col1": pl.String})
+            assert_frame_equal(
+                microbatches[-1].pl_df.collect(), pl.DataFrame({"col1": ["1"]})
+            )
+
+
+def test_schema_option():
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            # Given
+            schema = pl.Schema({"col1": pl.Float64, "col2": pl.String})
+            source = FileSource(options=dict(), fmt="ndjson", schema=schema)
+            source._path = Path(source_dir)
+            pl.DataFrame({"col1": [1, 2], "col2": ["a", "b"]}).write_ndjson(
+                Path(source_dir) / "source-1.ndjson"
+            )
+
+            # When
+            microbatch = next(
+                source.process(
+                    StateStore(state_dir), Config(dict(), OutputMode.COMPLETE)
+                )
+            )
+
+            # Then
+            assert microbatch.pl_df.collect_schema() == schema
+            assert_frame_equal(
+                microbatch.pl_df.collect(),
+                pl.DataFrame({"col1": [1.0, 2.0], "col2": ["a", "b"]}),
+            )
+
+
+def test_json_read_lazily_with_schema():
+    with TemporaryDirectory() as source_dir:
+        # Given
+        schema = pl.Schema({"col1": pl.Int64})
+        source = FileSource(options=dict(), fmt="json", schema=schema)
+        path = Path(source_dir) / "source-1.json"
+
+        # When
+        pl_df = source._read_paths([path.as_posix()])
+        pl.DataFrame({"col1": [1, 2]}).write_json(path)
+
+        # Then
+        assert_frame_equal(pl_df.collect(), pl.DataFrame({"col1": [1, 2]}))
+
+
+def test_source_polling_discovery(csv_source):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            csv_source._path = Path(source_dir)
+            csv_source._options = dict(
+                discoveryMode="polling",
+                pollInterval="10ms",
+                fileStabilityInterval="10ms",
+            )
+            config = Config(dict(), OutputMode.APPEND)
+            df1 = pl.DataFrame({"col1": [1, 2, 3]})
+            df2 = pl.DataFrame({"col1": [4, 5, 6]})
+            df1.write_csv(Path(source_dir) / "source-1.csv")
+
+            process_gen = csv_source.process(StateStore(state_dir), config)
+            out_df_1 = next(process_gen)
+            (Path(source_dir) / "nested").mkdir()
+            df2.write_csv(Path(source_dir) / "nested" / "source-2.csv")
+            out_df_2 = next(process_gen)
+            process_gen.close()
+
+            assert_frame_equal(out_df_1.pl_df.collect(), df1)
+            assert_frame_equal(out_df_2.pl_df.collect(), df2)
+            assert out_df_2.metadata.source_files == [
+                Path(source_dir) / "nested" / "source-2.csv"
+            ]
+
+
+def test_source_holds_back_recent_files_by_default(csv_source):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            # Given a file written long ago and one still being written
+            csv_source._path = Path(source_dir)
+            config = Config(dict(), OutputMode.APPEND)
+            df1 = pl.DataFrame({"col1": [1, 2, 3]})
+            df2 = pl.DataFrame({"col1": [4, 5, 6]})
+            df1.write_csv(Path(source_dir) / "source-1.csv")
+            os.utime(Path(source_dir) / "source-1.csv", (0, 0))
+            df2.write_csv(Path(source_dir) / "source-2.csv")
+
+            # When
+            process_gen = csv_source.process(StateStore(state_dir), config)
+            out_df_1 = next(process_gen)
+            out_df_2 = next(process_gen)
+            process_gen.close()
+
+            # Then the recent file is left out of the backfill until it is stable
+            assert out_df_1.metadata.source_files == [Path(source_dir) / "source-1.csv"]
+            assert_frame_equal(out_df_1.pl_df.collect(), df1)
+            assert_frame_equal(out_df_2.pl_df.collect(), df2)
+
+
+def test_source_waits_for_moved_files(csv_source):
+    with TemporaryDirectory() as source_dir:
+        with TemporaryDirectory() as state_dir:
+            csv_source._path = Path(source_dir)
+            config = Config(dict(), OutputMode.APPEND)
+            df1 = pl.DataFrame({"col1": [1, 2, 3]})
+            df2 = pl.DataFrame({"col1": [4, 5, 6]})
+            df1.write_csv(Path(source_dir) / "source-1.csv")
+            df2.write_csv(Path(source_dir) / "source-0.csv.tmp")
+
+            process_gen = csv_source.process(StateStore(state_dir), config)
+            out_df_1 = next(process_gen)
+            (Path(source_dir) / "source-0.csv.tmp").rename(
+                Path(source_dir) / "source-2.csv"
+            )
+            out_df_2 = next(process_gen)
+            process_gen.close()
+
+            assert_frame_equal(out_df_1.pl_df.collect(), df1)
+            assert_frame_equal(out_df_2.pl_df.collect(), df2)
+
+
+def test_static_table_reloads_changed_files():
+    with TemporaryDirectory() as source_dir:
+        # Given
+        pl.DataFrame({"id": [1], "name": ["a"]}).write_csv(f"{source_dir}/1.csv")
+        table = StaticFactory().format("csv").load(source_dir)
+        first = table.get()
+
+        # When
+        pl.DataFrame({"id": [2], "name": ["b"]}).write_csv(f"{source_dir}/2.csv")
+        second = table.get()
+
+        # Then
+        assert first["id"].to_list() == [1]
+        assert sorted(second["id"].to_list()) == [1, 2]
+        assert table.get() is second
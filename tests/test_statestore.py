@@ -1,4 +1,6 @@
 # mypy: disable-error-code="no-untyped-def"
+import sqlite3
+from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import polars as pl
@@ -25,12 +27,10 @@ def test_not_state_exists(state_store):
 def test_state_exists(state_store):
     # Given
     table_name = "test"
-    cur = state_store._con.cursor()
-    cur.execute(f"CREATE TABLE {table_name} (id INTEGER)")
-    cur.close()
+    state_store.write_state(pl.DataFrame({"id": [1]}).lazy(), table_name)
 
     # When
-    exists = state_store.state_exists(table_name)
+    exists = StateStore(state_store._state_dir).state_exists(table_name)
 
     # Then
     assert exists
@@ -111,8 +111,367 @@ def test_write_get_state(state_store):
 
     # Then
     df.equals(result)
-    assert cur.execute(f"SELECT col1, col2 FROM {table_name};").fetchall() == [
+    version = state_store._version(table_name)
+    assert cur.execute(
+        f"SELECT col1, col2 FROM {table_name}__{version:020d};"
+    ).fetchall() == [
         (1, 4),
         (2, 5),
         (3, 6),
     ]
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "ipc", "parquet"])
+def test_state_backends(backend):
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend=backend)
+        df_1 = pl.DataFrame({"col1": [1, 2, 3], "col2": ["a", "b", "c"]})
+        df_2 = pl.DataFrame({"col1": [4], "col2": ["d"]})
+
+        # When
+        exists_before = state_store.state_exists("test")
+        state_store.write_state(df_1.lazy(), "test")
+        state_store.write_state(df_2.lazy(), "test")
+
+        # Then
+        assert not exists_before
+        assert state_store.state_exists("test")
+        assert state_store.get_state("test").collect().equals(df_2)
+
+
+def test_file_backend_retains_versions():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend="ipc")
+        df = pl.DataFrame({"col1": [1, 2, 3]})
+
+        # When
+        for _ in range(5):
+            state_store.write_state(df.lazy(), "test")
+
+        # Then
+        versions = sorted(p.name for p in (Path(state_dir) / "state/test").iterdir())
+        assert versions == [f"{3:020d}.arrow", f"{4:020d}.arrow"]
+
+
+def test_unsupported_backend():
+    with TemporaryDirectory() as state_dir:
+        with pytest.raises(ValueError) as exc_info:
+            StateStore(state_dir, backend="csv")
+
+        assert str(exc_info.value) == "csv is not supported"
+
+
+def test_write_behind_checkpoint():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend="ipc", checkpoint_batches=2)
+        backend_store = StateStore(state_dir, backend="ipc")
+        df = pl.DataFrame({"col1": [1, 2, 3]})
+        wal_id = state_store.wal_append("test-key")
+
+        # When
+        state_store.write_state(df.lazy(), "test")
+        state_store.commit_batch([wal_id])
+
+        # Then state is served from memory without being persisted
+        assert state_store.get_state("test").collect().equals(df)
+        assert not backend_store.state_exists("test")
+        assert state_store.wal_uncommitted_entries() == ["test-key"]
+
+        # When
+        state_store.commit_batch([])
+        state_store.checkpoint(wait=True)
+
+        # Then
+        assert backend_store.get_state("test").collect().equals(df)
+        assert state_store.wal_uncommitted_entries() == []
+
+
+def test_write_through_commit_batch():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir)
+        wal_id = state_store.wal_append("test-key")
+
+        # When
+        state_store.commit_batch([wal_id])
+
+        # Then
+        assert state_store.wal_uncommitted_entries() == []
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "ipc", "parquet"])
+def test_append_state(backend):
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend=backend)
+        df_1 = pl.DataFrame({"col1": [1, 2]})
+        df_2 = pl.DataFrame({"col1": [3]})
+
+        # When
+        state_store.append_state(df_1.lazy(), "test")
+        state_store.append_state(df_2.lazy(), "test")
+
+        # Then
+        assert state_store.get_state("test").collect().equals(pl.concat([df_1, df_2]))
+
+
+def test_file_backend_compacts_deltas():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend="ipc")
+        table_dir = Path(state_dir) / "state/test"
+
+        # When
+        for i in range(10):
+            state_store.append_state(pl.DataFrame({"col1": [i]}).lazy(), "test")
+
+        # Then
+        live = [p.name for p in sorted(table_dir.iterdir())][-2:]
+        assert live == [f"{9:020d}.arrow", f"{10:020d}.delta.arrow"]
+        assert state_store.get_state("test").collect()["col1"].to_list() == list(
+            range(10)
+        )
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "ipc"])
+def test_write_behind_checkpoints_deltas(backend):
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend=backend, checkpoint_batches=1)
+        state_store.write_state(pl.DataFrame({"col1": [0]}).lazy(), "test")
+        state_store.commit_batch([])
+
+        # When
+        for i in range(1, 4):
+            state_store.append_state(pl.DataFrame({"col1": [i]}).lazy(), "test")
+            state_store.commit_batch([])
+        state_store.write_state(pl.DataFrame({"col1": [4]}).lazy(), "replaced")
+        state_store.append_state(pl.DataFrame({"col1": [5]}).lazy(), "replaced")
+        state_store.commit_batch([])
+        state_store.checkpoint(wait=True)
+
+        # Then appends are written as deltas, and tables replaced in full
+        backend_store = StateStore(state_dir, backend=backend)
+        assert backend_store._backend._versions("test") == [
+            (0, False),
+            (1, True),
+            (2, True),
+            (3, True),
+        ]
+        assert backend_store._backend._versions("replaced") == [(0, False)]
+        assert backend_store.get_state("test").collect()["col1"].to_list() == [
+            0,
+            1,
+            2,
+            3,
+        ]
+        assert backend_store.get_state("replaced").collect()["col1"].to_list() == [
+            4,
+            5,
+        ]
+
+
+def test_processed_source_files():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir)
+        id_1 = state_store.wal_append_file("source-1.csv", 10, 1.5)
+        state_store.wal_append_file("source-2.csv", 20, 2.5)
+
+        # When
+        state_store.wal_commit(id_1)
+        result = state_store.processed_source_files()
+
+        # Then
+        assert result == {"source-1.csv": (10, 1.5)}
+        assert state_store.wal_uncommitted_entries() == ["source-2.csv"]
+
+
+def test_source_schema():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir)
+        schema = pl.Schema({"col1": pl.Int64, "col2": pl.Datetime("us")})
+
+        # When
+        state_store.write_source_schema("source", schema)
+
+        # Then
+        assert StateStore(state_dir).source_schema("source") == schema
+        assert state_store.source_schema("other") is None
+
+
+def test_wal_append_commit_many():
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, backend="ipc", synchronous="off")
+        keys = ["source-1.csv", "it's-quoted.csv", "source-3.csv"]
+
+        # When
+        wal_ids = state_store.wal_append_many(keys)
+        state_store.wal_commit_many(wal_ids[:2])
+
+        # Then
+        assert wal_ids == [1, 2, 3]
+        assert state_store.wal_uncommitted_entries() == ["source-3.csv"]
+        assert state_store.wal_append_many([]) == []
+        journal_mode = state_store._con.execute("PRAGMA journal_mode").fetchone()
+        assert journal_mode == ("wal",)
+
+
+@pytest.mark.parametrize(
+    "backend, synchronous", [("sqlite", 2), ("ipc", 1), ("parquet", 1)]
+)
+def test_synchronous_default(backend, synchronous):
+    with TemporaryDirectory() as state_dir:
+        # When
+        state_store = StateStore(state_dir, backend=backend)
+
+        # Then a rollback journaled database is fsynced on every commit
+        assert state_store._con.execute("PRAGMA synchronous").fetchone() == (
+            synchronous,
+        )
+
+
+def test_unsupported_synchronous():
+    with TemporaryDirectory() as state_dir:
+        with pytest.raises(ValueError) as exc_info:
+            StateStore(state_dir, synchronous="sometimes")
+
+        assert str(exc_info.value) == "sometimes is not supported"
+
+
+@pytest.mark.parametrize("checkpoint_batches", [None, 1])
+def test_partition_state_committed_by_parent(checkpoint_batches):
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, checkpoint_batches=checkpoint_batches)
+        partition = state_store.partition(1)()
+        pl_df = pl.DataFrame({"id": [1, 2]})
+        wal_ids = state_store.wal_append_many(["batch-0"])
+
+        # When
+        partition.write_state(pl_df.lazy(), "group_by")
+        state_store.add_batch_states(partition.end_batch())
+        state_store.commit_batch(wal_ids)
+        state_store.checkpoint(wait=True)
+
+        # Then
+        reopened = state_store.partition(1)()
+        assert reopened.get_state("group_by").collect().equals(pl_df)
+        assert not state_store.state_exists("group_by")
+        assert not state_store.partition(0)().state_exists("group_by")
+        assert state_store.wal_uncommitted_entries() == []
+
+
+@pytest.mark.parametrize("checkpoint_batches", [None, 2])
+def test_after_commit_runs_once_wal_committed(checkpoint_batches):
+    with TemporaryDirectory() as state_dir:
+        # Given
+        state_store = StateStore(state_dir, checkpoint_batches=checkpoint_batches)
+        wal_ids = state_store.wal_append_many(["a", "b"])
+        committed = []
+
+        # When
+        state_store.after_commit(lambda: committed.append(wal_ids))
+        assert not state_store.wal_committed(wal_ids)
+        state_store.commit_batch(wal_ids)
+        state_store.checkpoint(wait=True)
+
+        # Then
+        assert committed == [wal_ids]
+        assert state_store.wal_committed(wal_ids)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "ipc", "parquet"])
+def test_crash_before_commit_rolls_back_state(backend, monkeypatch):
+    with TemporaryDirectory() as state_dir:
+        # Given a committed checkpoint
+        state_store = StateStore(state_dir, backend=backend, checkpoint_batches=1)
+        committed = pl.DataFrame({"col1": [1]})
+        state_store.write_state(committed.lazy(), "test")
+        state_store.commit_batch(state_store.wal_append_many(["batch-0"]))
+        state_store.checkpoint(wait=True)
+
+        # When the process crashes once the next state is written, before the WAL
+        # entries covering it are committed
+        def crash(con, wal_ids, versions):
+            raise KeyboardInterrupt
+
+        monkeypatch.setattr(StateStore, "_commit", staticmethod(crash))
+        state_store.write_state(pl.DataFrame({"col1": [1, 2]}).lazy(), "test")
+        with pytest.raises(KeyboardInterrupt):
+            state_store.commit_batch(state_store.wal_append_many(["batch-1"]))
+            state_store.checkpoint(wait=True)
+        monkeypatch.undo()
+
+        # Then the state of the uncommitted batch is not read on restart
+        restarted = StateStore(state_dir, backend=backend, checkpoint_batches=1)
+        assert restarted.wal_uncommitted_entries() == ["batch-1"]
+        assert restarted.get_state("test").collect().equals(committed)
+
+        # When the batch is replayed
+        replayed = pl.DataFrame({"col1": [1, 3]})
+        restarted.write_state(replayed.lazy(), "test")
+        restarted.commit_batch(restarted.wal_append_many(["batch-1"]))
+        restarted.checkpoint(wait=True)
+
+        # Then
+        assert (
+            StateStore(state_dir, backend=backend)
+            .get_state("test")
+            .collect()
+            .equals(replayed)
+        )
+
+
+def test_legacy_state_adopted():
+    with TemporaryDirectory() as state_dir:
+        # Given a checkpoint written before state was versioned
+        con = sqlite3.connect(Path(state_dir) / "state.db", isolation_level=None)
+        con.execute(
+            "CREATE TABLE write_ahead_log (id INTEGER PRIMARY KEY, key VARCHAR)"
+        )
+        con.execute("CREATE TABLE wal_commits (id INTEGER PRIMARY KEY, wal_id INTEGER)")
+        con.close()
+        group_by = pl.DataFrame({"id": [1, 2], "col2": [3, 4]})
+        drop_duplicates = pl.DataFrame({"id": [1, 2]})
+        for pl_df, table_name in [
+            (group_by, "group_by"),
+            (drop_duplicates, "drop_duplicates"),
+        ]:
+            pl_df.write_database(
+                table_name=table_name,
+                connection=f"sqlite:///{state_dir}/state.db",
+                engine="adbc",
+            )
+
+        # When
+        state_store = StateStore(state_dir)
+
+        # Then
+        assert state_store.state_exists("group_by")
+        assert state_store.state_exists("drop_duplicates")
+        assert not state_store.state_exists("wal_commits")
+        assert state_store.get_state("group_by").collect().equals(group_by)
+        assert (
+            state_store.get_state("drop_duplicates").collect().equals(drop_duplicates)
+        )
+
+
+def test_legacy_file_state_adopted():
+    with TemporaryDirectory() as state_dir:
+        # Given file state written before versions were committed
+        state_store = StateStore(state_dir, backend="ipc")
+        pl_df = pl.DataFrame({"col1": [1, 2]})
+        state_store.write_state(pl_df.lazy(), "test")
+        state_store._con.execute("DROP TABLE state_versions")
+
+        # When
+        restarted = StateStore(state_dir, backend="ipc")
+
+        # Then
+        assert restarted.get_state("test").collect().equals(pl_df)
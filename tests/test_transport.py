@@ -0,0 +1,78 @@
+# mypy: disable-error-code="no-untyped-def"
+import os
+from datetime import datetime
+
+import polars as pl
+from polars.testing import assert_frame_equal
+from pytest import fixture
+
+from polar_streams.transport import ArrowTransport
+
+
+@fixture
+def transport():
+    transport = ArrowTransport()
+    yield transport
+    transport.close()
+
+
+@fixture
+def pl_df():
+    return pl.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "name": ["a", None, "c"],
+            "ts": [datetime(2024, 1, 1), datetime(2024, 1, 2), None],
+        }
+    )
+
+
+def test_send_receive(transport, pl_df):
+    # Given
+    (handle,) = transport.send(pl_df)
+
+    # When
+    result = transport.receive(handle)
+
+    # Then
+    assert_frame_equal(result, pl_df)
+    assert not os.path.exists(handle.path)
+    assert os.listdir(transport.directory) == []
+
+
+def test_send_to_many_receivers(transport, pl_df):
+    # Given
+    handles = transport.send(pl_df, receivers=2)
+
+    # When
+    first = ArrowTransport.receive(handles[0])
+
+    # Then
+    assert os.listdir(transport.directory) == [os.path.basename(handles[1].path)]
+    assert_frame_equal(ArrowTransport.receive(handles[1]), first)
+    assert_frame_equal(first, pl_df)
+
+
+def test_send_through_opened_transport(transport, pl_df):
+    # Given
+    opened = ArrowTransport(transport.directory)
+
+    # When
+    (handle,) = opened.send(pl_df.clear())
+    opened.close()
+
+    # Then
+    assert_frame_equal(transport.receive(handle), pl_df.clear())
+    assert os.path.isdir(transport.directory)
+
+
+def test_close_releases_unreceived_handles(pl_df):
+    # Given
+    transport = ArrowTransport()
+    transport.send(pl_df)
+
+    # When
+    transport.close()
+
+    # Then
+    assert not os.path.exists(transport.directory)
@@ -0,0 +1,81 @@
+# mypy: disable-error-code="no-untyped-def"
+import logging
+from datetime import timedelta
+
+import pytest
+
+from polar_streams import util
+from polar_streams.util import log, parse_duration, staticlog
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    @log()
+    def increment(self, step, counted):
+        self.count += step
+        return self.count
+
+
+class Unformattable:
+    def __repr__(self):
+        raise AssertionError("Arguments formatted while logging is disabled")
+
+
+@pytest.mark.parametrize(
+    "duration,expected",
+    [
+        ("10s", timedelta(seconds=10)),
+        ("1h30m", timedelta(hours=1, minutes=30)),
+        ("250ms", timedelta(milliseconds=250)),
+        ("2w", timedelta(weeks=2)),
+        (timedelta(days=1), timedelta(days=1)),
+    ],
+)
+def test_parse_duration(duration, expected):
+    assert parse_duration(duration) == expected
+
+
+@pytest.mark.parametrize("duration", ["", "10", "1mo", "1h 30m"])
+def test_parse_invalid_duration(duration):
+    with pytest.raises(ValueError) as exc_info:
+        parse_duration(duration)
+
+    assert str(exc_info.value) == f"{duration} is not a valid duration"
+
+
+def test_log_formats_arguments_when_enabled(caplog):
+    # Given
+    caplog.set_level(logging.DEBUG, logger="Counter.increment")
+
+    # When
+    result = Counter().increment(2, counted=True)
+
+    # Then
+    assert result == 2
+    assert caplog.messages == ["increment: args((2,)), kwargs({'counted': True})"]
+
+
+def test_log_skips_formatting_when_disabled(caplog):
+    # Given
+    caplog.set_level(logging.INFO, logger="Counter.increment")
+
+    # When
+    result = Counter().increment(1, counted=Unformattable())
+
+    # Then
+    assert result == 1
+    assert caplog.messages == []
+
+
+def test_log_calls_switch_leaves_functions_unwrapped(monkeypatch):
+    # Given
+    monkeypatch.setattr(util, "LOG_CALLS", False)
+
+    def func():
+        pass
+
+    # When / Then
+    assert log()(func) is func
+    assert staticlog()(func) is func
@@ -0,0 +1,66 @@
+# mypy: disable-error-code="no-untyped-def"
+from datetime import datetime
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from polar_streams.window import Window
+
+
+def test_tumbling_window():
+    # Given
+    df = pl.DataFrame(
+        {"time": [datetime(2025, 1, 1, 0, 0, 30), datetime(2025, 1, 1, 0, 7)]}
+    ).lazy()
+
+    # When
+    result = Window("time", "5m").assign(df).collect()
+
+    # Then
+    assert_frame_equal(
+        result,
+        pl.DataFrame(
+            {
+                "time": [datetime(2025, 1, 1, 0, 0, 30), datetime(2025, 1, 1, 0, 7)],
+                "window_start": [
+                    datetime(2025, 1, 1, 0, 0),
+                    datetime(2025, 1, 1, 0, 5),
+                ],
+                "window_end": [datetime(2025, 1, 1, 0, 5), datetime(2025, 1, 1, 0, 10)],
+            }
+        ),
+    )
+
+
+def test_sliding_window():
+    # Given
+    df = pl.DataFrame({"time": [datetime(2025, 1, 1, 0, 7)]}).lazy()
+
+    # When
+    result = Window("time", "10m", "5m").assign(df).collect()
+
+    # Then
+    assert_frame_equal(
+        result,
+        pl.DataFrame(
+            {
+                "time": [datetime(2025, 1, 1, 0, 7)] * 2,
+                "window_start": [
+                    datetime(2025, 1, 1, 0, 5),
+                    datetime(2025, 1, 1, 0, 0),
+                ],
+                "window_end": [
+                    datetime(2025, 1, 1, 0, 15),
+                    datetime(2025, 1, 1, 0, 10),
+                ],
+            }
+        ),
+    )
+
+
+def test_window_slide_larger_than_size():
+    with pytest.raises(ValueError) as exc_info:
+        Window("time", "5m", "10m")
+
+    assert str(exc_info.value) == "Window slide cannot be larger than its size"